@@ -0,0 +1,75 @@
+"""
+Import-time guard for the serving path.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Usage:
+    $ python benchmarks/imports.py --budget 5.0 --baseline imports.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+
+# Training and plotting dependencies that must stay off the inference path
+FORBIDDEN = ('pandas', 'matplotlib', 'seaborn', 'requests', 'pkg_resources', 'utils.plots', 'utils.datasets')
+
+PROBE = """
+import sys, time, json
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(json.dumps({'seconds': t, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure(module, runs):
+    """ Import a module in fresh interpreters.
+
+        Args:
+            module(str): dotted module name, relative to the app directory
+            runs(int): number of fresh interpreters
+
+        Returns:
+            (dict) best import time in seconds and the modules loaded by the import
+    """
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', PROBE % module], cwd=ROOT, env=os.environ,
+                             check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return {'seconds': min(r['seconds'] for r in results), 'modules': results[0]['modules']}
+
+
+def main(opt):
+    result = measure(opt.module, opt.runs)
+    loaded = sorted(m for m in FORBIDDEN if m in result['modules'])
+    report = {'module': opt.module, 'seconds': round(result['seconds'], 4), 'forbidden': loaded}
+    errors = ['forbidden modules imported: %s' % ', '.join(loaded)] if loaded else []
+    if opt.budget and result['seconds'] > opt.budget:
+        errors.append('import time %.3fs over budget %.3fs' % (result['seconds'], opt.budget))
+    if opt.baseline and Path(opt.baseline).exists():
+        baseline = json.loads(Path(opt.baseline).read_text())['seconds']
+        report['baseline'] = baseline
+        if result['seconds'] > baseline * (1 + opt.tolerance):
+            errors.append('import time %.3fs regressed over baseline %.3fs' % (result['seconds'], baseline))
+    elif opt.baseline:
+        Path(opt.baseline).write_text(json.dumps(report, indent=2))  # first run records the baseline
+    report['errors'] = errors
+    print(json.dumps(report, indent=2))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import cost of the serving path')
+    parser.add_argument('--module', type=str, default='logic.reader', help='module to import')
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters, the fastest is kept')
+    parser.add_argument('--budget', type=float, default=0.0, help='maximum import time in seconds, 0 to disable')
+    parser.add_argument('--baseline', type=str, default='', help='baseline JSON report, written if missing')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression over baseline')
+    sys.exit(main(parser.parse_args()))
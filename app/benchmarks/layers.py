@@ -0,0 +1,164 @@
+"""
+Per-layer profile of the served model.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+The model is loaded as the Reader loads it, fused and in eval mode, and run on
+representative shapes and batch sizes. Each layer reports its time, FLOPs,
+params and output activation bytes, with totals per module type (Conv, C3, SPPF,
+...). With --compare, a second model or an earlier JSON report is profiled or
+read on the same shapes and the report carries the differences, to see which
+blocks to slim.
+
+Usage:
+    $ python benchmarks/layers.py --weights model/best.pt --shapes 480x640 320x320 --batch-sizes 1 8
+    $ python benchmarks/layers.py --weights model/slim.pt --compare model/best.pt --output diff.json
+    $ python benchmarks/layers.py --config config.yaml --compare layers.json
+"""
+
+import sys
+import json
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+import torch
+import yaml
+
+from models.experimental import Ensemble, attempt_load
+from utils.general import check_img_size
+from utils.params import Parameters
+
+FIELDS = ('time_ms', 'gflops', 'params', 'output_bytes')
+
+
+def profile_model(model, shapes, batch_sizes, device, n=10):
+    """ Per-layer profile of a model on every shape and batch size.
+
+        Args:
+            model(Model): fused model in eval mode
+            shapes(list): inference (height, width), aligned to the model stride
+            batch_sizes(list): images per forward
+            device(torch.device): device the model is on
+            n(int): timed runs per layer, the mean is reported
+
+        Returns:
+            (list) one run per (shape, batch size), with its layers, totals and totals per module type
+    """
+    if isinstance(model, Ensemble):
+        raise ValueError('profile the ensemble members one at a time')
+    dtype = next(model.parameters()).dtype
+    stride = int(model.stride.max())
+    runs = []
+    for shape in shapes:
+        shape = check_img_size(list(shape), s=stride)
+        for bs in batch_sizes:
+            x = torch.zeros(bs, 3, *shape, device=device, dtype=dtype)
+            model.profile_layers(x, 1)  # warm-up, cudnn autotuning and Detect grids
+            layers = [_rounded(p) for p in model.profile_layers(x, n)]
+            runs.append({'shape': shape, 'batch_size': bs, 'layers': layers,
+                         'total': _sum(layers), 'by_type': _by_type(layers)})
+    return runs
+
+
+def diff(runs, baseline):
+    """ Differences of a profile over a baseline profile, on the runs of the same shape and batch size.
+    Layers are compared one by one when both models have the same layer types, per module type otherwise.
+
+        Args:
+            runs(list): profile, as returned by profile_model()
+            baseline(list): baseline profile
+
+        Returns:
+            (list) per run, the differences (profile - baseline) and time ratios of the totals, types and layers
+    """
+    base = {(tuple(r['shape']), r['batch_size']): r for r in baseline}
+    diffs = []
+    for run in runs:
+        b = base.get((tuple(run['shape']), run['batch_size']))
+        if b is None:
+            continue
+        d = {'shape': run['shape'], 'batch_size': run['batch_size'], 'total': _delta(run['total'], b['total']),
+             'by_type': {t: _delta(run['by_type'].get(t), b['by_type'].get(t))
+                         for t in sorted(set(run['by_type']) | set(b['by_type']))}}
+        if [p['type'] for p in run['layers']] == [p['type'] for p in b['layers']]:
+            d['layers'] = [dict(_delta(p, q), i=p['i'], type=p['type']) for p, q in zip(run['layers'], b['layers'])]
+        diffs.append(d)
+    return diffs
+
+
+def load(weights, device):
+    """ Load a model as the Reader does, or the runs of an earlier JSON report.
+
+        Args:
+            weights(str): checkpoint, serving artifact or JSON report
+            device(torch.device): device the model is loaded on
+
+        Returns:
+            (Model or list) model, or the runs of the report
+    """
+    if weights.endswith('.json'):
+        return json.loads(Path(weights).read_text())['runs']
+    return attempt_load(weights, map_location=device)
+
+
+def _sum(layers):
+    return _rounded({k: sum(p[k] for p in layers) for k in FIELDS})
+
+
+def _by_type(layers):
+    types = dict()
+    for p in layers:
+        types.setdefault(p['type'], []).append(p)
+    return {t: dict(_sum(group), count=len(group)) for t, group in types.items()}
+
+
+def _delta(a, b):
+    # a - b for every field, time ratio a / b; a missing side counts as zero
+    a, b = a or dict.fromkeys(FIELDS, 0), b or dict.fromkeys(FIELDS, 0)
+    d = _rounded({k: a[k] - b[k] for k in FIELDS})
+    d['time_ratio'] = round(a['time_ms'] / b['time_ms'], 3) if b['time_ms'] else None
+    return d
+
+
+def _rounded(p):
+    return dict(p, time_ms=round(p['time_ms'], 4), gflops=round(p['gflops'], 4))
+
+
+def main(opt):
+    with open(opt.config) as f:
+        params = Parameters(yaml.load(f, Loader=yaml.FullLoader)['detection'])
+    device = torch.device(opt.device) if opt.device else params.device
+    weights = opt.weights or params.model
+    if isinstance(weights, list):
+        sys.exit('model_path is an ensemble, set --weights to one of its members')
+    shapes = [tuple(int(v) for v in s.split('x')) for s in opt.shapes] if opt.shapes else [params.pred_shape[:2]]
+    torch.backends.cudnn.benchmark = True
+
+    runs = profile_model(load(weights, device), shapes, opt.batch_sizes, device, opt.runs)
+    report = {'weights': weights, 'device': str(device), 'runs': runs}
+    if opt.compare:
+        baseline = load(opt.compare, device)
+        if not isinstance(baseline, list):
+            baseline = profile_model(baseline, shapes, opt.batch_sizes, device, opt.runs)
+        report.update(compare=opt.compare, diff=diff(runs, baseline))
+    print(json.dumps(report, indent=2))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-layer time, FLOPs, params and activation bytes of the served model')
+    parser.add_argument('--config', type=str, default=str(ROOT / 'config.yaml'), help='configuration file, for defaults')
+    parser.add_argument('--weights', type=str, default='', help='checkpoint or serving artifact, default model_path')
+    parser.add_argument('--compare', type=str, default='', help='second checkpoint, or JSON report, to diff against')
+    parser.add_argument('--shapes', type=str, nargs='*', default=[], help='HxW inference shapes, default pred_shape')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1], help='images per forward')
+    parser.add_argument('--device', type=str, default='', help='cpu or cuda:0, default the configured device')
+    parser.add_argument('--runs', type=int, default=10, help='timed runs per layer')
+    parser.add_argument('--output', type=str, default='', help='JSON report path')
+    main(parser.parse_args())
@@ -0,0 +1,257 @@
+"""
+Load generator for the frame upload service.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Frames of a directory are replayed against /api/v1/frame-upload, as a number
+of simulated cameras, either at a target rate (open loop) or with a fixed
+number of requests in flight (closed loop). When the detected folder is
+reachable, i.e. on the same host or a shared volume, the generator waits for
+each result and reports the latency from upload to result.
+
+Usage:
+    $ python benchmarks/loadgen.py --frames ../sample-data --rate 10 --duration 60 \
+        --detected static-files/detected-license-plate --output report.json
+    $ python benchmarks/loadgen.py --frames ../sample-data --concurrency 4 --requests 500
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class LoadGenerator:
+    """ Replays frames against the upload endpoint and collects per-frame timings. """
+
+    def __init__(self, url, frames, cameras, detected=None, timeout=30.0):
+        self.__url = url
+        self.__frames = [(os.path.basename(path), open(path, 'rb').read()) for path in frames]
+        self.__cameras = ['cam%02d' % i for i in range(cameras)]
+        self.__detected = detected
+        self.__timeout = timeout
+        self.__session = threading.local()
+        self.__results = []
+        self.__lock = threading.Lock()
+
+    def run_rate(self, rate, count, duration):
+        """ Open loop: uploads start at a fixed rate, whatever the service latency.
+
+            Args:
+                rate(float): uploads per second, over all cameras
+                count(int): number of uploads, 0 for no limit
+                duration(float): seconds, 0 for no limit
+
+            Returns:
+                (float) seconds spent sending
+        """
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            for i in self.__schedule(count, duration, start):
+                delay = start + i / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.__upload, i, start + i / rate)
+        return time.monotonic() - start
+
+    def run_concurrency(self, concurrency, count, duration):
+        """ Closed loop: each worker uploads its next frame as soon as the previous upload returns.
+
+            Args:
+                concurrency(int): uploads in flight
+                count(int): number of uploads, 0 for no limit
+                duration(float): seconds, 0 for no limit
+
+            Returns:
+                (float) seconds spent sending
+        """
+        start = time.monotonic()
+        schedule = self.__schedule(count, duration, start)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    i = next(schedule, None)
+                if i is None:
+                    return
+                self.__upload(i)
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.monotonic() - start
+
+    def wait_results(self):
+        """
+        It polls the detected folder until every accepted frame has a result or the timeout expires.
+        """
+        if not self.__detected:
+            return
+        pending = {r['filename']: r for r in self.__results if r['accepted']}
+        since = min((r['sent'] for r in pending.values()), default=0) - 1
+        deadline = time.time() + self.__timeout
+        while pending and time.time() < deadline:
+            for filename, mtime in _results(self.__detected, since):
+                record = pending.pop(filename, None)
+                if record is not None:
+                    record['result_latency'] = max(mtime - record['sent'], 0)
+            time.sleep(0.02)
+
+    def report(self, elapsed, options):
+        """ Summary of a run.
+
+            Args:
+                elapsed(float): seconds spent sending
+                options(dict): run options, copied in the report
+
+            Returns:
+                (dict) throughput, latency percentiles, error and shed rates
+        """
+        results = self.__results
+        sent = len(results)
+        accepted = [r for r in results if r['accepted']]
+        errors = [r for r in results if not r['accepted']]
+        report = {
+            'options': options,
+            'sent': sent,
+            'accepted': len(accepted),
+            'errors': len(errors),
+            'error_rate': _ratio(len(errors), sent),
+            'errors_by_status': _count(r['status'] for r in errors),
+            'elapsed': round(elapsed, 3),
+            'upload_throughput': round(len(accepted) / elapsed, 3) if elapsed else None,
+            'upload_latency': _percentiles([r['upload_latency'] for r in accepted])
+        }
+        if self.__detected:
+            done = [r for r in accepted if 'result_latency' in r]
+            last = max((r['sent'] + r['result_latency'] for r in done), default=None)
+            first = min((r['sent'] for r in results), default=None)
+            report.update({
+                'results': len(done),
+                'shed': len(accepted) - len(done),  # accepted but no result within the timeout
+                'shed_rate': _ratio(len(accepted) - len(done), len(accepted)),
+                'result_throughput': round(len(done) / (last - first), 3) if done and last > first else None,
+                'result_latency': _percentiles([r['result_latency'] for r in done])
+            })
+        return report
+
+    def __schedule(self, count, duration, start):
+        i = 0
+        while (not count or i < count) and (not duration or time.monotonic() - start < duration):
+            yield i
+            i += 1
+
+    def __upload(self, i, scheduled=None):
+        """ Upload frame i and record its timings.
+        In open loop, latencies run from the scheduled time, so that waiting for a free worker counts
+        against the service rather than being omitted.
+
+            Args:
+                i(int): upload index
+                scheduled(float): monotonic time the upload was due, None to measure from the send
+        """
+        name, data = self.__frames[i % len(self.__frames)]
+        camera = self.__cameras[i % len(self.__cameras)]
+        stem, extension = os.path.splitext(name)
+        filename = '%s_%06d%s' % (stem, i, extension)
+        session = getattr(self.__session, 'session', None)
+        if session is None:
+            session = self.__session.session = requests.Session()
+        now = time.monotonic()
+        t = now if scheduled is None else scheduled
+        sent = time.time() - (now - t)  # wall clock time the upload was due
+        try:
+            response = session.post(self.__url, files={'upload': (filename, data)}, data={'source': camera},
+                                    timeout=self.__timeout)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        record = {
+            'filename': '%s_%s' % (camera, filename),  # stored name, the Writer prefixes the source
+            'sent': sent,
+            'upload_latency': time.monotonic() - t,
+            'send_delay': now - t,  # waited for a free worker
+            'status': status,
+            'accepted': status == 201
+        }
+        with self.__lock:
+            self.__results.append(record)
+
+
+def _results(folder, since):
+    # (filename, mtime) of the results under folder, walking only the time buckets written since: those created since
+    # and the newest one before, its shards already exist so its mtime no longer changes
+    entries = sorted(os.scandir(folder), key=lambda e: e.name)
+    buckets = [e for e in entries if e.is_dir()]
+    older = [e for e in buckets if e.stat().st_mtime < since]
+    for e in entries:
+        if e.is_file():
+            yield e.name, e.stat().st_mtime
+        elif e.is_dir() and (e.stat().st_mtime >= since or e is older[-1]):
+            for root, _, filenames in os.walk(e.path):
+                for filename in filenames:
+                    yield filename, os.path.getmtime(os.path.join(root, filename))
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, (50, 95, 99))
+    return {'p50': round(p50, 4), 'p95': round(p95, 4), 'p99': round(p99, 4),
+            'mean': round(float(np.mean(values)), 4), 'max': round(max(values), 4)}
+
+
+def _ratio(a, b):
+    return round(a / b, 4) if b else None
+
+
+def _count(values):
+    counts = dict()
+    for x in values:
+        counts[str(x)] = counts.get(str(x), 0) + 1
+    return counts
+
+
+def main(opt):
+    frames = sorted(os.path.join(opt.frames, f) for f in os.listdir(opt.frames) if f.lower().endswith(EXTENSIONS))
+    if not frames:
+        sys.exit('No frames in %s' % opt.frames)
+    if not (opt.requests or opt.duration):
+        sys.exit('Set --requests or --duration')
+    generator = LoadGenerator(opt.url, frames, opt.cameras, opt.detected, opt.timeout)
+    if opt.rate:
+        elapsed = generator.run_rate(opt.rate, opt.requests, opt.duration)
+    else:
+        elapsed = generator.run_concurrency(opt.concurrency, opt.requests, opt.duration)
+    generator.wait_results()
+    report = generator.report(elapsed, vars(opt))
+    print(json.dumps(report, indent=2))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay frames against the upload endpoint')
+    parser.add_argument('--url', type=str, default='http://localhost:8080/api/v1/frame-upload', help='upload endpoint')
+    parser.add_argument('--frames', type=str, required=True, help='directory of frames to replay, cycled')
+    parser.add_argument('--cameras', type=int, default=1, help='simulated cameras, sent as the source field')
+    parser.add_argument('--rate', type=float, default=0.0, help='uploads per second (open loop), 0 for closed loop')
+    parser.add_argument('--concurrency', type=int, default=1, help='uploads in flight (closed loop)')
+    parser.add_argument('--requests', type=int, default=0, help='number of uploads')
+    parser.add_argument('--duration', type=float, default=0.0, help='seconds of load')
+    parser.add_argument('--detected', type=str, default='', help='detected folder, to wait for results')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for an upload or a result')
+    parser.add_argument('--output', type=str, default='', help='JSON report path')
+    main(parser.parse_args())
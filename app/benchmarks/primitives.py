@@ -0,0 +1,238 @@
+"""
+Micro-benchmarks of the hot-path primitives.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Each case times one primitive on synthetic inputs, generated from a fixed seed
+per case, across realistic sizes: 1 to 64 images and 10 to 30k candidate boxes.
+The first run with --baseline records the report; later runs compare against it
+and fail when a case is slower than the baseline by more than the tolerance.
+
+Usage:
+    $ python benchmarks/primitives.py --baseline primitives.json --tolerance 0.2
+    $ python benchmarks/primitives.py --filter nms --threads 1
+"""
+
+import sys
+import json
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+import numpy as np
+import torch
+
+from models.yolo import Detect
+from utils.augmentations import letterbox
+from utils.general import non_max_suppression, non_max_suppression_batched, scale_coords, xywh2xyxy
+from utils.metrics import box_iou
+
+ANCHORS = ((10, 13, 16, 30, 33, 23), (30, 61, 62, 45, 59, 119), (116, 90, 156, 198, 373, 326))  # yolov5s P3-P5
+CHANNELS = (128, 256, 512)
+STRIDES = (8, 16, 32)
+NMS_SIZES = ((1, 10), (1, 1000), (1, 30000), (8, 1000), (64, 100), (64, 1000))  # (images, candidates per image)
+
+
+def _boxes(rng, n, shape=(640, 640)):
+    # n random xywh boxes inside an image of shape (height, width), 8 to 160 pixels wide
+    xy = rng.uniform(0, 1, (n, 2)) * (shape[1], shape[0])
+    wh = rng.uniform(8, 160, (n, 2))
+    return np.concatenate((xy, wh), 1).astype(np.float32)
+
+
+def _prediction(rng, images, candidates, nc=1, conf_thres=0.25):
+    # (images, candidates, 5+nc) raw prediction whose boxes all pass conf_thres, i.e. NMS candidates
+    x = np.empty((images, candidates, 5 + nc), dtype=np.float32)
+    for i in range(images):
+        x[i, :, :4] = _boxes(rng, candidates)
+    x[..., 4:] = rng.uniform(np.sqrt(conf_thres) + 0.01, 1, (images, candidates, 1 + nc))
+    return torch.from_numpy(x)
+
+
+def bench_letterbox(rng, size):
+    im = rng.integers(0, 255, (*size, 3), dtype=np.uint8)
+    return lambda: letterbox(im, 640, auto=False)
+
+
+def bench_xywh2xyxy(rng, n):
+    x = torch.from_numpy(_boxes(rng, n))
+    return lambda: xywh2xyxy(x)
+
+
+def bench_scale_coords(rng, n):
+    # In place: repeated calls drift the boxes into the clipped range, the cost stays the same
+    x = xywh2xyxy(torch.from_numpy(_boxes(rng, n, (480, 640))))
+    return lambda: scale_coords((480, 640), x, (1080, 1920))
+
+
+def bench_box_iou(rng, n):
+    a, b = (xywh2xyxy(torch.from_numpy(_boxes(rng, n))) for _ in range(2))
+    return lambda: box_iou(a, b)
+
+
+def bench_nms(rng, size):
+    images, candidates = size
+    pred = _prediction(rng, images, candidates)
+    return lambda: non_max_suppression(pred, 0.25, max_det=1000)
+
+
+def bench_nms_batched(rng, size):
+    images, candidates = size
+    pred = _prediction(rng, images, candidates)
+    return lambda: non_max_suppression_batched(pred, 0.25, max_det=1000)
+
+
+def _detect(rng, images, conf_thres):
+    # Detect head of a one class yolov5s, on the feature maps of a 480x640 batch
+    m = Detect(nc=1, anchors=ANCHORS, ch=CHANNELS).eval()
+    m.stride = torch.tensor(STRIDES, dtype=torch.float32)
+    m.conf_thres = conf_thres
+    x = [torch.from_numpy(rng.standard_normal((images, c, 480 // s, 640 // s), dtype=np.float32))
+         for c, s in zip(CHANNELS, STRIDES)]
+
+    def forward():
+        with torch.no_grad():
+            return m(list(x))  # forward() replaces the list items
+
+    return forward
+
+
+def bench_detect(rng, images):
+    return _detect(rng, images, None)
+
+
+def bench_detect_prefilter(rng, images):
+    return _detect(rng, images, 0.25)
+
+
+def bench_box_label(rng, n):
+    from utils.plots import Annotator  # plotting dependencies, off the serving path
+
+    im = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    boxes = xywh2xyxy(_boxes(rng, n, im.shape)).tolist()
+
+    def draw():
+        annotator = Annotator(im, line_width=3)
+        for box in boxes:
+            annotator.box_label(box, 'plate 0.87', color=(255, 255, 0))
+
+    return draw
+
+
+# name: (setup(rng, size) returning the timed callable, sizes)
+CASES = {
+    'letterbox': (bench_letterbox, ((480, 640), (1080, 1920), (2160, 3840))),
+    'xywh2xyxy': (bench_xywh2xyxy, (10, 1000, 30000)),
+    'scale_coords': (bench_scale_coords, (10, 1000, 30000)),
+    'box_iou': (bench_box_iou, (10, 300, 3000)),
+    'non_max_suppression': (bench_nms, NMS_SIZES),
+    'non_max_suppression_batched': (bench_nms_batched, NMS_SIZES),
+    'detect_forward': (bench_detect, (1, 8, 64)),
+    'detect_forward_prefilter': (bench_detect_prefilter, (1, 8, 64)),
+    'annotator_box_label': (bench_box_label, (1, 10, 100)),
+}
+
+
+def measure(fn, repeat, min_time):
+    """ Time a callable, timeit style.
+
+        Args:
+            fn(callable): primitive call, without arguments
+            repeat(int): number of timed rounds
+            min_time(float): minimum seconds per round, the loop count is doubled until reached
+
+        Returns:
+            (dict) loops per round, median and best time per call in microseconds
+    """
+    fn()  # warm-up, lazy allocations and caches
+    loops = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if time.perf_counter() - t >= min_time:
+            break
+        loops *= 2
+    rounds = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        rounds.append((time.perf_counter() - t) / loops * 1e6)
+    return {'loops': loops, 'median_us': round(statistics.median(rounds), 3), 'min_us': round(min(rounds), 3)}
+
+
+def run(cases, seed, repeat, min_time):
+    """ Run the benchmark cases.
+
+        Args:
+            cases(dict): name: (setup, sizes), as in CASES
+            seed(int): seed of the synthetic inputs, combined with the case and size index so filtering keeps them
+            repeat(int): number of timed rounds per case
+            min_time(float): minimum seconds per round
+
+        Returns:
+            (dict) case@size: timings
+    """
+    results = dict()
+    for name, (setup, sizes) in cases.items():
+        for j, size in enumerate(sizes):
+            key = '%s@%s' % (name, 'x'.join(map(str, size)) if isinstance(size, tuple) else size)
+            torch.manual_seed(seed)
+            rng = np.random.default_rng([seed, list(CASES).index(name), j])
+            results[key] = measure(setup(rng, size), repeat, min_time)
+            print('%-45s %12.1f us' % (key, results[key]['median_us']), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Cases slower than the baseline.
+
+        Args:
+            results(dict): case@size: timings of this run
+            baseline(dict): case@size: timings of the baseline run
+            tolerance(float): allowed relative slowdown of the median
+
+        Returns:
+            (list) regression messages
+    """
+    errors = []
+    for key, r in results.items():
+        base = baseline.get(key)
+        if base and r['median_us'] > base['median_us'] * (1 + tolerance):
+            errors.append('%s %.1fus regressed over baseline %.1fus (%+.0f%%)' %
+                          (key, r['median_us'], base['median_us'], (r['median_us'] / base['median_us'] - 1) * 100))
+    return errors
+
+
+def main(opt):
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    cases = {k: v for k, v in CASES.items() if not opt.filter or any(f in k for f in opt.filter)}
+    results = run(cases, opt.seed, opt.repeat, opt.min_time)
+    report = {'torch': torch.__version__, 'threads': torch.get_num_threads(), 'seed': opt.seed, 'results': results}
+    errors = []
+    if opt.baseline and Path(opt.baseline).exists():
+        errors = compare(results, json.loads(Path(opt.baseline).read_text())['results'], opt.tolerance)
+    elif opt.baseline:
+        Path(opt.baseline).write_text(json.dumps(report, indent=2))  # first run records the baseline
+    report['errors'] = errors
+    print(json.dumps(report, indent=2))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the hot-path primitives on synthetic inputs')
+    parser.add_argument('--filter', type=str, nargs='*', default=[], help='run the cases whose name contains one of these')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic inputs')
+    parser.add_argument('--repeat', type=int, default=5, help='timed rounds per case, the median is compared')
+    parser.add_argument('--min-time', type=float, default=0.05, help='minimum seconds per round')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for the default')
+    parser.add_argument('--baseline', type=str, default='', help='baseline JSON report, written if missing')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression over baseline')
+    sys.exit(main(parser.parse_args()))
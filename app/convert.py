@@ -0,0 +1,35 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Convert a training checkpoint into a serving artifact
+
+Usage:
+    $ python path/to/convert.py --weights best.pt  # writes best.serve
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from models.experimental import save_serving
+from utils.general import LOGGER, file_size, print_args
+
+
+def run(weights='best.pt', output=''):
+    output = output or str(Path(weights).with_suffix('.serve'))
+    save_serving(weights, output)
+    LOGGER.info(f'Serving artifact saved to {output} ({file_size(weights):.1f} MB -> {file_size(output):.1f} MB)')
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='best.pt', help='training checkpoint path')
+    parser.add_argument('--output', type=str, default='', help='serving artifact path, default weights.serve')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    run(**vars(opt))
@@ -14,87 +14,483 @@ __description__ = 'Reader class'
 
 import os
 import cv2
+import json
 import time
 import torch
+import hashlib
 import logging
+import weakref
 import threading
 import numpy as np
 from PIL import Image
 import torch.backends.cudnn as cudnn
-from models.experimental import attempt_load
-from utils.general import non_max_suppression
+from models.experimental import Ensemble, attempt_load
+from models.yolo import Detect
+from utils.general import (check_img_size, clip_coords, merge_detections, non_max_suppression_batched,
+                           weighted_boxes_fusion)
+from utils.layout import Layout
+from utils.logs import setup_logging
 from utils.params import Parameters
+from utils.regions import candidate_windows, crop_roi, inference_shape, scale_boxes, tile_windows, translate_boxes
+from utils.retention import Retention
+from utils.telemetry import BATCH_SIZE, DROPPED, FRAMES, STAGE_SECONDS
+from utils.torch_utils import time_sync
+from utils.tracing import TRACES, export_spans
+from utils.workqueue import FrameQueue
 
 class Reader:
 
-    def __init__(self, static_files_potential, static_files_detection, model_path, mutex, verbosity, logging_path) -> None:
+    def __init__(self, static_files_potential, static_files_detection, config, verbosity, logging_path, queue=None,
+                 store=None, retention=None, layout=None) -> None:
         self.__static_files_potential = static_files_potential
         self.__static_files_detection = static_files_detection
-        self.__mutex = mutex
+        self.__layout = layout or Layout()  # shards of the potential folder, and of the detected buckets by default
+        self.__queue = queue or FrameQueue(os.path.join(os.path.dirname(static_files_potential), 'frames.db'),
+                                           layout=self.__layout)
+        self.__store = store  # detection store, one row per box; None to keep the images and records only
+        self.__retention = retention or Retention(static_files_detection, layout=self.__layout)  # time buckets
         self.__reader = None
-        self.__params = Parameters(model_path)
-        self.__model, self.__labels = self.__load_yolov5_model()
+        self.__watcher = None
+        self.__config = dict(config)
+        self.__params = Parameters(config)
+        self.__shapes = dict()
+        self.__threads = torch.get_num_threads()  # intra-op threads of the process, shared by parallel ensemble members
+        self.__model, self.__labels, self.__stride, self.__detect, self.__version = self.__load_yolov5_model(self.__params)
+        self.__share_threads(self.__model)
+        self.__warmup(self.__params, self.__model, self.__detect, self.__stride)
+        self.__overlap = self.__tile_overlap(self.__params, self.__stride)
+        self.__pending = None  # parameters, and model state when reloaded, applied before the next batch
+        self.__target = self.__params  # parameters of the latest reload or swap, applied or not
+        self.__file_model = config.get('model_path')  # model_path of the configuration file, at the last reload
+        self.__generation = 0  # latest model load, older background loads are discarded
+        self.__swap_lock = threading.Lock()
         self.__setup_logging(verbosity, logging_path)
 
     def __setup_logging(self, verbosity, path):
-        format = "%(asctime)s %(filename)s:%(lineno)d %(levelname)s - %(message)s"
-        filename=path
-        datefmt = "%d/%m/%Y %H:%M:%S"
-        level = logging.INFO
-        if (verbosity):
-            level = logging.DEBUG
-        logging.basicConfig(filename=filename, filemode='a', format=format, level=level, datefmt=datefmt)
+        setup_logging(path, verbosity)  # no-op when already configured from the logging section
 
     
     def setup(self):
         if not os.path.exists(self.__static_files_detection):
             os.makedirs(self.__static_files_detection)
+        if not os.path.exists(self.__static_files_potential):
+            os.makedirs(self.__static_files_potential)
+        recovered = self.__queue.recover(self.__static_files_potential)  # resume where the last run left off
+        logging.info('Frame queue: %s, %d frames found in the folder' % (self.__queue.counts(), recovered))
 
         self.__reader = threading.Thread(
             target = self.__reader_job, 
-            args = ()
+            args = (),
+            name = 'reader'
         )
+        self.__watcher = threading.Thread(
+            target = self.__watcher_job,
+            args = (),
+            daemon = True,
+            name = 'model-watch'
+        )
+
+    def reload(self, config):
+        """ Validate a new detection configuration and apply it between two batches.
+        Hot-reloadable changes apply from the next batch, the others load and warm up the model
+        in the background while the current one keeps serving. A model set by swap_model() is kept
+        unless model_path changed in the file, and a load in flight is only superseded by another load.
+
+            Args:
+                config(dict): detection section of the configuration file
+
+            Returns:
+                (set) changed parameters
+
+            Raises:
+                ValueError: the configuration is not valid, the current one is kept
+        """
+        with self.__swap_lock:
+            file_model = config.get('model_path')
+            if file_model == self.__file_model:  # unchanged in the file, keep the model swap_model() loaded
+                config = dict(config, model_path=self.__config['model_path'])
+            params = Parameters(config)
+            changed = self.__target.changes(params)
+            reload = self.__target.needs_reload(params)
+            self.__config, self.__file_model, self.__target = dict(config), file_model, params
+            if reload:  # supersedes the loads in flight
+                self.__generation += 1
+                generation = self.__generation
+                self.__pending = None
+            elif changed:  # applied with the model of a load done meanwhile, if any
+                self.__pending = (params, self.__pending and self.__pending[1])
+        if reload:
+            threading.Thread(target=self.__swap, args=(params, generation), daemon=True).start()
+        logging.info('Detection parameters reloaded, changed: %s' % ', '.join(sorted(changed)))
+        return changed
+
+    def swap_model(self, model_path=None):
+        """ Load a model in the background and switch to it between two batches, in-flight frames are kept.
+        The new model is warmed up on the configured shapes first; the current one serves meanwhile
+        and is released once the last batch referencing it is done.
+
+            Args:
+                model_path(str or list): checkpoint, serving artifact or ensemble, files of model_dir only since
+                    loading a checkpoint unpickles it; None reloads the current path
+
+            Returns:
+                (str or list) model path being loaded
+
+            Raises:
+                ValueError: a model file does not exist or is outside model_dir
+        """
+        config = dict(self.__config, model_path=model_path or self.__config['model_path'])
+        params = Parameters(config)
+        model_dir = os.path.realpath(params.model_dir)
+        for path in params.model if isinstance(params.model, list) else [params.model]:
+            if model_path and os.path.commonpath([model_dir, os.path.realpath(path)]) != model_dir:
+                raise ValueError('model %s is not in %s' % (path, params.model_dir))
+            if not os.path.isfile(path):
+                raise ValueError('model %s not found' % path)
+        with self.__swap_lock:
+            self.__config, self.__target = config, params
+            self.__generation += 1
+            generation = self.__generation
+            self.__pending = None
+        threading.Thread(target=self.__swap, args=(params, generation), daemon=True).start()
+        logging.info('Loading model %s' % params.model)
+        return params.model
+
+    def model_version(self):
+        """
+        It returns the version tag of the model serving the current batches.
+        """
+        return self.__version
+
+    def __swap(self, params, generation):
+        """ Load and warm up a model for new parameters, then queue it for the reader thread.
+
+            Args:
+                params(Parameters): new parameters
+                generation(int): reload that requested the model
+        """
+        try:
+            state = self.__load_yolov5_model(params)
+            model, _, stride, detect, _ = state
+            self.__warmup(params, model, detect, stride)
+        except Exception as e:
+            logging.error('Model reload failed, keeping the current one: %s' % e)
+            return
+        with self.__swap_lock:
+            if generation == self.__generation:  # not superseded by a later load, hot changes since then included
+                self.__pending = (self.__target, state)
+
+    def __apply_pending(self):
+        """
+        It switches to the parameters and model of the latest reload, called between two batches.
+        """
+        with self.__swap_lock:
+            pending, self.__pending = self.__pending, None
+        if pending is None:
+            return
+        params, state = pending
+        if state is not None:
+            weakref.finalize(self.__model, logging.info, 'Model %s released' % self.__version)
+            self.__model, self.__labels, self.__stride, self.__detect, self.__version = state
+            self.__share_threads(self.__model)
+            self.__shapes = dict()
+            if params.device.type != 'cpu':
+                torch.cuda.empty_cache()
+            logging.info('Model %s switched in' % self.__version)
+        self.__params = params
+        self.__overlap = self.__tile_overlap(params, self.__stride)
+
+    def __share_threads(self, model):
+        """
+        It splits the intra-op threads among the members of a parallel ensemble, all of them for any other model.
+        Called as a model is switched in, never while a batch runs: the setting is process-wide.
+        """
+        members = len(model) if isinstance(model, Ensemble) and model.parallel and len(model) > 1 else 1
+        torch.set_num_threads(max(self.__threads // members, 1))
+
+    def __tile_overlap(self, params, stride):
+        """
+        It returns tile_overlap rounded up to a multiple of the model stride, warning once per reload when rounded,
+        and at most one stride less than the tile, so that tiles always advance.
+        """
+        overlap = check_img_size(params.tile_overlap, s=stride)
+        limit = max(min(params.tile_shape[:2]) - stride, 0)
+        if overlap > limit:
+            logging.warning('tile_overlap %d is not smaller than the tile at stride %d, using %d'
+                            % (overlap, stride, limit))
+        return min(overlap, limit)
+
+    def __watcher_job(self):
+        """
+        It polls the model files and swaps the model in once a changed file has been stable for one interval.
+        """
+        watched, last, changed = None, None, None
+        while True:
+            time.sleep(self.__params.model_watch_interval)
+            if not self.__params.model_watch or watched != self.__params.model:  # disabled or another model
+                watched, last, changed = self.__params.model, self.__model_stat(self.__params.model), None
+                continue
+            current = self.__model_stat(watched)
+            if current != last and current == changed:  # unchanged since the last poll, fully written
+                try:
+                    self.swap_model()
+                except ValueError as e:
+                    logging.error('Model watch: %s' % e)
+                last = current
+            changed = current
+
+    def __model_stat(self, model_path):
+        """ Modification time and size of the model files.
+
+            Args:
+                model_path(str or list): checkpoint, serving artifact or ensemble
+
+            Returns:
+                (tuple) (mtime, size) per file, None for missing files
+        """
+        paths = model_path if isinstance(model_path, list) else [model_path]
+        return tuple((os.stat(p).st_mtime_ns, os.stat(p).st_size) if os.path.isfile(p) else None for p in paths)
 
     def __reader_job(self):
+        scanned = time.monotonic()
         while True:
-            if not self.__potential_folder_is_empty():
-                self.__mutex.acquire()
-                oldest_frame_path = self.__oldest()
+            try:
+                self.__apply_pending()
+                claimed = self.__queue.claim(self.__params.batch_size, self.__params.queue_lease,
+                                             self.__params.queue_max_attempts)
+                if not claimed:
+                    if time.monotonic() - scanned > self.__params.queue_scan_interval:  # frames copied into the folder
+                        self.__queue.scan(self.__static_files_potential)
+                        scanned = time.monotonic()
+                    time.sleep(0.1)
+                    continue
+                try:
+                    self.__batch(claimed)
+                except Exception:
+                    logging.exception('Batch of %d frames failed' % len(claimed))
+                    failed = claimed if len(claimed) == 1 else self.__one_by_one(claimed)
+                    self.__queue.fail([i for i, _, _ in failed], 'inference failed')
+                    DROPPED.inc('error', amount=len(failed))
+            except Exception:  # i.e. the queue database, the loop keeps running
+                logging.exception('Reader loop failed')
+                time.sleep(1.0)
+
+    def __one_by_one(self, claimed):
+        """ Infer the frames of a failed batch one at a time, to fail only the frames that make it fail.
 
-                frame =  self.__get_frame(oldest_frame_path)
+            Args:
+                claimed(list): (id, filename, enqueue unix time) of the claimed frames
 
-                detected, _ = self.__detection(frame, self.__model, self.__labels)
-                os.remove(oldest_frame_path)
+            Returns:
+                (list) the claimed frames that failed alone
+        """
+        failed = []
+        for frame in claimed:
+            try:
+                self.__batch([frame])
+            except Exception:
+                logging.exception('Frame %s failed' % frame[1])
+                failed.append(frame)
+        return failed
+
+    def __batch(self, claimed):
+        """ Infer claimed frames together and write their results.
+        Exceptions before any result is written are raised; a frame whose result cannot be written fails alone.
 
-                self.__mutex.release()
+            Args:
+                claimed(list): (id, filename, enqueue unix time) of the claimed frames
+        """
+        ids = [i for i, _, _ in claimed]
+        oldest_frame_paths = [self.__layout.path(self.__static_files_potential, filename)
+                              for _, filename, _ in claimed]
+        traces = [self.__dequeue(path, enqueued) for (_, _, enqueued), path in zip(claimed, oldest_frame_paths)]
+
+        t = time.perf_counter()
+        frames = [self.__get_frame(path) for path in oldest_frame_paths]
+        STAGE_SECONDS.observe(time.perf_counter() - t, 'decode')
+        unreadable = [(i, path) for i, path, frame in zip(ids, oldest_frame_paths, frames) if frame is None]
+        for _, path in unreadable:
+            logging.error('Dropped unreadable frame %s' % path)
+            DROPPED.inc('unreadable')
+        self.__queue.fail([i for i, _ in unreadable], 'unreadable', [path for _, path in unreadable])
+        times = [enqueued for _, _, enqueued in claimed]
+        ids, times, oldest_frame_paths, traces, frames = self.__readable(frames, ids, times, oldest_frame_paths, traces)
+        rois = [self.__params.rois.get(self.__source(path)) for path in oldest_frame_paths]
+
+        start = time.monotonic()
+        detections = self.__detection(frames, self.__labels, rois) if frames else []
+        end = time.monotonic()
+
+        written = []
+        for i, path, timestamp, trace, (detected, label, det) in zip(ids, oldest_frame_paths, times, traces, detections):
+            try:
+                self.__write(path, timestamp, trace, detected, label, det, start, end)
+                written.append((i, path))
+            except Exception:
+                logging.exception('Result of frame %s not written' % path)
+                self.__queue.fail([i], 'result not written')
+                DROPPED.inc('error')
+
+        # results are written, only now the frames leave the queue and the folder
+        self.__queue.complete([i for i, _ in written], [path for _, path in written])
+
+        if self.__params.trace_export and traces:
+            attributes = [{'frame': os.path.basename(path), 'model': self.__version} for path in oldest_frame_paths]
+            try:
+                export_spans(self.__params.trace_export, traces, attributes)
+            except OSError as e:
+                logging.error('Trace export failed: %s' % e)
+        if frames:
+            BATCH_SIZE.observe(len(frames))
+            FRAMES.inc(amount=len(frames))
+
+    def __write(self, path, timestamp, trace, detected, label, det, start, end):
+        """ Write the annotated image, the record and the store rows of a frame.
 
-                image = Image.fromarray(detected)
-                filename = os.path.basename(oldest_frame_path)
-                absolute_path = '%s/%s' % (self.__static_files_detection, filename)
-                image.save(absolute_path)
-                time.sleep(0.1)       
+            Args:
+                path(str): path of the frame in the potential folder
+                timestamp(float): unix time the frame was enqueued
+                trace(Trace): trace of the frame
+                detected(np.ndarray): annotated frame
+                label(str): label of the last detected object
+                det(torch.Tensor): (n, 6) detections [xyxy, conf, cls] in frame coordinates
+                start(float): monotonic time the inference started
+                end(float): monotonic time the inference ended
+        """
+        t = time.perf_counter()
+        trace.mark('inference_start', start)
+        trace.mark('inference_end', end)
+        image = Image.fromarray(detected)
+        filename = os.path.basename(path)
+        absolute_path = self.__retention.path(filename, timestamp)
+        image.save(absolute_path)
+        trace.mark('result_write')
+        logging.debug('Frame %s: %d detections', filename, len(det), extra={'sample': 100, 'trace': trace.id})
+        if self.__params.records:
+            self.__record(path, absolute_path, label, det, self.__labels, trace)
+        if self.__store is not None:
+            self.__store.add(self.__source(path), timestamp, det, self.__labels, absolute_path, self.__version)
+        STAGE_SECONDS.observe(time.perf_counter() - t, 'encode')
+        STAGE_SECONDS.observe(trace.events['result_write'] - trace.events.get('receive', trace.events['enqueue']), 'end_to_end')
+
+    def __readable(self, frames, *lists):
+        """
+        It keeps the frames that could be decoded, with the matching items of each list.
+        """
+        keep = [i for i, frame in enumerate(frames) if frame is not None]
+        return [[items[i] for i in keep] for items in lists] + [[frames[i] for i in keep]]
 
-    def __potential_folder_is_empty(self):
-        path = self.__static_files_potential
-        return True if not len(os.listdir(path)) else False
+    def __dequeue(self, path, enqueued):
+        """ Trace of a frame claimed from the queue.
+        Frames not uploaded through the Writer get a new trace, enqueued at their queue time.
 
-    def __oldest(self):
-        path = self.__static_files_potential
-        files = os.listdir(path)
-        paths = [os.path.join(path, basename) for basename in files]
-        return min(paths, key=os.path.getctime)
+            Args:
+                path(str): path of the frame in the potential folder
+                enqueued(float): unix time the frame was enqueued
 
-    def __load_yolov5_model(self):
+            Returns:
+                (Trace) trace with the dequeue event marked
         """
-        It loads the model and returns the model and the names of the classes.
-        :return: model, names
+        trace = TRACES.pop(os.path.basename(path))
+        trace.mark('dequeue')
+        if 'enqueue' not in trace.events:
+            trace.mark('enqueue', trace.events['dequeue'] - max(time.time() - enqueued, 0))
+        return trace
+
+    def __record(self, path, image_path, label, det, names, trace):
+        """ Write the result record of a frame next to its annotated image.
+
+            Args:
+                path(str): path of the frame in the potential folder
+                image_path(str): path of the annotated image, in its bucket of the detected folder
+                label(str): label of the last detected object
+                det(torch.Tensor): (n, 6) detections [xyxy, conf, cls] in frame coordinates
+                names(list): class names
+                trace(Trace): trace of the frame
         """
-        model = attempt_load(self.__params.model, map_location=self.__params.device)
-        print("device",self.__params.device)
+        filename = os.path.basename(path)
+        record = {
+            'frame': filename,
+            'source': self.__source(path),
+            'label': label,
+            'model': self.__version,
+            'mode': self.__params.mode,
+            'detections': [{'box': [round(x, 1) for x in xyxy], 'conf': round(conf, 4), 'class': names[int(cls)]}
+                           for *xyxy, conf, cls in det.tolist()],
+            'trace': trace.to_record()
+        }
+        absolute_path = '%s.json' % os.path.splitext(image_path)[0]
+        with open(absolute_path, 'w') as f:
+            json.dump(record, f)
+
+    def __source(self, path):
+        """ Camera that produced a frame, i.e. the filename prefix before the first underscore.
+
+            Args:
+                path(str): relative or absolute path of the frame
+
+            Returns:
+                (str) source name, the whole basename when there is no prefix
+        """
+        return os.path.basename(path).split('_', 1)[0]
+
+    def __load_yolov5_model(self, params):
+        """
+        It loads the model and returns the model, the names of the classes, the max stride and its Detect layers.
+        :param params: the parameters the model is loaded for
+        :return: model, names, stride, detect
+        """
+        model = attempt_load(params.model, map_location=params.device)
+        logging.info('Model %s loaded on %s' % (params.model, params.device))
         stride = int(model.stride.max())  # model stride
         names = model.module.names if hasattr(model, 'module') else model.names  # get class names
+        detect = [m for m in model.modules() if isinstance(m, Detect)]
+        if isinstance(model, Ensemble):
+            model.parallel = params.ensemble_parallel
+            model.fusion = params.ensemble_fusion
+
+        return model, names, stride, detect, self.__model_version(params.model)
 
-        return model, names
+    def __model_version(self, model_path):
+        """ Version tag of a model, the file name and a digest of its content for each file.
+
+            Args:
+                model_path(str or list): checkpoint, serving artifact or ensemble
+
+            Returns:
+                (str) version tag, i.e. best.pt@1a2b3c4d, ensemble members joined by +
+        """
+        tags = []
+        for path in model_path if isinstance(model_path, list) else [model_path]:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            tags.append('%s@%s' % (os.path.basename(path), digest.hexdigest()[:8]))
+        return '+'.join(tags)
+
+    def __warmup(self, params, model, detect, stride):
+        """
+        It pre-computes the Detect grids of every configured inference shape and, on GPU, runs the model on each
+        of them at batch 1 and batch_size, so that cudnn autotunes before the first batch rather than during it.
+        It raises ValueError when a configured shape is not a multiple of the model stride.
+        """
+        cudnn.benchmark = True  # set True to speed up constant image size inference
+
+        shapes = [params.pred_shape[:2], params.coarse_shape[:2], params.fine_shape[:2], params.tile_shape[:2]]
+        for key, shape in zip(('pred_shape', 'coarse_shape', 'fine_shape', 'tile_shape'), shapes):
+            if any(x % stride for x in shape):  # models with P6 outputs have a larger stride
+                raise ValueError('%s must be a multiple of the model stride %d, got %r' % (key, stride, list(shape)))
+        for m in detect:
+            m.grid_cache_size = params.grid_cache_size
+            m.cache_grids(shapes)
+
+        if params.device.type != 'cpu':
+            dtype = next(model.parameters())
+            with torch.no_grad():
+                for h, w in dict.fromkeys(tuple(shape) for shape in shapes):  # distinct, in order
+                    for n in sorted({1, params.batch_size}):
+                        model(torch.zeros(n, 3, h, w).to(params.device).type_as(dtype), augment=params.augment)
 
     def __get_frame(self, filename):
         """ Read image from file using opencv.
@@ -107,107 +503,218 @@ class Reader:
         """
         return cv2.imread(filename)
 
-    def __detection(self, frame, model, names):
-        """
-        It takes an image, runs it through the model, and returns the image with bounding boxes drawn around
-        the detected objects
-        
-        :param frame: The frame of video or webcam feed on which we're running inference
-        :param model: The model to use for detection
-        :param names: a list of class names
-        :return: the image with the bounding boxes and the label of the detected object.
-        """
-        out = frame.copy()
+    def __inference_shape(self, shape, max_shape, stretch=False):
+        """ Stride-aligned inference shape, cached per crop shape.
+        Full frames are stretched to max_shape, crops get the smallest shape that fits it.
 
-        frame = cv2.resize(frame, (self.__params.pred_shape[1], self.__params.pred_shape[0]), interpolation=cv2.INTER_LINEAR)
-        frame = np.transpose(frame, (2, 1, 0))
+            Args:
+                shape(tuple): crop shape (height, width, channels)
+                max_shape(tuple): configured inference shape (height, width, ...)
+                stretch(bool): resize to max_shape regardless of the aspect ratio
 
+            Returns:
+                (tuple) inference (height, width)
+        """
+        if stretch:
+            return tuple(max_shape[:2])
+        key = shape[:2], tuple(max_shape[:2])
+        if key not in self.__shapes:
+            self.__shapes[key] = tuple(inference_shape(shape, max_shape, self.__stride))
+        return self.__shapes[key]
 
-        cudnn.benchmark = True  # set True to speed up constant image size inference
+    def __inference(self, images, shapes, conf_thres):
+        """ Batched inference, one forward per distinct inference shape.
 
-        if self.__params.device.type != 'cpu':
-            model(torch.zeros(1, 3, self.__params.imgsz, self.__params.imgsz).to(self.__params.device).type_as(next(model.parameters())))  # run once
+            Args:
+                images(list): HWC images, of any size
+                shapes(list): inference (height, width) of each image
+                conf_thres(float): NMS confidence threshold
 
-        frame = torch.from_numpy(frame).to(self.__params.device)
-        frame = frame.float()
-        frame /= 255.0
-        if frame.ndimension() == 3:
-            frame = frame.unsqueeze(0)
+            Returns:
+                (list) (n, 6) detections per image [xyxy, conf, cls], in image coordinates
+        """
+        groups = dict()
+        for i, shape in enumerate(shapes):
+            groups.setdefault(tuple(shape), []).append(i)
+
+        detections = [None] * len(images)
+        for shape, index in groups.items():
+            t0 = time_sync()
+            batch = np.stack([cv2.resize(images[i], (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR) for i in index])
+            batch = np.ascontiguousarray(batch.transpose((0, 3, 1, 2)))  # BHWC to BCHW
+
+            batch = torch.from_numpy(batch).to(self.__params.device)
+            batch = batch.float()
+            batch /= 255.0
+
+            for m in self.__detect:  # decode only the anchors above threshold, not supported by augmented inference
+                m.conf_thres = conf_thres if self.__params.prefilter and not self.__params.augment else None
+
+            t1 = time_sync()
+            pred = self.__model(batch, augment=self.__params.augment)[0]
+            t2 = time_sync()
+            if isinstance(pred, list):  # ensemble members, fused after NMS
+                pred = [non_max_suppression_batched(p, conf_thres, max_det=self.__params.max_det, bs=len(index)) for p in pred]
+                pred = weighted_boxes_fusion(pred, self.__params.wbf_iou_thres, self.__params.ensemble_weights, self.__params.max_det)
+            else:
+                pred = non_max_suppression_batched(pred, conf_thres, max_det=self.__params.max_det, bs=len(index))
+            for i, det in zip(index, pred):
+                detections[i] = scale_boxes(det, shape, images[i].shape)  # inference to image space
+            t3 = time_sync()
+            STAGE_SECONDS.observe(t1 - t0, 'preprocess')
+            STAGE_SECONDS.observe(t2 - t1, 'forward')
+            STAGE_SECONDS.observe(t3 - t2, 'nms')
+        return detections
+
+    def __full(self, frames, rois):
+        """ Single pass on each frame, or on its region of interest, at pred_shape.
 
-        frame = torch.transpose(frame, 2, 3)
+            Args:
+                frames(list): HWC frames
+                rois(list): region of interest of each frame, None for the full frame
 
+            Returns:
+                (list) (n, 6) detections per frame, in frame coordinates
+        """
+        crops = [crop_roi(frame, roi) if roi is not None else (frame, (0, 0)) for frame, roi in zip(frames, rois)]
+        shapes = [self.__inference_shape(crop.shape, self.__params.pred_shape, roi is None) for (crop, _), roi in zip(crops, rois)]
+        detections = self.__inference([crop for crop, _ in crops], shapes, self.__params.conf_thres)
+        return [translate_boxes(det, offset) for det, (_, offset) in zip(detections, crops)]
 
-        pred = model(frame, augment=False)[0]
-        pred = non_max_suppression(pred, self.__params.conf_thres, max_det=self.__params.max_det)
+    def __cascade(self, frames, rois):
+        """ Coarse-to-fine detection for small and distant plates.
+        A low resolution pass over the whole batch finds candidates, then a second batched pass
+        runs on upscaled windows around them, cut from the full resolution frames.
 
-        label=""
-        # detections per image
-        for i, det in enumerate(pred):
+            Args:
+                frames(list): HWC frames
+                rois(list): region of interest of each frame, None for the full frame
 
-            img_shape = frame.shape[2:]
-            out_shape = out.shape
+            Returns:
+                (list) (n, 6) detections per frame, in frame coordinates
+        """
+        crops = [crop_roi(frame, roi) if roi is not None else (frame, (0, 0)) for frame, roi in zip(frames, rois)]
+        shapes = [self.__inference_shape(crop.shape, self.__params.coarse_shape, roi is None) for (crop, _), roi in zip(crops, rois)]
+        candidates = self.__inference([crop for crop, _ in crops], shapes, self.__params.coarse_conf_thres)
+
+        windows, owners = [], []
+        for i, (det, (_, offset)) in enumerate(zip(candidates, crops)):
+            det = translate_boxes(det[:self.__params.max_candidates], offset)
+            for window in candidate_windows(det, frames[i].shape, self.__params.fine_min_side, self.__params.fine_context):
+                windows.append(window)
+                owners.append(i)
+
+        images = [frames[i][y1:y2, x1:x2] for i, (x1, y1, x2, y2) in zip(owners, windows)]
+        fine_shape = self.__params.fine_shape[:2]
+        detections = self.__inference(images, [fine_shape] * len(images), self.__params.conf_thres)
+        return self.__merge(len(frames), owners, windows, detections)
+
+    def __tiled(self, frames, rois):
+        """ Native resolution detection on overlapping stride-aligned tiles.
+        Tiles of the whole batch are inferred together, then duplicates at the seams are merged.
 
-            s_ = f'{i}: '
-            s_ += '%gx%g ' % img_shape  # print string
+            Args:
+                frames(list): HWC frames
+                rois(list): region of interest of each frame, None for the full frame
 
-            if len(det):
+            Returns:
+                (list) (n, 6) detections per frame, in frame coordinates
+        """
+        crops = [crop_roi(frame, roi) if roi is not None else (frame, (0, 0)) for frame, roi in zip(frames, rois)]
+        tile_shape = self.__params.tile_shape[:2]
+        overlap = self.__overlap
 
-                gain = min(img_shape[0] / out_shape[0], img_shape[1] / out_shape[1])  # gain  = old / new
+        images, windows, owners = [], [], []
+        for i, (crop, (ox, oy)) in enumerate(crops):
+            for x1, y1, x2, y2 in tile_windows(crop.shape, tile_shape, overlap):
+                images.append(crop[y1:y2, x1:x2])
+                windows.append((x1 + ox, y1 + oy, x2 + ox, y2 + oy))
+                owners.append(i)
 
-                coords = det[:, :4]
+        shapes = [self.__inference_shape(image.shape, tile_shape) for image in images]
+        detections = self.__inference(images, shapes, self.__params.conf_thres)
+        return self.__merge(len(frames), owners, windows, detections)
 
+    def __merge(self, n, owners, windows, detections):
+        """ Detections of frame windows back in frame coordinates, one class-aware NMS pass per frame.
 
-                pad = (img_shape[1] - out_shape[1] * gain) / 2, (
-                        img_shape[0] - out_shape[0] * gain) / 2  # wh padding
+            Args:
+                n(int): number of frames
+                owners(list): frame index of each window
+                windows(list): x1, y1, x2, y2 bounds of each window in its frame
+                detections(list): (n, 6) detections per window, in window coordinates
 
-                coords[:, [0, 2]] -= pad[0]  # x padding
-                coords[:, [1, 3]] -= pad[1]  # y padding
-                coords[:, :4] /= gain
+            Returns:
+                (list) (n, 6) detections per frame, in frame coordinates
+        """
+        merged = [[] for _ in range(n)]
+        for i, (x1, y1, _, _), det in zip(owners, windows, detections):
+            merged[i].append(translate_boxes(det, (x1, y1)))
+        return [merge_detections(torch.cat(det, 0), max_det=self.__params.max_det) if det
+                else torch.zeros((0, 6), device=self.__params.device) for det in merged]
 
-                coords[:, 0].clamp_(0, out_shape[1])  # x1
-                coords[:, 1].clamp_(0, out_shape[0])  # y1
-                coords[:, 2].clamp_(0, out_shape[1])  # x2
-                coords[:, 3].clamp_(0, out_shape[0])  # y2
+    def __detection(self, frames, names, rois):
+        """
+        It takes a batch of images, runs it through the model, and returns the images with bounding boxes
+        drawn around the detected objects
+        
+        :param frames: The frames of video or webcam feed on which we're running inference
+        :param names: a list of class names
+        :param rois: region of interest of each frame source, rectangle or polygon; None infers the whole frame
+        :return: the images with the bounding boxes, the label of the detected object and the detections.
+        """
+        if self.__params.mode == 'cascade':
+            pred = self.__cascade(frames, rois)
+        elif self.__params.mode == 'tiled':
+            pred = self.__tiled(frames, rois)
+        else:
+            pred = self.__full(frames, rois)
+
+        t = time.perf_counter()
+        results = [self.__annotate(frame, det, names) + (det,) for frame, det in zip(frames, pred)]
+        STAGE_SECONDS.observe(time.perf_counter() - t, 'annotate')
+        return results
+
+    def __annotate(self, frame, det, names):
+        """
+        It draws the detections on a copy of the frame.
 
-                det[:, :4] = coords.round()
+        :param frame: the frame the detections refer to
+        :param det: (n, 6) detections [xyxy, conf, cls] in frame coordinates
+        :param names: a list of class names
+        :return: the image with the bounding boxes and the label of the last detected object.
+        """
+        out = frame.copy()
 
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s_ += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+        label=""
+        out_shape = out.shape
 
-                for *xyxy, conf, cls in reversed(det):
+        if len(det):
 
-                    x1 = int(xyxy[0].item())
-                    y1 = int(xyxy[1].item())
-                    x2 = int(xyxy[2].item())
-                    y2 = int(xyxy[3].item())
+            clip_coords(det, out_shape)
+            det[:, :4] = det[:, :4].round()
 
-                    confidence_score = conf
-                    class_index = cls
-                    object_name = names[int(cls)]
-                    
-                    detected_plate = frame[:,:,y1:y2, x1:x2].squeeze().permute(1, 2, 0).cpu().numpy()
-                    # cv2.imshow("Crooped Plate ",detected_plate)
+            for *xyxy, conf, cls in reversed(det):
 
-                    #rect_size= (detected_plate.shape[0]*detected_plate.shape[1])
-                    c = int(cls)  # integer class
-                    label = names[c] if self.__params.hide_conf else f'{names[c]} {conf:.2f}'
+                c = int(cls)  # integer class
+                label = names[c] if self.__params.hide_conf else f'{names[c]} {conf:.2f}'
 
-                    tl = self.__params.rect_thickness
+                tl = self.__params.rect_thickness
 
-                    c1, c2 = (int(xyxy[0]), int(xyxy[1])), (int(xyxy[2]), int(xyxy[3]))
-                    cv2.rectangle(out, c1, c2, self.__params.color, thickness=tl, lineType=cv2.LINE_AA)
+                c1, c2 = (int(xyxy[0]), int(xyxy[1])), (int(xyxy[2]), int(xyxy[3]))
+                cv2.rectangle(out, c1, c2, self.__params.color, thickness=tl, lineType=cv2.LINE_AA)
 
-                    if label:
-                        tf = max(tl - 1, 1)  # font thickness
-                        t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
-                        c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
-                        cv2.rectangle(out, c1, c2, self.__params.color, -1, cv2.LINE_AA)  # filled
-                        cv2.putText(out, label, (c1[0], c1[1] - 2), 0, tl / 3, [225, 255, 255], thickness=tf,
-                                    lineType=cv2.LINE_AA)
+                if label:
+                    tf = max(tl - 1, 1)  # font thickness
+                    t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
+                    c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
+                    cv2.rectangle(out, c1, c2, self.__params.color, -1, cv2.LINE_AA)  # filled
+                    cv2.putText(out, label, (c1[0], c1[1] - 2), 0, tl / 3, [225, 255, 255], thickness=tf,
+                                lineType=cv2.LINE_AA)
 
         return out, label
 
     
     def start(self):
         self.__reader.start()
+        self.__watcher.start()
@@ -13,11 +13,22 @@ __credits__ = ''
 __description__ = 'Writer class'
 
 import os
+import hmac
+import contextlib
 import logging
+import mimetypes
 import threading
 from flask_api import status
 from flask import Flask, request, make_response
 from werkzeug.utils import secure_filename
+from utils.layout import Layout
+from utils.logs import setup_logging
+from utils.sampler import SAMPLER
+from utils.telemetry import DETECTED_BYTES, DROPPED, QUEUE_DEPTH, UPLOAD_BYTES, UPLOADS, render
+from utils.tracing import TRACES, Trace, parse_trace_id
+from utils.workqueue import staging
+
+LOOPBACK = frozenset(('127.0.0.1', '::1', '::ffff:127.0.0.1'))
 
 class Writer:
     """
@@ -28,23 +39,25 @@ class Writer:
         'jpeg'
     }
 
-    def __init__(self, host, port, static_files, mutex, verbosity, logging_path) -> None:
+    def __init__(self, host, port, static_files, verbosity, logging_path, reload=None, swap=None, version=None,
+                 queue=None, store=None, retention=None, layout=None, admin_token=None) -> None:
         self.__host = host
         self.__port = port
         self.__static_files = static_files
-        self.__mutex = mutex
         self.__writer = None
+        self.__reload = reload  # re-reads the detection configuration, returns the changed parameters
+        self.__swap = swap  # loads a model in the background, returns its path
+        self.__version = version  # version tag of the serving model
+        self.__queue = queue  # durable frame queue the Reader claims from, else the Reader scans the folder
+        self.__store = store  # detection store, queried by plate, source and time
+        self.__retention = retention  # time buckets and segments of the detected folder, serves the results
+        self.__layout = layout or Layout()  # shards of the potential folder
+        self.__admin_token = admin_token  # bearer token of the admin routes, None to serve them to localhost only
         self.__verbosity = verbosity
         self.__setup_logging(verbosity, logging_path)
 
     def __setup_logging(self, verbosity, path):
-        format = "%(asctime)s %(filename)s:%(lineno)d %(levelname)s - %(message)s"
-        filename=path
-        datefmt = "%d/%m/%Y %H:%M:%S"
-        level = logging.INFO
-        if (verbosity):
-            level = logging.DEBUG
-        logging.basicConfig(filename=filename, filemode='a', format=format, level=level, datefmt=datefmt)
+        setup_logging(path, verbosity)  # no-op when already configured from the logging section
 
 
     def setup(self):
@@ -53,30 +66,152 @@ class Writer:
 
         self.__writer = threading.Thread(
             target = self.__writer_job, 
-            args = (self.__host, self.__port, self.__verbosity)
+            args = (self.__host, self.__port, self.__verbosity),
+            name = 'writer'
         )
 
     def __writer_job(self, host, port, verbosity):
         app = Flask(__name__)
 
         app.add_url_rule('/api/v1/frame-upload', 'frame-upload', self.__frame_upload, methods=['POST'])
-        print(host, port)
+        app.add_url_rule('/metrics', 'metrics', self.__metrics, methods=['GET'])
+        app.add_url_rule('/api/v1/admin/profile', 'admin-profile', self.__admin(self.__admin_profile),
+                         methods=['GET', 'POST'])
+        QUEUE_DEPTH.set_function(self.__queue.depth if self.__queue else self.__frames_in_folder)
+        if self.__retention:
+            app.add_url_rule('/api/v1/detected/<path:name>', 'detected', self.__detected, methods=['GET'])
+            DETECTED_BYTES.set_function(self.__retention.size)
+        if self.__store:
+            app.add_url_rule('/api/v1/detections', 'detections', self.__detections, methods=['GET'])
+        if self.__reload:
+            app.add_url_rule('/api/v1/admin/reload', 'admin-reload', self.__admin(self.__admin_reload), methods=['POST'])
+        if self.__swap:
+            app.add_url_rule('/api/v1/admin/model', 'admin-model', self.__admin(self.__admin_model),
+                             methods=['GET', 'POST'])
+        logging.info('Listening on %s:%s' % (host, port))
         app.run(host=host, port=port, debug=verbosity, threaded=True, use_reloader=False)
 
 
     def __frame_upload(self):
+        trace = Trace(parse_trace_id(request.headers))
+        trace.mark('receive')
         if request.method == 'POST':
             if 'upload' not in request.files:
-                response = make_response("File not found", status.HTTP_400_BAD_REQUEST)
+                DROPPED.inc('no_file')
+                return make_response("File not found", status.HTTP_400_BAD_REQUEST)
             file = request.files['upload']
-            if file and self.__allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                absolute_path = '%s/%s' % (self.__static_files, filename)
-                self.__mutex.acquire()
-                file.save(absolute_path)
-                self.__mutex.release()
-                response = make_response("File is stored", status.HTTP_201_CREATED)
-            return response
+            if not (file and self.__allowed_file(file.filename)):
+                DROPPED.inc('bad_extension')
+                return make_response("File type not allowed", status.HTTP_400_BAD_REQUEST)
+            filename = secure_filename(file.filename)
+            source = request.form.get('source')
+            if source:  # prefix the camera name, the Reader picks its region of interest from it
+                filename = secure_filename('%s_%s' % (source, filename))
+            absolute_path = self.__layout.path(self.__static_files, filename, create=True)
+            staged = staging(absolute_path) if self.__queue else absolute_path  # moved in place as it is enqueued
+            try:  # staging names are unique, concurrent uploads need no lock
+                file.save(staged)
+                size = os.path.getsize(staged)  # before it is enqueued, the Reader may remove the frame from then on
+                trace.mark('enqueue')
+                TRACES.put(filename, trace)
+                if self.__queue:
+                    self.__queue.enqueue(filename, staged, absolute_path)
+            except Exception:
+                if staged != absolute_path:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(staged)
+                raise
+            UPLOADS.inc()
+            UPLOAD_BYTES.observe(size)
+            return make_response("File is stored", status.HTTP_201_CREATED, {'X-Trace-Id': trace.id})
+
+    def __frames_in_folder(self):
+        return sum(1 for _ in self.__layout.entries(self.__static_files))
+
+    def __metrics(self):
+        return make_response(render(), status.HTTP_200_OK, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    def __admin(self, handler):
+        """
+        It wraps an admin route: with a token, requests must carry it as 'Authorization: Bearer <token>';
+        without one, only requests from the loopback interface are served.
+        """
+        def guarded(*args, **kwargs):
+            if self.__admin_token:
+                scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+                if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), self.__admin_token.encode()):
+                    return make_response({'error': 'admin token required'}, status.HTTP_401_UNAUTHORIZED,
+                                         {'WWW-Authenticate': 'Bearer'})
+            elif request.remote_addr not in LOOPBACK:
+                return make_response({'error': 'admin routes are served to localhost only'}, status.HTTP_403_FORBIDDEN)
+            return handler(*args, **kwargs)
+        return guarded
+
+    def __admin_profile(self):
+        try:
+            seconds = float(request.args.get('seconds', 10))
+            interval = float(request.args.get('interval', 0.01))
+            format = request.args.get('format', 'collapsed')
+            if format not in ('collapsed', 'speedscope'):
+                raise ValueError('format must be collapsed or speedscope, got %r' % format)
+            profile = SAMPLER.profile(seconds, interval)
+        except ValueError as e:
+            return make_response({'error': str(e)}, status.HTTP_400_BAD_REQUEST)
+        except RuntimeError as e:
+            return make_response({'error': str(e)}, status.HTTP_409_CONFLICT)
+        logging.info('Sampled %d stacks in %.1fs' % (profile.samples, profile.duration))
+        if format == 'speedscope':
+            return make_response(profile.speedscope(), status.HTTP_200_OK,
+                                 {'Content-Disposition': 'attachment; filename=profile.speedscope.json'})
+        return make_response(profile.collapsed(), status.HTTP_200_OK,
+                             {'Content-Type': 'text/plain; charset=utf-8',
+                              'Content-Disposition': 'attachment; filename=profile.collapsed.txt'})
+
+    def __detections(self):
+        args = request.args
+        try:
+            since, until = [float(args[k]) if k in args else None for k in ('since', 'until')]
+            options = dict(since=since, until=until, source=args.get('source'), limit=int(args.get('limit', 100)))
+            if 'plate' in args:
+                rows = self.__store.exact(args['plate'], **options)
+            elif 'near' in args:
+                rows = self.__store.fuzzy(args['near'], float(args.get('distance', 1.0)), **options)
+            elif 'prefix' in args:
+                rows = self.__store.prefix(args['prefix'], **options)
+            else:
+                rows = self.__store.between(**options)
+        except ValueError as e:
+            return make_response({'error': str(e)}, status.HTTP_400_BAD_REQUEST)
+        return make_response({'detections': rows}, status.HTTP_200_OK)
+
+    def __detected(self, name):
+        try:
+            content = self.__retention.read(name)
+        except ValueError as e:
+            return make_response({'error': str(e)}, status.HTTP_400_BAD_REQUEST)
+        if content is None:
+            return make_response({'error': 'not found'}, status.HTTP_404_NOT_FOUND)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        return make_response(content, status.HTTP_200_OK, {'Content-Type': content_type})
+
+    def __admin_reload(self):
+        try:
+            changed = self.__reload()
+        except ValueError as e:
+            logging.error('Configuration rejected: %s' % e)
+            return make_response({'error': str(e)}, status.HTTP_400_BAD_REQUEST)
+        return make_response({'changed': sorted(changed)}, status.HTTP_200_OK)
+
+    def __admin_model(self):
+        if request.method == 'GET':
+            return make_response({'version': self.__version()}, status.HTTP_200_OK)
+        body = request.get_json(silent=True) or request.form
+        try:
+            model_path = self.__swap(body.get('model_path'))
+        except ValueError as e:
+            logging.error('Model swap rejected: %s' % e)
+            return make_response({'error': str(e)}, status.HTTP_400_BAD_REQUEST)
+        return make_response({'loading': model_path, 'version': self.__version()}, status.HTTP_202_ACCEPTED)
 
     def __allowed_file(self, filename):
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in self.__ALLOWED_EXTENSIONS
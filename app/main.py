@@ -14,10 +14,17 @@ __description__ = 'License Plate Detection'
 
 import os
 import yaml
+import signal
+import logging
 import argparse
-from threading import Lock
 from logic.writer import Writer
 from logic.reader import Reader
+from utils.layout import Layout
+from utils.logs import setup_logging
+from utils.store import DetectionStore
+from utils.plates import CONFUSIONS, ConfusionDistance, PlateIndex
+from utils.retention import Retention
+from utils.workqueue import FrameQueue
 
 def main():
     description = ('%s\n%s' % (__author__, __description__))
@@ -40,27 +47,98 @@ def main():
 
     options = parser.parse_args()
     verbosity = options.verbosity
-    mutex = Lock()
     with open(options.config) as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
     logdir_name = config['logging']['logging_folder']
     logging_path = '%s/%s' % (config['logging']['logging_folder'], config['logging']['logging_filename'])
     if not os.path.exists(logdir_name):
         os.makedirs(logdir_name)
+    setup_logging(logging_path, verbosity, config['logging'].get('max_bytes', 10 * 1024 * 1024),
+        config['logging'].get('backup_count', 5), config['logging'].get('format', 'json') == 'json')
 
-    writer = setup_writer(config['restful'], config['static_files'], mutex, verbosity, logging_path)
-    reader = setup_reader(config['detection'], config['static_files'], mutex, verbosity, logging_path)
+    layout = Layout(config['static_files'].get('layout_levels', 0), config['static_files'].get('layout_width', 2))
+    queue = FrameQueue(config['static_files'].get('queue', 'static-files/frames.db'), layout=layout,
+        quarantine=config['static_files'].get('failed') or None)
+    store = setup_store(config['static_files'], config.get('search'))
+    retention = setup_retention(config['static_files'], config.get('retention') or {}, layout)
+    reader = setup_reader(config['detection'], config['static_files'], verbosity, logging_path, queue, store,
+        retention, layout)
+    reload = lambda: reload_detection(options.config, reader)
+    writer = setup_writer(config['restful'], config['static_files'], verbosity, logging_path,
+        reload, reader.swap_model, reader.model_version, queue, store, retention, layout)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_on_signal(reload))
     writer.start()
     reader.start()
 
-def setup_writer(config, config_files, mutex, verbosity, logging_path):
+def reload_detection(config_path, reader):
+    """ Re-read the detection section of the configuration file and hand it to the reader.
+
+        Args:
+            config_path(str): YAML configuration file
+            reader(Reader): running reader
+
+        Returns:
+            (set) changed parameters
+
+        Raises:
+            ValueError: the new configuration is not valid, the current one is kept
+    """
+    try:
+        with open(config_path) as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)['detection']
+    except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+        raise ValueError('cannot read the detection section of %s: %s' % (config_path, e))
+    return reader.reload(config)
+
+def reload_on_signal(reload):
+    try:
+        reload()
+    except ValueError as e:
+        logging.error('Configuration rejected: %s' % e)
+
+def setup_writer(config, config_files, verbosity, logging_path, reload=None, swap=None, version=None, queue=None,
+        store=None, retention=None, layout=None):
     writer = Writer(config['host'], config['port'],
-        config_files['potential'], mutex, verbosity, logging_path)
+        config_files['potential'], verbosity, logging_path, reload, swap, version, queue, store, retention, layout,
+        config.get('admin_token') or None)
     writer.setup()
     return writer
 
-def setup_reader(config, config_files, mutex, verbosity, logging_path):
-    reader = Reader(config_files['potential'], config_files['detected'], config['model_path'], mutex, verbosity, logging_path)
+def setup_store(config_files, config_search=None):
+    """ Detection store, with a fuzzy plate index when the search section is set.
+
+        Args:
+            config_files(dict): static_files section
+            config_search(dict): search section, None to disable fuzzy search
+
+        Returns:
+            (DetectionStore) store, None when static_files.detections is empty
+    """
+    if not config_files.get('detections'):
+        return None
+    index = None
+    if config_search:
+        distance = ConfusionDistance(config_search.get('confusions', CONFUSIONS), config_search.get('confusion_cost', 0.5))
+        index = PlateIndex(distance, int(config_search.get('depth', 1)))
+    return DetectionStore(config_files['detections'], index=index)
+
+def setup_retention(config_files, config_retention, layout=None):
+    """ Time buckets, packing and quotas of the detected folder.
+
+        Args:
+            config_files(dict): static_files section
+            config_retention(dict): retention section, defaults for the missing keys
+            layout(Layout): layout of the files within a bucket
+
+        Returns:
+            (Retention) retention manager, its background passes started
+    """
+    return Retention(config_files['detected'], layout=layout, **config_retention)
+
+def setup_reader(config, config_files, verbosity, logging_path, queue=None, store=None, retention=None,
+        layout=None):
+    reader = Reader(config_files['potential'], config_files['detected'], config, verbosity, logging_path, queue, store,
+        retention, layout)
     reader.setup()
     return reader
 
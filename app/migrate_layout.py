@@ -0,0 +1,162 @@
+"""
+Move the files of the potential and detected folders to the configured layout
+
+Run it with the service stopped, after changing static_files.layout_levels or
+layout_width, or to convert the flat folders of older versions: potential
+frames are moved to their shard; flat detected results are moved to the time
+bucket of their modification time; files of the bucket directories are moved
+to their shard; segment indexes and the image paths of the detection store
+are rewritten to match. Files are renamed, never copied, and a file already in
+place is left alone, so an interrupted migration is resumed by running it again.
+
+Usage:
+    $ python path/to/migrate_layout.py --config config.yaml --dry-run
+    $ python path/to/migrate_layout.py --config config.yaml
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+from pathlib import Path
+
+import yaml
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.layout import Layout
+from utils.retention import INDEX, SEGMENT, bucket_name, bucket_start
+
+
+def migrate_potential(folder, layout, dry_run=False):
+    """ Move the frames of the potential folder to their shard.
+
+        Args:
+            folder(str): potential folder
+            layout(Layout): target layout
+            dry_run(bool): count the moves only
+
+        Returns:
+            (int) frames moved
+    """
+    moves = [(path, layout.path(folder, os.path.basename(path))) for path in _files(folder)]
+    return _move([(a, b) for a, b in moves if a != b], folder, dry_run)
+
+
+def migrate_detected(folder, layout, bucket_seconds=3600, dry_run=False):
+    """ Move the results of the detected folder to their bucket and shard, and rewrite the segment indexes.
+
+        Args:
+            folder(str): detected folder
+            layout(Layout): target layout within a bucket
+            bucket_seconds(int): time span of a bucket, as in the retention section
+            dry_run(bool): count the moves only
+
+        Returns:
+            (list) (old path, new path) of the moved results
+    """
+    moves = []
+    flat = dict()  # frame stem: paths of its image and record, kept in the same bucket
+    for e in os.scandir(folder):
+        stem, extension = os.path.splitext(e.name)
+        if e.is_dir() and bucket_start(e.name) is not None:
+            for path in _files(e.path):
+                target = os.path.join(e.path, layout.relative(os.path.basename(path)))
+                if path != target:
+                    moves.append((path, target))
+        elif e.is_file() and not (extension in (SEGMENT, INDEX) and bucket_start(stem) is not None):
+            flat.setdefault(stem, []).append(e)
+    for entries in flat.values():
+        bucket = bucket_name(min(e.stat().st_mtime for e in entries), bucket_seconds)
+        moves += [(e.path, os.path.join(folder, bucket, layout.relative(e.name))) for e in entries]
+    _move(moves, folder, dry_run)
+    for e in os.scandir(folder):
+        stem, extension = os.path.splitext(e.name)
+        if extension == INDEX and bucket_start(stem) is not None:
+            _reindex(e.path, layout, dry_run)
+    return moves
+
+
+def update_store(path, moves, dry_run=False):
+    """ Rewrite the image paths of the detection store rows of the moved results.
+
+        Args:
+            path(str): detection store database
+            moves(list): (old path, new path)
+            dry_run(bool): count the rows only
+
+        Returns:
+            (int) rows updated
+    """
+    db = sqlite3.connect(path)
+    with db:
+        if dry_run:
+            return sum(db.execute('SELECT COUNT(*) FROM detections WHERE image = ?', (old,)).fetchone()[0]
+                       for old, _ in moves)
+        return db.executemany('UPDATE detections SET image = ? WHERE image = ?', [(new, old) for old, new in moves]).rowcount
+
+
+def _files(folder):
+    return [os.path.join(root, filename) for root, _, filenames in os.walk(folder) for filename in filenames]
+
+
+def _move(moves, folder, dry_run):
+    if dry_run:
+        return len(moves)
+    for path, target in moves:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    for root, _, _ in sorted(os.walk(folder), reverse=True):  # shards of the old layout, deepest first
+        if root != folder and not os.listdir(root):
+            os.rmdir(root)
+    return len(moves)
+
+
+def _reindex(path, layout, dry_run):
+    # the names of a segment index, relative to its bucket, follow the layout; offsets are unchanged
+    with open(path) as f:
+        lines = f.readlines()
+    rewritten = []
+    for line in lines:
+        parts = line.rstrip('\n').split(' ', 2)
+        if len(parts) == 3:  # lines torn by a crash are dropped
+            name = layout.relative(parts[2].rsplit('/', 1)[-1]).replace(os.sep, '/')
+            rewritten.append('%s %s %s\n' % (parts[0], parts[1], name))
+    if dry_run or rewritten == lines:
+        return
+    with open(path + '.tmp', 'w') as f:
+        f.writelines(rewritten)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def run(config='config.yaml', dry_run=False):
+    with open(config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    files = config['static_files']
+    layout = Layout(files.get('layout_levels', 0), files.get('layout_width', 2))
+    bucket_seconds = (config.get('retention') or {}).get('bucket_seconds', 3600)
+    t = time.time()
+    moved = migrate_potential(files['potential'], layout, dry_run) if os.path.isdir(files['potential']) else 0
+    logging.info('%s: %d frames %s' % (files['potential'], moved, 'to move' if dry_run else 'moved'))
+    moves = migrate_detected(files['detected'], layout, bucket_seconds, dry_run) if os.path.isdir(files['detected']) else []
+    logging.info('%s: %d results %s' % (files['detected'], len(moves), 'to move' if dry_run else 'moved'))
+    if files.get('detections') and os.path.exists(files['detections']) and moves:
+        rows = update_store(files['detections'], moves, dry_run)
+        logging.info('%s: %d rows %s' % (files['detections'], rows, 'to update' if dry_run else 'updated'))
+    logging.info('%s in %.1f s' % (layout, time.time() - t))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='config.yaml', help='YAML configuration file')
+    parser.add_argument('--dry-run', action='store_true', help='count the files to move, change nothing')
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    run(**vars(opt))
@@ -2,7 +2,11 @@
 """
 Experimental modules
 """
+import json
 import math
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -11,6 +15,9 @@ import torch.nn as nn
 from models.common import Conv
 from utils.downloads import attempt_download
 
+SERVE_MAGIC = b'YOLOSRV1'  # serving artifact file signature
+SERVE_ALIGN = 4096  # tensor data starts on a page boundary
+
 
 class CrossConv(nn.Module):
     # Cross Convolution Downsample
@@ -74,25 +81,48 @@ class MixConv2d(nn.Module):
 
 class Ensemble(nn.ModuleList):
     # Ensemble of models
+    parallel = False  # run members concurrently on separate threads, the caller sets their share of intra-op threads
+    fusion = 'nms'  # 'nms' concatenates member outputs, 'wbf' returns them apart for weighted_boxes_fusion()
+
     def __init__(self):
         super().__init__()
 
     def forward(self, x, augment=False, profile=False, visualize=False):
-        y = []
-        for module in self:
-            y.append(module(x, augment, profile, visualize)[0])
+        if self.parallel and len(self) > 1:
+            y = self._forward_parallel(x, augment, profile, visualize)
+        else:
+            y = []
+            for module in self:
+                y.append(module(x, augment, profile, visualize)[0])
+        if self.fusion == 'wbf':
+            return y, None  # per member inference, fused after NMS
         # y = torch.stack(y).max(0)[0]  # max ensemble
         # y = torch.stack(y).mean(0)  # mean ensemble
-        y = torch.cat(y, 1)  # nms ensemble
+        y = torch.cat(y, 1 if y[0].ndim == 3 else 0)  # nms ensemble, Detect.conf_thres candidates are (n,6+nc)
         return y, None  # inference, train output
 
+    def _forward_parallel(self, x, augment=False, profile=False, visualize=False):
+        # torch.set_num_threads() is process-wide, the caller splits the threads once instead of each member
+        if getattr(self, 'pool', None) is None:
+            self.pool = ThreadPoolExecutor(len(self), thread_name_prefix='ensemble')
+        grad = torch.is_grad_enabled()  # grad mode is thread-local
+
+        def run(module):
+            with torch.set_grad_enabled(grad):
+                return module(x, augment, profile, visualize)[0]
+
+        return list(self.pool.map(run, self))
+
 
 def attempt_load(weights, map_location=None, inplace=True, fuse=True):
-    from models.yolo import Detect, Model
+    from models.yolo import Detect, Model, mark_last_use
 
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
+        if str(w).endswith('.serve'):  # pre-fused serving artifact, weights memory-mapped
+            model.append(load_serving(w, map_location))
+            continue
         ckpt = torch.load(attempt_download(w), map_location=map_location)  # load
         ckpt = (ckpt.get('ema') or ckpt['model']).float()  # FP32 model
         model.append(ckpt.fuse().eval() if fuse else ckpt.eval())  # fused or un-fused model in eval mode
@@ -102,10 +132,14 @@ def attempt_load(weights, map_location=None, inplace=True, fuse=True):
         t = type(m)
         if t in (nn.Hardswish, nn.LeakyReLU, nn.ReLU, nn.ReLU6, nn.SiLU, Detect, Model):
             m.inplace = inplace  # torch 1.7.0 compatibility
+            if t is Model and not hasattr(m.model[0], 'free'):  # liveness compatibility
+                mark_last_use(m.model)
             if t is Detect:
                 if not isinstance(m.anchor_grid, list):  # new Detect Layer compatibility
                     delattr(m, 'anchor_grid')
                     setattr(m, 'anchor_grid', [torch.zeros(1)] * m.nl)
+                if not hasattr(m, 'grid_cache'):  # grid cache compatibility
+                    setattr(m, 'grid_cache', OrderedDict())
         elif t is Conv:
             m._non_persistent_buffers_set = set()  # torch 1.6.0 compatibility
         elif t is nn.Upsample and not hasattr(m, 'recompute_scale_factor'):
@@ -120,3 +154,54 @@ def attempt_load(weights, map_location=None, inplace=True, fuse=True):
         model.stride = model[torch.argmax(torch.tensor([m.stride.max() for m in model])).int()].stride  # max stride
         assert all(model[0].nc == m.nc for m in model), f'Models have different class counts: {[m.nc for m in model]}'
         return model  # return ensemble
+
+
+def save_serving(weights, file):
+    # Write a serving artifact: fused FP32 eval-mode model, no optimizer or EMA, weights in one flat mmap-able block
+    model = attempt_load(weights, map_location='cpu')
+    assert not isinstance(model, Ensemble), 'Serving artifacts hold a single model, convert ensemble members one by one'
+    header, offset = {'yaml': model.yaml, 'names': list(model.names), 'tensors': {}}, 0
+    state = {k: v.detach().contiguous() for k, v in model.state_dict().items()}
+    for k, v in state.items():
+        offset = -(-offset // 64) * 64  # 64-byte aligned tensors
+        header['tensors'][k] = {'dtype': str(v.dtype).split('.')[-1], 'shape': list(v.shape), 'offset': offset}
+        offset += v.numel() * v.element_size()
+    meta = json.dumps(header).encode()
+    start = -(-(len(SERVE_MAGIC) + 8 + len(meta)) // SERVE_ALIGN) * SERVE_ALIGN
+    with open(file, 'wb') as f:
+        f.write(SERVE_MAGIC + len(meta).to_bytes(8, 'little') + meta)
+        for k, v in state.items():
+            f.seek(start + header['tensors'][k]['offset'])
+            f.write(v.numpy().tobytes())
+        f.truncate(start + offset)
+    return file
+
+
+def load_serving(file, map_location=None):
+    # Load a serving artifact, CPU weights are read-only views of a shared mapping so workers share the page cache
+    from models.yolo import Model
+
+    with open(file, 'rb') as f:
+        assert f.read(len(SERVE_MAGIC)) == SERVE_MAGIC, f'{file} is not a serving artifact'
+        n = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(n))
+    start = -(-(len(SERVE_MAGIC) + 8 + n) // SERVE_ALIGN) * SERVE_ALIGN
+    buffer = np.memmap(file, dtype=np.uint8, mode='r')
+
+    model = Model(header['yaml']).eval()  # initial weights are replaced below
+    for m in model.modules():  # fused layout of Model.fuse() without the BatchNorm arithmetic
+        if isinstance(m, Conv) and hasattr(m, 'bn'):
+            m.conv.bias = nn.Parameter(torch.empty(m.conv.out_channels))
+            delattr(m, 'bn')
+            m.forward = m.forward_fuse
+    state = model.state_dict(keep_vars=True)
+    assert state.keys() == header['tensors'].keys(), f'{file} does not match its model definition'
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # non-writable arrays, weights are never written in place at inference
+        for k, t in header['tensors'].items():
+            size = int(np.prod(t['shape'])) * np.dtype(t['dtype']).itemsize
+            x = buffer[start + t['offset']:start + t['offset'] + size].view(t['dtype']).reshape(t['shape'])
+            state[k].data = torch.from_numpy(x)
+    model.nc, model.names = header['yaml']['nc'], header['names']
+    model.requires_grad_(False)
+    return model.to(map_location) if map_location is not None else model
@@ -10,6 +10,7 @@ import argparse
 import os
 import platform
 import sys
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
 
@@ -24,20 +25,16 @@ from models.common import *
 from models.experimental import *
 from utils.autoanchor import check_anchor_order
 from utils.general import LOGGER, check_version, check_yaml, make_divisible, print_args
-from utils.plots import feature_visualization
-from utils.torch_utils import (fuse_conv_and_bn, initialize_weights, model_info, profile, scale_img, select_device,
-                               time_sync)
-
-try:
-    import thop  # for FLOPs computation
-except ImportError:
-    thop = None
+from utils.torch_utils import (fuse_conv_and_bn, initialize_weights, layer_flops, model_info, profile, scale_img,
+                               select_device, tensor_bytes, time_sync)
 
 
 class Detect(nn.Module):
     stride = None  # strides computed during build
     onnx_dynamic = False  # ONNX export parameter
     export = False  # export mode
+    conf_thres = None  # inference pre-filter, objectness threshold of the compact candidates output
+    grid_cache_size = 32  # decoded grids kept per served (layer, ny, nx), least recently used evicted first
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -47,20 +44,28 @@ class Detect(nn.Module):
         self.na = len(anchors[0]) // 2  # number of anchors
         self.grid = [torch.zeros(1)] * self.nl  # init grid
         self.anchor_grid = [torch.zeros(1)] * self.nl  # init anchor grid
+        self.grid_cache = OrderedDict()  # (i, ny, nx): (grid, anchor_grid)
         self.register_buffer('anchors', torch.tensor(anchors).float().view(self.nl, -1, 2))  # shape(nl,na,2)
         self.m = nn.ModuleList(nn.Conv2d(x, self.no * self.na, 1) for x in ch)  # output conv
         self.inplace = inplace  # use in-place ops (e.g. slice assignment)
 
     def forward(self, x):
         z = []  # inference output
+        prefilter = self.conf_thres is not None and not (self.training or self.export)
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.onnx_dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                if self.onnx_dynamic:  # traced, grid computed in the graph
                     self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+                elif self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                    self.grid[i], self.anchor_grid[i] = self._cached_grid(nx, ny, i)
+
+                if prefilter:  # decode candidates only
+                    z.append(self._decode_candidates(x[i], i))
+                    continue
 
                 y = x[i].sigmoid()
                 if self.inplace:
@@ -73,8 +78,38 @@ class Detect(nn.Module):
                     y = torch.cat((xy, wh, conf), 4)
                 z.append(y.view(bs, -1, self.no))
 
+        if prefilter:
+            return torch.cat(z, 0), x  # candidates(n,6+nc) [image, xywh, obj, cls], train
         return x if self.training else (torch.cat(z, 1),) if self.export else (torch.cat(z, 1), x)
 
+    def _decode_candidates(self, p, i):
+        # Sigmoid and xywh decoding of the anchors above conf_thres only, sigmoid(v) > t <=> v > log(t / (1 - t))
+        t = self.conf_thres
+        logit = math.log(t / (1 - t)) if 0 < t < 1 else -math.inf if t <= 0 else math.inf
+        b, a, gy, gx = (p[..., 4] > logit).nonzero(as_tuple=True)  # image, anchor, grid y, grid x
+        y = p[b, a, gy, gx].sigmoid()
+        xy = (y[:, 0:2] * 2 + self.grid[i][0, a, gy, gx]) * self.stride[i]  # xy
+        wh = (y[:, 2:4] * 2) ** 2 * self.anchor_grid[i][0, a, gy, gx]  # wh
+        return torch.cat((b[:, None].to(y.dtype), xy, wh, y[:, 4:]), 1)
+
+    def _cached_grid(self, nx=20, ny=20, i=0):
+        # LRU cache of _make_grid(), shapes alternate with mixed camera resolutions and rectangular inference
+        k = i, ny, nx
+        grid = self.grid_cache.get(k)
+        if grid is not None:
+            self.grid_cache.move_to_end(k)
+            return grid
+        grid = self.grid_cache[k] = self._make_grid(nx, ny, i)
+        while len(self.grid_cache) > self.grid_cache_size:  # 0 disables the cache, the grid is still returned
+            self.grid_cache.popitem(last=False)
+        return grid
+
+    def cache_grids(self, shapes):
+        # Pre-warm the grid cache for inference image shapes [(h, w), ...]
+        for h, w in shapes:
+            for i, s in enumerate(self.stride.tolist()):
+                self._cached_grid(math.ceil(w / s), math.ceil(h / s), i)
+
     def _make_grid(self, nx=20, ny=20, i=0):
         d = self.anchors[i].device
         t = self.anchors[i].dtype
@@ -132,35 +167,69 @@ class Model(nn.Module):
     def forward(self, x, augment=False, profile=False, visualize=False):
         if augment:
             return self._forward_augment(x)  # augmented inference, None
-        return self._forward_once(x, profile, visualize)  # single-scale inference, train
+        if profile:  # layer by layer
+            dt = []
+            x = self._forward_once(x, dt, visualize)
+            self._log_profile(dt)
+            return x
+        return self._forward_once(x, None, visualize)  # single-scale inference, train
 
     def _forward_augment(self, x):
         img_size = x.shape[-2:]  # height, width
         s = [1, 0.83, 0.67]  # scales
         f = [None, 3, None]  # flips (2-ud, 3-lr)
-        y = []  # outputs
-        for si, fi in zip(s, f):
-            xi = scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max()))
+        gs = int(self.stride.max())  # grid size (max stride)
+        y = [None] * len(s)  # outputs
+        for group in ([j for j, si in enumerate(s) if si == 1], [j for j, si in enumerate(s) if si != 1]):
+            if not group:  # full scale copies in one forward, downscaled copies padded to a common shape in another
+                continue
+            xi = [scale_img(x.flip(f[j]) if f[j] else x, s[j], gs=gs) for j in group]
+            h, w = (max(t.shape[k] for t in xi) for k in (2, 3))  # common gs-multiple shape
+            xi = torch.cat([nn.functional.pad(t, [0, w - t.shape[3], 0, h - t.shape[2]], value=0.447) for t in xi], 0)
             yi = self._forward_once(xi)[0]  # forward
-            # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-            yi = self._descale_pred(yi, fi, si, img_size)
-            y.append(yi)
+            yi = self._descale_preds(yi.view(len(group), -1, *yi.shape[1:]), [f[j] for j in group],
+                                     [s[j] for j in group], img_size)
+            for j, yj in zip(group, yi):
+                y[j] = yj
         y = self._clip_augmented(y)  # clip augmented tails
         return torch.cat(y, 1), None  # augmented inference, train
 
-    def _forward_once(self, x, profile=False, visualize=False):
-        y, dt = [], []  # outputs
+    def _forward_once(self, x, profile=None, visualize=False, n=10):
+        # profile: list the per-layer profiles are appended to, None to run without profiling; n: timed runs per layer
+        y = []  # outputs
         for m in self.model:
             if m.f != -1:  # if not from previous layer
                 x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
-            if profile:
-                self._profile_one_layer(m, x, dt)
+            if profile is not None:
+                profile.append(self._profile_one_layer(m, x, n))
             x = m(x)  # run
             y.append(x if m.i in self.save else None)  # save output
+            for j in m.free:  # last consumer has run, release saved output
+                y[j] = None
             if visualize:
+                from utils.plots import feature_visualization  # matplotlib, imported on first use
                 feature_visualization(x, m.type, m.i, save_dir=visualize)
         return x
 
+    def activation_memory(self, x, free=True):
+        # Peak bytes of layer outputs alive at once during a forward, with or without releasing dead saved outputs
+        nbytes = lambda t: sum(nbytes(i) for i in t) if isinstance(t, (list, tuple)) else t.numel() * t.element_size()
+        y, live, peak = [], 0, 0  # outputs, saved bytes alive, peak bytes
+        with torch.no_grad():
+            for m in self.model:
+                prev = 0 if m.f != -1 or (y and y[-1] is not None) else nbytes(x)  # unsaved input still alive
+                if m.f != -1:  # if not from previous layer
+                    x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+                x = m(x.copy() if isinstance(m, Detect) else x)  # run, inplace fix
+                saved = m.i in self.save
+                y.append(x if saved else None)  # save output
+                live += nbytes(x) if saved else 0
+                peak = max(peak, live + prev + (0 if saved else nbytes(x)))
+                for j in m.free if free else ():  # last consumer has run, release saved output
+                    live -= nbytes(y[j])
+                    y[j] = None
+        return peak
+
     def _descale_pred(self, p, flips, scale, img_size):
         # de-scale predictions following augmented inference (inverse operation)
         if self.inplace:
@@ -178,6 +247,17 @@ class Model(nn.Module):
             p = torch.cat((x, y, wh, p[..., 4:]), -1)
         return p
 
+    def _descale_preds(self, p, flips, scales, img_size):
+        # de-scale predictions p(k,bs,n,no) of k augmented copies at once (inverse operation)
+        s = torch.tensor(scales, device=p.device, dtype=p.dtype).view(-1, 1, 1, 1)
+        ud = torch.tensor([fi == 2 for fi in flips], device=p.device).view(-1, 1, 1)
+        lr = torch.tensor([fi == 3 for fi in flips], device=p.device).view(-1, 1, 1)
+        xy, wh = p[..., 0:2] / s, p[..., 2:4] / s  # de-scale
+        x = torch.where(lr, img_size[1] - xy[..., 0], xy[..., 0])  # de-flip lr
+        y = torch.where(ud, img_size[0] - xy[..., 1], xy[..., 1])  # de-flip ud
+        obj = p[..., 4] * ((x >= 0) & (x < img_size[1]) & (y >= 0) & (y < img_size[0]))  # drop padding predictions
+        return torch.cat((x[..., None], y[..., None], wh, obj[..., None], p[..., 5:]), -1)
+
     def _clip_augmented(self, y):
         # Clip YOLOv5 augmented inference tails
         nl = self.model[-1].nl  # number of detection layers (P3-P5)
@@ -189,18 +269,31 @@ class Model(nn.Module):
         y[-1] = y[-1][:, i:]  # small
         return y
 
-    def _profile_one_layer(self, m, x, dt):
+    def profile_layers(self, x, n=10):
+        # Per-layer profile of one forward on input x, list of dicts with the layer index, inputs ('from'), type,
+        # time (ms, mean of n runs), GFLOPs, params and output activation bytes; FLOPs are counted for the whole batch
+        dt = []
+        with torch.no_grad():
+            self._forward_once(x, dt, n=n)
+        return dt
+
+    def _profile_one_layer(self, m, x, n=10):
         c = isinstance(m, Detect)  # is final layer, copy input as inplace fix
-        o = thop.profile(m, inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPs
+        flops = layer_flops(m, x.copy() if c else x)
         t = time_sync()
-        for _ in range(10):
-            m(x.copy() if c else x)
-        dt.append((time_sync() - t) * 100)
-        if m == self.model[0]:
-            LOGGER.info(f"{'time (ms)':>10s} {'GFLOPs':>10s} {'params':>10s}  {'module'}")
-        LOGGER.info(f'{dt[-1]:10.2f} {o:10.2f} {m.np:10.0f}  {m.type}')
-        if c:
-            LOGGER.info(f"{sum(dt):10.2f} {'-':>10s} {'-':>10s}  Total")
+        for _ in range(n):
+            y = m(x.copy() if c else x)
+        dt = (time_sync() - t) * 1000 / n
+        return {'i': m.i, 'from': m.f, 'type': m.type.split('.')[-1], 'time_ms': dt, 'gflops': flops / 1E9,
+                'params': m.np, 'output_bytes': tensor_bytes(y)}
+
+    def _log_profile(self, dt):
+        LOGGER.info(f"{'time (ms)':>10s} {'GFLOPs':>10s} {'params':>10s} {'output (MB)':>12s}  {'module'}")
+        for p in dt:
+            LOGGER.info(f"{p['time_ms']:10.2f} {p['gflops']:10.2f} {p['params']:10.0f} {p['output_bytes'] / 1E6:12.2f}"
+                        f"  {p['type']}")
+        LOGGER.info(f"{sum(p['time_ms'] for p in dt):10.2f} {sum(p['gflops'] for p in dt):10.2f} {'-':>10s} {'-':>12s}"
+                    f"  Total")
 
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
         # https://arxiv.org/abs/1708.02002 section 3.3
@@ -246,6 +339,8 @@ class Model(nn.Module):
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
+            if hasattr(m, 'grid_cache'):
+                m.grid_cache = OrderedDict((k, tuple(map(fn, v))) for k, v in m.grid_cache.items())
         return self
 
 
@@ -300,9 +395,21 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
         if i == 0:
             ch = []
         ch.append(c2)
+    mark_last_use(layers)
     return nn.Sequential(*layers), sorted(save)
 
 
+def mark_last_use(layers):
+    # Liveness of saved outputs: m.free lists the saved layer outputs m is the last consumer of
+    last = {}  # saved layer index: index of its last consumer
+    for m in layers:
+        for x in ([m.f] if isinstance(m.f, int) else m.f):
+            if x != -1:
+                last[x % m.i] = m.i
+    for m in layers:
+        m.free = sorted(j for j, i in last.items() if i == m.i)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cfg', type=str, default='yolov5s.yaml', help='model.yaml')
@@ -310,15 +417,20 @@ if __name__ == '__main__':
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--profile', action='store_true', help='profile model speed')
     parser.add_argument('--line-profile', action='store_true', help='profile model speed layer by layer')
+    parser.add_argument('--memory', action='store_true',
+                        help='peak activation memory of --weights per batch size, estimated, and measured on CUDA')
+    parser.add_argument('--weights', type=str, default='', help='checkpoint or serving artifact, for --memory')
     parser.add_argument('--test', action='store_true', help='test all yolo*.yaml')
     opt = parser.parse_args()
-    opt.cfg = check_yaml(opt.cfg)  # check YAML
+    if opt.memory and not opt.weights:
+        parser.error('--memory profiles a served model, set --weights')
+    opt.cfg = opt.cfg if opt.memory else check_yaml(opt.cfg)  # check YAML
     print_args(vars(opt))
     device = select_device(opt.device)
 
     # Create model
     im = torch.rand(opt.batch_size, 3, 640, 640).to(device)
-    model = Model(opt.cfg).to(device)
+    model = attempt_load(opt.weights, map_location=device) if opt.memory else Model(opt.cfg).to(device)
 
     # Options
     if opt.line_profile:  # profile layer by layer
@@ -327,6 +439,27 @@ if __name__ == '__main__':
     elif opt.profile:  # profile forward-backward
         results = profile(input=im, ops=[model], n=3)
 
+    elif opt.memory:  # peak activation memory, layer outputs released after their last use or kept to the end
+        if isinstance(model, Ensemble):
+            sys.exit('--weights is an ensemble, profile its members one at a time')
+        cuda = device.type == 'cuda'
+        dtype = next(model.parameters()).dtype
+        LOGGER.info(f"{'batch':>6s}{'estimated kept (MB)':>21s}{'estimated released (MB)':>25s}"
+                    f"{'measured (MB)':>15s}")
+        for bs in 1, 2, 4, 8, 16, 32:
+            x = torch.rand(bs, 3, 640, 640, device=device, dtype=dtype)
+            kept, released = (model.activation_memory(x, free=f) / 1E6 for f in (False, True))
+            measured = f"{'-':>15s}"  # estimates count tensor sizes only, allocator and workspaces show on CUDA
+            if cuda:
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+                base = torch.cuda.memory_allocated(device)
+                with torch.no_grad():
+                    model(x)
+                torch.cuda.synchronize(device)
+                measured = f'{(torch.cuda.max_memory_allocated(device) - base) / 1E6:>15.1f}'
+            LOGGER.info(f'{bs:>6d}{kept:>21.1f}{released:>25.1f}{measured}')
+
     elif opt.test:  # test all models
         for cfg in Path(ROOT / 'models').rglob('yolo*.yaml'):
             try:
@@ -0,0 +1,96 @@
+"""
+Migration of the frame folders to a layout, and its resumption.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Usage:
+    $ python -m pytest app/tests/test_migrate_layout.py
+"""
+
+import os
+import sys
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+pytest.importorskip('yaml')
+
+from migrate_layout import migrate_detected, migrate_potential, update_store
+from utils.layout import Layout
+from utils.retention import INDEX, SEGMENT, bucket_name
+
+LAYOUT = Layout(2, 2)
+MTIME = 1697378400  # 2023-10-15 14:00 UTC
+
+
+def _touch(path, content=b'frame', mtime=MTIME):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def _files(folder):
+    return sorted(os.path.relpath(os.path.join(root, f), folder) for root, _, files in os.walk(folder) for f in files)
+
+
+def test_potential(tmp_path):
+    folder = str(tmp_path)
+    names = ['lane01_%d.jpg' % i for i in range(20)]
+    for name in names:
+        _touch(os.path.join(folder, name))
+    assert migrate_potential(folder, LAYOUT, dry_run=True) == 20
+    assert _files(folder) == sorted(names)
+    assert migrate_potential(folder, LAYOUT) == 20
+    assert _files(folder) == sorted(LAYOUT.relative(name) for name in names)
+    assert migrate_potential(folder, LAYOUT) == 0
+
+
+def test_potential_resumed(tmp_path):
+    folder = str(tmp_path)
+    names = ['lane01_%d.jpg' % i for i in range(20)]
+    for name in names:
+        _touch(os.path.join(folder, name))
+    for name in names[:8]:  # moved before the migration was interrupted
+        target = LAYOUT.path(folder, name, create=True)
+        os.replace(os.path.join(folder, name), target)
+    assert migrate_potential(folder, LAYOUT) == 12
+    assert _files(folder) == sorted(LAYOUT.relative(name) for name in names)
+
+
+def test_detected_resumed(tmp_path):
+    folder = str(tmp_path)
+    bucket = bucket_name(MTIME, 3600)
+    flat = ['lane01_a.jpg', 'lane01_a.json', 'lane01_b.jpg']
+    for name in flat:
+        _touch(os.path.join(folder, name))
+    _touch(os.path.join(folder, bucket, 'lane01_c.jpg'))  # a bucket of the flat layout
+    with open(os.path.join(folder, bucket + SEGMENT), 'wb') as f:
+        f.write(b'packed')
+    with open(os.path.join(folder, bucket + INDEX), 'w') as f:
+        f.write('0 6 lane01_d.jpg\n')
+    first = migrate_detected(folder, LAYOUT, 3600)
+    assert len(first) == 4
+    expected = sorted([os.path.join(bucket, LAYOUT.relative(name)) for name in flat + ['lane01_c.jpg']] +
+                      [bucket + SEGMENT, bucket + INDEX])
+    assert _files(folder) == expected
+    with open(os.path.join(folder, bucket + INDEX)) as f:
+        assert f.read() == '0 6 %s\n' % LAYOUT.relative('lane01_d.jpg').replace(os.sep, '/')
+    assert migrate_detected(folder, LAYOUT, 3600) == []  # a run again after completion, or a resumed one, is a no-op
+    assert _files(folder) == expected
+
+    db = str(tmp_path / 'detections.db')
+    with sqlite3.connect(db) as connection:
+        connection.execute('CREATE TABLE detections (image TEXT)')
+        connection.executemany('INSERT INTO detections VALUES (?)', [(old,) for old, _ in first] + [('other.jpg',)])
+    assert update_store(db, first, dry_run=True) == 4
+    assert update_store(db, first) == 4
+    with sqlite3.connect(db) as connection:
+        images = sorted(image for image, in connection.execute('SELECT image FROM detections'))
+    assert images == sorted([new for _, new in first] + ['other.jpg'])
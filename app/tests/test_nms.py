@@ -0,0 +1,130 @@
+"""
+Equivalence of the batched NMS with the per-image loop.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+non_max_suppression_batched must return the detections of non_max_suppression,
+image by image, on dense (bs,n,5+nc) predictions and on the compact candidates
+of Detect.conf_thres. Predictions are float64 so that the image offsets of the
+batched call do not move IoUs across the threshold by rounding, but for the
+float32 case, which checks that they stay small enough not to on large batches.
+
+Usage:
+    $ python -m pytest app/tests/test_nms.py
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+pytest.importorskip('cv2')
+
+from utils.general import non_max_suppression, non_max_suppression_batched
+
+
+def _prediction(seed, bs=4, n=600, nc=3, empty=(), dtype=torch.float64):
+    """ Random dense predictions of overlapping boxes.
+
+        Args:
+            seed(int): random seed
+            bs(int): batch size
+            n(int): anchors per image
+            nc(int): number of classes
+            empty(tuple): images without any candidate
+            dtype(torch.dtype): type of the predictions, drawn in float64
+
+        Returns:
+            (torch.Tensor) (bs,n,5+nc) [xywh, obj, cls]
+    """
+    g = torch.Generator().manual_seed(seed)
+    x = torch.rand((bs, n, 5 + nc), generator=g, dtype=torch.float64)
+    x[..., :2] *= 320  # centers
+    x[..., 2:4] = x[..., 2:4] * 70 + 10  # sizes
+    for i in empty:
+        x[i, :, 4] = 0  # objectness
+    return x.to(dtype)
+
+
+def _compact(prediction, conf_thres):
+    # Detect.conf_thres candidates [image, xywh, obj, cls] of a dense prediction
+    xi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)
+    return torch.cat((xi[:, None].to(prediction.dtype), prediction[xi, ai]), 1)
+
+
+def _assert_same(expected, actual):
+    assert len(actual) == len(expected)
+    for a, b in zip(actual, expected):
+        assert a.shape == b.shape
+        torch.testing.assert_close(a, b, check_dtype=False)  # non_max_suppression fills empty images in float32
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('multi_label', (False, True))
+@pytest.mark.parametrize('agnostic', (False, True))
+def test_dense(seed, multi_label, agnostic):
+    x = _prediction(seed)
+    kwargs = dict(conf_thres=0.25, iou_thres=0.45, agnostic=agnostic, multi_label=multi_label)
+    _assert_same(non_max_suppression(x.clone(), **kwargs), non_max_suppression_batched(x.clone(), **kwargs))
+
+
+@pytest.mark.parametrize('bs, n', ((4, 60), (8, 2000)), ids=('one call', 'over 4000 boxes'))
+def test_batch_size(bs, n):
+    x = _prediction(7, bs, n)
+    kwargs = dict(max_det=1000)
+    _assert_same(non_max_suppression(x.clone(), **kwargs), non_max_suppression_batched(x.clone(), **kwargs))
+
+
+@pytest.mark.parametrize('seed', (1, 5, 9, 25))
+def test_float32_large_batch(seed):
+    x = _prediction(seed, bs=64, n=400, nc=3, dtype=torch.float32)
+    x[..., :2] *= 2  # 640 pixel frames, image offsets reach 64 frames
+    kwargs = dict(max_det=1000)
+    _assert_same(non_max_suppression(x.double(), **kwargs), non_max_suppression_batched(x.clone(), **kwargs))
+
+
+@pytest.mark.parametrize('classes', ([0], [1, 2]))
+def test_classes(classes):
+    x = _prediction(3)
+    for multi_label in (False, True):
+        kwargs = dict(classes=classes, multi_label=multi_label)
+        _assert_same(non_max_suppression(x.clone(), **kwargs), non_max_suppression_batched(x.clone(), **kwargs))
+
+
+@pytest.mark.parametrize('empty', ((0,), (1, 3), (0, 1, 2, 3)))
+def test_empty_images(empty):
+    x = _prediction(4, empty=empty)
+    output = non_max_suppression_batched(x.clone())
+    _assert_same(non_max_suppression(x.clone()), output)
+    assert all(output[i].shape == (0, 6) for i in empty)
+
+
+@pytest.mark.parametrize('max_det', (1, 5, 20))
+def test_max_det(max_det):
+    x = _prediction(5)
+    kwargs = dict(conf_thres=0.05, iou_thres=0.7, multi_label=True, max_det=max_det)
+    output = non_max_suppression_batched(x.clone(), **kwargs)
+    _assert_same(non_max_suppression(x.clone(), **kwargs), output)
+    assert all(len(d) == max_det for d in output)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('multi_label', (False, True))
+def test_compact(seed, multi_label):
+    x = _prediction(seed, empty=(2,))
+    kwargs = dict(conf_thres=0.25, iou_thres=0.45, multi_label=multi_label)
+    compact = _compact(x, 0.1)  # Detect keeps candidates below the NMS threshold too
+    _assert_same(non_max_suppression(x.clone(), **kwargs),
+                 non_max_suppression_batched(compact, bs=x.shape[0], **kwargs))
+
+
+def test_compact_without_candidates():
+    x = _prediction(6, empty=range(4))
+    output = non_max_suppression_batched(_compact(x, 0.25), bs=4)
+    assert [d.shape for d in output] == [(0, 6)] * 4
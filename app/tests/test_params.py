@@ -0,0 +1,66 @@
+"""
+Validation of the detection parameters.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Usage:
+    $ python -m pytest app/tests/test_params.py
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+pytest.importorskip('torch')
+
+from utils.params import Parameters
+
+MODEL = {'model_path': 'model/best.pt'}
+
+
+@pytest.mark.parametrize('overlap', (0, 64, 600, 608))
+def test_tile_overlap_rounded_below_the_tile(overlap):
+    assert Parameters(dict(MODEL, tile_overlap=overlap)).tile_overlap == overlap
+
+
+@pytest.mark.parametrize('overlap', (609, 630, 640))
+def test_tile_overlap_rounded_to_the_tile(overlap):
+    with pytest.raises(ValueError, match='tile_overlap'):
+        Parameters(dict(MODEL, tile_overlap=overlap))
+
+
+def test_defaults():
+    params = Parameters(MODEL)
+    assert params.model == MODEL['model_path']
+    assert params.tile_shape == (640, 640, 3)
+    assert params.queue_max_attempts == 3
+
+
+@pytest.mark.parametrize('config', (
+    {'model_path': None},
+    {'unknown': 1},
+    {'conf_thres': 1.5},
+    {'batch_size': 2.5},
+    {'model_watch': 'yes'},
+    {'tile_shape': [640, 600]},
+    {'tile_shape': [640]},
+    {'mode': 'fast'},
+))
+def test_invalid(config):
+    with pytest.raises(ValueError):
+        Parameters(dict(MODEL, **config))
+
+
+def test_hot_changes_do_not_reload():
+    params = Parameters(MODEL)
+    hot = Parameters(dict(MODEL, conf_thres=0.5, batch_size=4))
+    assert params.changes(hot) == {'conf_thres', 'batch_size'}
+    assert not params.needs_reload(hot)
+    cold = Parameters(dict(MODEL, tile_shape=[320, 320]))
+    assert params.changes(cold) == {'tile_shape'}
+    assert params.needs_reload(cold)
@@ -0,0 +1,68 @@
+"""
+Fuzzy plate search against a brute-force scan.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Usage:
+    $ python -m pytest app/tests/test_plates.py
+"""
+
+import sys
+import random
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from utils.plates import ConfusionDistance, PlateIndex
+
+ALPHABET = 'ABCDGILOQSTZ0125678'  # mostly confusable characters, so that near plates are frequent
+
+
+def _plates(seed, n):
+    rng = random.Random(seed)
+    return sorted({''.join(rng.choice(ALPHABET) for _ in range(rng.randint(5, 7))) for _ in range(n)})
+
+
+def _misread(plates, seed, edits):
+    # plates with a few random substitutions, insertions or deletions
+    rng = random.Random(seed)
+    queries = []
+    for plate in plates:
+        for _ in range(edits):
+            i = rng.randrange(len(plate))
+            plate = rng.choice((plate[:i] + rng.choice(ALPHABET) + plate[i + 1:], plate[:i] + rng.choice(ALPHABET) +
+                                plate[i:], plate[:i] + plate[i + 1:]))
+        queries.append(plate)
+    return queries
+
+
+def test_distance():
+    distance = ConfusionDistance(cost=0.5)
+    assert distance('AB123CD', 'AB123CD') == 0
+    assert distance('AB123CD', 'A8123CD') == 0.5
+    assert distance('AB123CD', 'AB12JCD') == 1
+    assert distance('AB123CD', 'AB123C') == 1
+    with pytest.raises(ValueError):
+        ConfusionDistance(cost=0.2)
+
+
+@pytest.mark.parametrize('depth, radius', ((1, 0.5), (1, 1.0), (2, 1.5), (2, 2.0)))
+def test_search_matches_brute_force(depth, radius):
+    plates = _plates(depth, 500)
+    index = PlateIndex(ConfusionDistance(), depth)
+    for plate in plates:
+        index.add(plate)
+    assert len(index) == len(plates)
+    confused = [p.replace('0', 'O', 1) for p in plates[:40]]  # within 0.5 of the plate
+    for query in _plates(depth + 10, 20) + _misread(plates[:40], depth, depth) + confused:
+        expected = sorted((d, p) for d, p in ((index.distance(query, p), p) for p in plates) if d <= radius + 1e-9)
+        assert index.search(query, radius) == expected
+
+
+def test_radius_above_depth():
+    with pytest.raises(ValueError):
+        PlateIndex(depth=1).search('AB123CD', 1.5)
@@ -0,0 +1,40 @@
+"""
+Tiles of the tiled inference mode.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Usage:
+    $ python -m pytest app/tests/test_regions.py
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+pytest.importorskip('torch')
+pytest.importorskip('cv2')
+
+from utils.regions import tile_windows
+
+
+@pytest.mark.parametrize('overlap, count', ((0, 4 * 6), (64, 4 * 7), (608, 49 * 101)))
+def test_tiles_cover_a_4k_frame(overlap, count):
+    tiles = tile_windows((2160, 3840, 3), (640, 640), overlap)
+    assert len(tiles) == count
+    assert all(x2 - x1 == 640 and y2 - y1 == 640 and x2 <= 3840 and y2 <= 2160 for x1, y1, x2, y2 in tiles)
+    assert max(x2 for _, _, x2, _ in tiles) == 3840 and max(y2 for _, _, _, y2 in tiles) == 2160
+
+
+def test_small_frame_single_tile():
+    assert tile_windows((480, 600, 3), (640, 640), 64) == [(0, 0, 600, 480)]
+
+
+@pytest.mark.parametrize('overlap', (640, 700))
+def test_overlap_not_smaller_than_the_tile(overlap):
+    with pytest.raises(ValueError):
+        tile_windows((2160, 3840, 3), (640, 640), overlap)
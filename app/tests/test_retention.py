@@ -0,0 +1,80 @@
+"""
+Retention of the detected folder: packing into segments and reads.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Usage:
+    $ python -m pytest app/tests/test_retention.py
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from utils.layout import Layout
+from utils.retention import INDEX, SEGMENT, Retention
+
+DAY = 86400.0
+
+
+@pytest.fixture(params=(0, 2), ids=('flat', 'sharded'))
+def retention(request, tmp_path):
+    # background passes run at the current time, buckets of the tests are packed by passes a day ahead only
+    return Retention(str(tmp_path / 'detected'), pack_after=DAY, interval=3600, layout=Layout(request.param))
+
+
+def _write(retention, name, content, timestamp):
+    path = retention.path(name, timestamp)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def _packed(retention, bucket):
+    with open(os.path.join(retention.folder, bucket + INDEX)) as f:
+        return [line.split(' ', 2)[2].strip() for line in f]
+
+
+def test_pack_and_read(retention):
+    now = time.time()
+    bucket = retention.bucket(now)
+    paths = [_write(retention, 'lane01_%d.jpg' % i, b'frame %d' % i, now) for i in range(5)]
+    assert retention.enforce(now + 2 * DAY)['packed'] == [bucket]
+    assert not any(os.path.exists(path) for path in paths)
+    assert not os.path.exists(os.path.join(retention.folder, bucket))
+    assert os.path.exists(os.path.join(retention.folder, bucket + SEGMENT))
+    for i in range(5):
+        assert retention.read('%s/lane01_%d.jpg' % (bucket, i)) == b'frame %d' % i
+    assert retention.read('%s/lane01_9.jpg' % bucket) is None
+
+
+def test_name_written_again_after_packing(retention):
+    now = time.time()
+    bucket = retention.bucket(now)
+    _write(retention, 'lane01_a.jpg', b'first', now)
+    retention.enforce(now + 2 * DAY)
+    _write(retention, 'lane01_a.jpg', b'second copy', now)  # a late result under the packed name
+    retention.enforce(now + 2 * DAY)
+    assert len(_packed(retention, bucket)) == 2
+    assert retention.read('%s/lane01_a.jpg' % bucket) == b'second copy'
+
+
+def test_interrupted_pack_is_not_appended_again(retention):
+    now = time.time()
+    bucket = retention.bucket(now)
+    path = _write(retention, 'lane01_a.jpg', b'frame', now)
+    with open(path, 'rb') as f:
+        content = f.read()
+    retention.enforce(now + 2 * DAY)
+    _write(retention, 'lane01_a.jpg', content, now)  # indexed, then the pass crashed before removing it
+    retention.enforce(now + 2 * DAY)
+    assert len(_packed(retention, bucket)) == 1
+    assert os.path.getsize(os.path.join(retention.folder, bucket + SEGMENT)) == len(content)
+    assert retention.read('%s/lane01_a.jpg' % bucket) == b'frame'
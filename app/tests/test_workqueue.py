@@ -0,0 +1,135 @@
+"""
+Frame queue: recovery, scans and claims.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Usage:
+    $ python -m pytest app/tests/test_workqueue.py
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]  # app directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from utils.layout import Layout
+from utils.workqueue import FrameQueue, staging
+
+
+def _touch(path, content=b'frame'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+@pytest.fixture(params=(0, 2), ids=('flat', 'sharded'))
+def layout(request):
+    return Layout(request.param)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    path = tmp_path / 'potential'
+    path.mkdir()
+    return str(path)
+
+
+def test_recover_removes_staged_files(tmp_path, folder, layout):
+    queue = FrameQueue(str(tmp_path / 'frames.db'), layout=layout)
+    staged = [_touch(staging(layout.path(folder, 'a.jpg'))), _touch(staging(os.path.join(folder, 'b.jpg')))]
+    frame = _touch(layout.path(folder, 'c.jpg'))
+    assert queue.recover(folder) == 1
+    assert not any(os.path.exists(path) for path in staged)
+    assert os.path.exists(frame)
+    assert queue.recover(folder) == 0  # nothing left to remove, the frame is known
+
+
+def _finish(queue, fail=False):
+    claimed = queue.claim(10, lease=60)
+    ids = [i for i, _, _ in claimed]
+    return queue.fail(ids, 'inference failed') if fail else queue.complete(ids)  # files left in the folder
+
+
+def test_scan_removes_done_frames(tmp_path, folder, layout):
+    queue = FrameQueue(str(tmp_path / 'frames.db'), layout=layout)
+    path = _touch(layout.path(folder, 'a.jpg'))
+    assert queue.scan(folder, settle=0) == 1
+    assert len(_finish(queue)) == 1
+    assert queue.scan(folder, settle=0) == 0
+    assert not os.path.exists(path)
+
+
+def test_scan_enqueues_reused_names(tmp_path, folder, layout):
+    queue = FrameQueue(str(tmp_path / 'frames.db'), layout=layout)
+    path = _touch(layout.path(folder, 'a.jpg'))
+    queue.scan(folder, settle=0)
+    _finish(queue)
+    time.sleep(0.05)
+    _touch(path, b'new frame')  # copied in under the name of the done frame
+    assert queue.scan(folder, settle=0) == 1
+    assert os.path.exists(path)
+    assert [filename for _, filename, _ in queue.claim(10, lease=60)] == ['a.jpg']
+
+
+def test_scan_quarantines_failed_frames(tmp_path, folder, layout):
+    quarantine = str(tmp_path / 'failed')
+    queue = FrameQueue(str(tmp_path / 'frames.db'), layout=layout, quarantine=quarantine)
+    path = _touch(layout.path(folder, 'a.jpg'))
+    queue.scan(folder, settle=0)
+    assert len(_finish(queue, fail=True)) == 1
+    assert queue.scan(folder, settle=0) == 0
+    assert not os.path.exists(path)
+    assert os.listdir(quarantine) == ['a.jpg']
+    assert queue.counts() == {'failed': 1}
+
+
+def test_claim_oldest_first(tmp_path):
+    queue = FrameQueue(str(tmp_path / 'frames.db'))
+    for name in 'abcde':
+        queue.enqueue(name + '.jpg')
+    assert [filename for _, filename, _ in queue.claim(3, lease=60)] == ['a.jpg', 'b.jpg', 'c.jpg']
+    assert [filename for _, filename, _ in queue.claim(3, lease=60)] == ['d.jpg', 'e.jpg']
+    assert queue.claim(3, lease=60) == []
+    assert queue.depth() == 0
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    queue = FrameQueue(str(tmp_path / 'frames.db'))
+    queue.enqueue('a.jpg')
+    first = queue.claim(1, lease=0.01)
+    time.sleep(0.05)
+    again = queue.claim(1, lease=60)
+    assert [i for i, _, _ in again] == [i for i, _, _ in first]
+    assert queue.complete([i for i, _, _ in again]) == [i for i, _, _ in again]
+    assert queue.counts() == {'done': 1}
+
+
+def test_frame_fails_after_max_attempts(tmp_path):
+    queue = FrameQueue(str(tmp_path / 'frames.db'))
+    queue.enqueue('a.jpg')
+    for _ in range(2):
+        assert len(queue.claim(1, lease=0, max_attempts=2)) == 1
+        time.sleep(0.01)
+    assert queue.claim(1, lease=0, max_attempts=2) == []
+    assert queue.counts() == {'failed': 1}
+
+
+def test_upload_again_while_claimed(tmp_path, folder):
+    queue = FrameQueue(str(tmp_path / 'frames.db'))
+    path = os.path.join(folder, 'a.jpg')
+    queue.enqueue('a.jpg', _touch(staging(path), b'first'), path)
+    (i, _, _), = queue.claim(1, lease=60)
+    queue.enqueue('a.jpg', _touch(staging(path), b'second'), path)  # replaces the claimed row and file
+    assert queue.complete([i], [path]) == []
+    with open(path, 'rb') as f:
+        assert f.read() == b'second'
+    (j, _, _), = queue.claim(1, lease=60)
+    assert queue.complete([j], [path]) == [j]
+    assert not os.path.exists(path)
@@ -26,13 +26,10 @@ from zipfile import ZipFile
 
 import cv2
 import numpy as np
-import pandas as pd
-import pkg_resources as pkg
 import torch
 import torchvision
 import yaml
 
-from utils.downloads import gsutil_getsize
 from utils.metrics import box_iou, fitness
 
 # Settings
@@ -46,7 +43,6 @@ FONT = 'Arial.ttf'  # https://ultralytics.com/assets/Arial.ttf
 
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
-pd.options.display.max_columns = 10
 cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with PyTorch DataLoader)
 os.environ['NUMEXPR_MAX_THREADS'] = str(NUM_THREADS)  # NumExpr max threads
 os.environ['OMP_NUM_THREADS'] = str(NUM_THREADS)  # OpenMP max threads (PyTorch and SciPy)
@@ -310,6 +306,7 @@ def check_python(minimum='3.7.0'):
 
 def check_version(current='0.0.0', minimum='0.0.0', name='version ', pinned=False, hard=False, verbose=False):
     # Check version vs. required version
+    import pkg_resources as pkg  # slow import, only needed on version checks
     current, minimum = (pkg.parse_version(x) for x in (current, minimum))
     result = (current == minimum) if pinned else (current >= minimum)  # bool
     s = f'{name}{minimum} required by YOLOv5, but {name}{current} is currently installed'  # string
@@ -323,6 +320,7 @@ def check_version(current='0.0.0', minimum='0.0.0', name='version ', pinned=Fals
 @try_except
 def check_requirements(requirements=ROOT / 'requirements.txt', exclude=(), install=True, cmds=()):
     # Check installed dependencies meet requirements (pass *.txt file or list of packages)
+    import pkg_resources as pkg
     prefix = colorstr('red', 'bold', 'requirements:')
     check_python()  # check python version
     if isinstance(requirements, (str, Path)):  # requirements.txt file
@@ -836,6 +834,162 @@ def non_max_suppression(prediction,
     return output
 
 
+def non_max_suppression_batched(prediction,
+                                conf_thres=0.25,
+                                iou_thres=0.45,
+                                classes=None,
+                                agnostic=False,
+                                multi_label=False,
+                                max_det=300,
+                                bs=None):
+    """Batched Non-Maximum Suppression (NMS), one torchvision.ops.nms() call for the whole batch on GPU, one per run of
+    images of about max_cpu boxes on CPU, whose kernel is quadratic in the boxes of a call
+
+    Boxes are offset by image index along x and by class along y, in steps just above the range of the boxes, so they
+    never overlap across images or classes while coordinates stay small enough for float32. There is no time limit,
+    output is never truncated.
+
+    Arguments:
+        prediction: (bs,n,5+nc) tensor, or (n,6+nc) candidates [image, xywh, obj, cls] from Detect.conf_thres
+        bs: batch size, required with candidates
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    compact = prediction.ndim == 2  # Detect.conf_thres candidates
+    assert not compact or bs is not None, 'Batch size is required with Detect.conf_thres candidates'
+    bs = bs if compact else prediction.shape[0]  # batch size
+    nc = prediction.shape[-1] - (6 if compact else 5)  # number of classes
+
+    # Checks
+    assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
+    assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
+
+    # Settings
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    max_cpu = 256  # boxes into a single torchvision.ops.nms() call on CPU, whose kernel is quadratic in them
+    multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    if compact:
+        i = prediction[:, 5] > conf_thres  # candidates
+        xi, x = prediction[i, 0].long(), prediction[i, 1:]  # image index, confidence
+    else:
+        xi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image, anchor index of candidates
+        x = prediction[xi, ai]  # confidence
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, xi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), xi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, xi = torch.cat((box, conf, j.float()), 1)[i], xi[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, xi = x[i], xi[i]
+
+    # Keep the max_nms most confident boxes of each image
+    i = x[:, 4].argsort(descending=True)
+    i = i[_group_by_image(xi[i], bs, max_nms)]
+    x, xi = x[i], xi[i]
+
+    # Batched NMS
+    low = x[:, :4].min() if len(x) else 0  # boxes are moved to start at 0
+    span = x[:, :4].max() - low + 1 if len(x) else 1  # offset step, larger than any box coordinate
+    c = x[:, 5:6] * (0 if agnostic else span)  # classes
+    offset = torch.cat((xi[:, None] * span, c), 1).repeat(1, 2) - low  # x by image, y by class
+    boxes, scores = x[:, :4] + offset, x[:, 4]  # boxes (offset by image and class), scores
+    if x.device.type == 'cpu' and x.shape[0] > max_cpu:  # one call per run of whole images of about max_cpu boxes
+        n = torch.bincount(xi, minlength=bs)
+        n = torch.bincount(((n.cumsum(0) - n) // max_cpu)[xi]).tolist()  # boxes per run, x is grouped by image
+        i = torch.cat([j[torchvision.ops.nms(boxes[j], scores[j], iou_thres)] for j in torch.arange(len(x)).split(n)])
+    else:
+        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS, sorted by decreasing score
+    i = i[_group_by_image(xi[i], bs, max_det)]  # limit detections
+
+    x, n = x[i], torch.bincount(xi[i], minlength=bs).cumsum(0).tolist()
+    return [x[a:b] for a, b in zip([0] + n[:-1], n)]  # slices, not split() views, so callers may edit in place
+
+
+def _group_by_image(xi, bs, limit):
+    # Stable sort of score-ordered boxes by image index, keeping the first limit boxes of each image
+    xi, order = torch.sort(xi, stable=True)
+    counts = torch.bincount(xi, minlength=bs)
+    rank = torch.arange(len(xi), device=xi.device) - (counts.cumsum(0) - counts)[xi]  # rank within image
+    return order[rank < limit]
+
+
+def merge_detections(x, iou_thres=0.45, agnostic=False, max_det=300):
+    """Class-aware NMS merge of detections gathered from overlapping crops of the same image
+
+    Arguments:
+        x: (n,6) tensor [xyxy, conf, cls] in image coordinates
+
+    Returns:
+         (n,6) tensor [xyxy, conf, cls]
+    """
+    max_wh = 7680  # (pixels) maximum box width and height
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+    return x[i[:max_det]]
+
+
+def weighted_boxes_fusion(detections, iou_thres=0.55, weights=None, max_det=300):
+    """Weighted Boxes Fusion (WBF) of ensemble member detections https://arxiv.org/abs/1910.13302
+
+    Boxes of the same class overlapping above iou_thres are clustered across members, fused boxes are the
+    confidence-weighted mean of the cluster, fused confidence is lowered when few members agree.
+
+    Arguments:
+        detections: list over members of NMS outputs, lists over images of (n,6) tensors [xyxy, conf, cls]
+        weights: member weights, default equal
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    weights = weights or [1.0] * len(detections)
+    total = sum(weights)
+    output = []
+    for dets in zip(*detections):  # image detections of every member
+        x = torch.cat([torch.cat((d[:, :5], d[:, 4:5] * w, d[:, 5:6]), 1) for d, w in zip(dets, weights)], 0)
+        x = x[x[:, 4].argsort(descending=True)]  # (n,7) [xyxy, conf, weighted conf, cls] by decreasing conf
+        fused, clusters = [], []  # fused boxes (n,5) [xyxy, cls], member rows of each fused box
+        for row in x:
+            j = -1
+            if fused:
+                f = torch.stack(fused)
+                iou = box_iou(row[None, :4], f[:, :4])[0] * (f[:, 4] == row[6])  # same class only
+                j = int(iou.argmax())
+                j = j if iou[j] > iou_thres else -1
+            if j < 0:
+                clusters.append([row])
+                fused.append(row[[0, 1, 2, 3, 6]])
+                continue
+            clusters[j].append(row)
+            c = torch.stack(clusters[j])
+            fused[j][:4] = (c[:, :4] * c[:, 5:6]).sum(0) / c[:, 5].sum()  # weighted conf mean box
+        if fused:
+            f = torch.stack(fused)
+            conf = torch.stack([torch.stack(c)[:, 5].sum() / len(c) * min(len(c), total) / total for c in clusters])
+            fused = torch.cat((f[:, :4], conf[:, None], f[:, 4:]), 1)  # conf rescaled by member agreement
+        else:
+            fused = torch.zeros((0, 6), device=x.device)
+        output.append(fused[fused[:, 4].argsort(descending=True)][:max_det])
+    return output
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -853,6 +1007,9 @@ def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_op
 
 
 def print_mutation(results, hyp, save_dir, bucket, prefix=colorstr('evolve: ')):
+    import pandas as pd  # training-only dependencies, kept off the inference import path
+    from utils.downloads import gsutil_getsize
+    pd.options.display.max_columns = 10
     evolve_csv = save_dir / 'evolve.csv'
     evolve_yaml = save_dir / 'hyp_evolve.yaml'
     keys = ('metrics/precision', 'metrics/recall', 'metrics/mAP_0.5', 'metrics/mAP_0.5:0.95', 'val/box_loss',
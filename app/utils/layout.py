@@ -0,0 +1,92 @@
+"""
+Fan-out layout of the frame folders.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+A flat folder with hundreds of thousands of files slows every lookup, create
+and listing on ext4 and overlayfs. A layout spreads the files over levels of
+nested directories, each named after width hex digits of a hash of the file
+name, i.e. 3f/a2/lane01_frame.jpg for two levels of width 2. The shard only
+depends on the name, so the Writer, the Reader and the result API find a
+file from its name alone, without a lookup table.
+"""
+
+import os
+import hashlib
+
+
+class Layout:
+    """ Hash-sharded directory layout, flat with 0 levels. """
+
+    def __init__(self, levels=0, width=2):
+        """
+            Args:
+                levels(int): nested shard directories, 0 for a flat folder
+                width(int): hex digits per shard directory, 16 ** width entries per level
+
+            Raises:
+                ValueError: levels or width out of range
+        """
+        if not 0 <= levels <= 4:
+            raise ValueError('levels must be in [0, 4], got %r' % levels)
+        if not 1 <= width <= 4:
+            raise ValueError('width must be in [1, 4], got %r' % width)
+        self.levels = int(levels)
+        self.width = int(width)
+
+    def __eq__(self, other):
+        return isinstance(other, Layout) and (self.levels, self.width) == (other.levels, other.width)
+
+    def __repr__(self):
+        return 'Layout(levels=%d, width=%d)' % (self.levels, self.width)
+
+    def shard(self, filename):
+        """
+        It returns the shard directories of a file name, relative to the folder, '' for a flat layout.
+        """
+        if not self.levels:
+            return ''
+        digest = hashlib.blake2b(filename.encode(), digest_size=8).hexdigest()
+        return os.path.join(*(digest[i * self.width:(i + 1) * self.width] for i in range(self.levels)))
+
+    def relative(self, filename):
+        """
+        It returns the path of a file relative to the folder.
+        """
+        return os.path.join(self.shard(filename), filename)
+
+    def path(self, folder, filename, create=False):
+        """ Path of a file in a folder.
+
+            Args:
+                folder(str): root of the layout
+                filename(str): file basename
+                create(bool): create its shard directories, before writing the file
+
+            Returns:
+                (str) path of the file
+        """
+        directory = os.path.join(folder, self.shard(filename))
+        if create and self.levels:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+
+    def entries(self, folder):
+        """ Files stored in a folder with this layout, at the depth of the shards.
+
+            Args:
+                folder(str): root of the layout
+
+            Returns:
+                (generator) os.DirEntry of the files
+        """
+        yield from _entries(folder, self.levels)
+
+
+def _entries(directory, depth):
+    with os.scandir(directory) as it:
+        for e in it:
+            if depth and e.is_dir():
+                yield from _entries(e.path, depth - 1)
+            elif not depth and e.is_file():
+                yield e
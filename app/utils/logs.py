@@ -0,0 +1,95 @@
+"""
+Non-blocking logging of the service.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+The root logger only puts records on an in-memory queue; a listener thread
+formats them and writes them to a size-rotated file, so the inference thread
+never waits on disk. High-frequency events can be sampled per call site:
+
+    logging.debug('Frame %s read', path, extra={'sample': 100})  # one record in 100
+"""
+
+import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+
+# LogRecord attributes, the others come from extra= and are written as fields
+_STANDARD = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample'}
+
+_LISTENER = None
+_LOCK = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record: time, level, logger, thread, location, message and extra fields. """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'file': '%s:%d' % (record.filename, record.lineno),
+            'message': record.getMessage()
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _STANDARD)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """ Keeps one record in n per call site for records logged with extra={'sample': n}. """
+
+    def __init__(self):
+        super().__init__()
+        self.__counts = dict()  # (pathname, lineno): records seen
+
+    def filter(self, record):
+        n = getattr(record, 'sample', 1)
+        if n <= 1:
+            return True
+        key = record.pathname, record.lineno
+        count = self.__counts.get(key, 0)  # races between threads only shift which record is kept
+        self.__counts[key] = count + 1
+        if count % n:
+            return False
+        record.sampled = n  # written as a field, the record stands for n events
+        return True
+
+
+def setup_logging(path, verbosity=False, max_bytes=10 * 1024 * 1024, backup_count=5, structured=True):
+    """ Route the root logger through a queue to a rotating file written by a listener thread.
+    Only the first call configures logging, like logging.basicConfig.
+
+        Args:
+            path(str): log file
+            verbosity(bool): DEBUG level, INFO otherwise
+            max_bytes(int): size the file is rotated at, 0 to never rotate
+            backup_count(int): rotated files kept
+            structured(bool): JSON lines, plain text otherwise
+    """
+    global _LISTENER
+    with _LOCK:
+        if _LISTENER is not None:
+            return
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        if structured:
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter('%(asctime)s %(filename)s:%(lineno)d %(levelname)s - %(message)s',
+                                                   datefmt='%d/%m/%Y %H:%M:%S'))
+        records = queue.SimpleQueue()
+        producer = logging.handlers.QueueHandler(records)
+        producer.addFilter(SampleFilter())
+        root = logging.getLogger()
+        root.addHandler(producer)
+        root.setLevel(logging.DEBUG if verbosity else logging.INFO)
+        _LISTENER = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+        _LISTENER.start()
+        atexit.register(_LISTENER.stop)  # drains the queue
@@ -1,33 +1,212 @@
+"""
+Detection and runtime parameters, read from the detection section of config.yaml.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+"""
+
 import torch
 
+STRIDE = 32  # largest stride of the YOLOv5 P5 models, inference shapes are multiples of it
+
 class Parameters():
+    """ Validated detection parameters.
+    Missing keys take their default, unknown keys and out of range values raise ValueError,
+    so a bad configuration fails at startup or is rejected on reload.
+    """
+
+    # Applied between two batches without touching the model; any other change reloads it in the background
+    HOT = frozenset((
+        'conf_thres', 'max_det', 'prefilter', 'augment', 'hide_conf', 'color', 'rect_thickness', 'rois',
+        'batch_size', 'mode', 'coarse_conf_thres', 'max_candidates', 'fine_min_side', 'fine_context',
+        'tile_overlap', 'ensemble_weights', 'wbf_iou_thres', 'model_watch', 'model_watch_interval', 'records',
+        'trace_export', 'queue_lease', 'queue_max_attempts', 'queue_scan_interval', 'model_dir'
+    ))
+
+    def __init__(self, config):
+        config = dict(config or {})
 
-    def __init__(self, model_path):
         self.weights = 'best.pt'
 
-        self.imgsz = 640
-        self.conf_thres = 0.25
-        self.max_det = 1000
-        self.hide_conf = True
+        self.imgsz = self.__number(config, 'imgsz', 640, int, 32)
+        self.conf_thres = self.__number(config, 'conf_thres', 0.25, float, 0, 1)
+        self.max_det = self.__number(config, 'max_det', 1000, int, 1)
+        self.prefilter = self.__flag(config, 'prefilter', True)  # Detect decodes only the anchors above conf_thres
+        self.augment = self.__flag(config, 'augment', False)  # batched test-time augmentation, flipped and downscaled copies
+        self.grid_cache_size = self.__number(config, 'grid_cache_size', 32, int, 0)  # Detect grids kept per (layer, shape), 0 to disable
+        self.hide_conf = self.__flag(config, 'hide_conf', True)
 
         self.region_threshold = 0.05
 
         self.color_blue = (255, 255, 0)
         self.color_red = (25, 20, 240)
-        self.color = self.color_blue
+        self.color = self.__color(config, 'color', self.color_blue)
         self.text_x_align = 10
         self.inference_time_y = 30
         self.fps_y = 90
         self.analysis_time_y = 60
         self.font_scale = 0.7
         self.thickness = 2
-        self.rect_thickness = 3
+        self.rect_thickness = self.__number(config, 'rect_thickness', 3, int, 1)
 
         self.rect_size=15000
 
-        self.pred_shape = (480, 640, 3)
+        self.pred_shape = self.__shape(config, 'pred_shape', (480, 640))
         self.vis_shape = (800, 600)
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.device = self.__device(config, 'device')
+
+        # model_path may list several checkpoints, inferred as an ensemble
+        self.ensemble_parallel = self.__flag(config, 'ensemble_parallel', True)  # members run concurrently, intra-op threads split among them
+        self.ensemble_fusion = self.__choice(config, 'ensemble_fusion', 'nms', ('nms', 'wbf'))  # 'nms' concatenates member outputs, 'wbf' fuses member detections
+        self.ensemble_weights = self.__weights(config, 'ensemble_weights')  # per member, WBF only
+        self.wbf_iou_thres = self.__number(config, 'wbf_iou_thres', 0.55, float, 0, 1)
 
         # self.model="/home/lcarnevale/Documents/university/project-data/2023__paper-edge_cloud_orchestrator/source/mftnakrsu/Automatic_Number_Plate_Recognition_YOLO_OCR/model/best.pt"
-        self.model = model_path
\ No newline at end of file
+        self.model = self.__model(config, 'model_path')
+        self.model_dir = self.__pop(config, 'model_dir', 'model')  # admin swaps only load models from this directory
+        if not isinstance(self.model_dir, str) or not self.model_dir:
+            raise ValueError('model_dir must be a directory path, got %r' % self.model_dir)
+        self.model_watch = self.__flag(config, 'model_watch', False)  # swap the model in when its files change
+        self.model_watch_interval = self.__number(config, 'model_watch_interval', 5.0, float, 0.1)  # seconds
+
+        # JSON record next to each detected frame, with the detections and the model version
+        self.records = self.__flag(config, 'records', True)
+
+        # JSON lines file the frame spans are appended to, in OTLP JSON form; empty to disable
+        self.trace_export = self.__pop(config, 'trace_export', '')
+        if not isinstance(self.trace_export, str):
+            raise ValueError('trace_export must be a file path, got %r' % self.trace_export)
+
+        # source -> rectangle [x1, y1, x2, y2] or polygon [[x, y], ...] in frame pixels
+        self.rois = self.__rois(config, 'rois')
+
+        # frames read from the potential folder per inference batch
+        self.batch_size = self.__number(config, 'batch_size', 1, int, 1)
+
+        # durable frame queue: claims expire after queue_lease seconds and are retried up to queue_max_attempts times,
+        # frames copied into the folder directly are picked up every queue_scan_interval seconds when idle
+        self.queue_lease = self.__number(config, 'queue_lease', 60.0, float, 1)
+        self.queue_max_attempts = self.__number(config, 'queue_max_attempts', 3, int, 1)
+        self.queue_scan_interval = self.__number(config, 'queue_scan_interval', 5.0, float, 0.1)
+
+        # 'full' single pass at pred_shape, 'cascade' coarse pass then fine pass around candidates,
+        # 'tiled' native resolution pass on overlapping tiles
+        self.mode = self.__choice(config, 'mode', 'full', ('full', 'cascade', 'tiled'))
+        self.coarse_shape = self.__shape(config, 'coarse_shape', (256, 320))
+        self.coarse_conf_thres = self.__number(config, 'coarse_conf_thres', 0.1, float, 0, 1)
+        self.max_candidates = self.__number(config, 'max_candidates', 16, int, 1)  # per frame
+        self.fine_shape = self.__shape(config, 'fine_shape', (320, 320))
+        self.fine_min_side = self.__number(config, 'fine_min_side', 160, int, 1)  # frame pixels, i.e. at most 2x upscaling
+        self.fine_context = self.__number(config, 'fine_context', 3.0, float, 1)
+        self.tile_shape = self.__shape(config, 'tile_shape', (640, 640))
+        self.tile_overlap = self.__number(config, 'tile_overlap', 64, int, 0)  # pixels
+
+        if config:
+            raise ValueError('Unknown detection parameters: %s' % ', '.join(sorted(config)))
+        if -(-self.tile_overlap // STRIDE) * STRIDE >= min(self.tile_shape[:2]):  # as rounded up by the Reader
+            raise ValueError('tile_overlap rounded up to a multiple of %d must be smaller than tile_shape, got %d'
+                             % (STRIDE, self.tile_overlap))
+
+    def changes(self, other):
+        """ Parameters whose value differs in another configuration.
+
+            Args:
+                other(Parameters): new parameters
+
+            Returns:
+                (set) changed attribute names
+        """
+        return {k for k, v in vars(self).items() if vars(other).get(k) != v}
+
+    def needs_reload(self, other):
+        """ Whether switching to other parameters requires loading and warming up the model again.
+
+            Args:
+                other(Parameters): new parameters
+
+            Returns:
+                (bool) True when a changed parameter is not hot-reloadable
+        """
+        return bool(self.changes(other) - self.HOT)
+
+    def __pop(self, config, key, default):
+        value = config.pop(key, None)
+        return default if value is None else value
+
+    def __number(self, config, key, default, kind, low=None, high=None):
+        value = self.__pop(config, key, default)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and value != int(value)):
+            raise ValueError('%s must be %s, got %r' % (key, kind.__name__, value))
+        if (low is not None and value < low) or (high is not None and value > high):
+            raise ValueError('%s must be in [%s, %s], got %r' % (key, low, high, value))
+        return kind(value)
+
+    def __flag(self, config, key, default):
+        value = self.__pop(config, key, default)
+        if not isinstance(value, bool):
+            raise ValueError('%s must be true or false, got %r' % (key, value))
+        return value
+
+    def __choice(self, config, key, default, choices):
+        value = self.__pop(config, key, default)
+        if value not in choices:
+            raise ValueError('%s must be one of %s, got %r' % (key, ', '.join(choices), value))
+        return value
+
+    def __shape(self, config, key, default):
+        value = self.__pop(config, key, default)
+        if not isinstance(value, (list, tuple)) or len(value) != 2 or \
+                not all(isinstance(x, int) and not isinstance(x, bool) and x >= STRIDE and x % STRIDE == 0 for x in value):
+            raise ValueError('%s must be [height, width] in multiples of %d pixels, got %r' % (key, STRIDE, value))
+        return (value[0], value[1], 3)
+
+    def __color(self, config, key, default):
+        value = self.__pop(config, key, default)
+        if not isinstance(value, (list, tuple)) or len(value) != 3 or \
+                not all(isinstance(x, int) and 0 <= x <= 255 for x in value):
+            raise ValueError('%s must be [b, g, r] in [0, 255], got %r' % (key, value))
+        return tuple(value)
+
+    def __device(self, config, key):
+        value = self.__pop(config, key, '')
+        try:
+            return torch.device(value or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+        except RuntimeError as e:
+            raise ValueError('%s: %s' % (key, e))
+
+    def __weights(self, config, key):
+        value = self.__pop(config, key, None)
+        if value is not None and (not isinstance(value, list) or
+                                  not all(isinstance(x, (int, float)) and x > 0 for x in value)):
+            raise ValueError('%s must be a list of positive numbers, got %r' % (key, value))
+        return value
+
+    def __model(self, config, key):
+        if key not in config:
+            raise ValueError('%s is required' % key)
+        value = config.pop(key)
+        paths = value if isinstance(value, list) else [value]
+        if not paths or not all(isinstance(x, str) and x for x in paths):
+            raise ValueError('%s must be a path or a list of paths, got %r' % (key, value))
+        if self.ensemble_weights is not None and len(self.ensemble_weights) != len(paths):
+            raise ValueError('ensemble_weights must have one weight per model, got %r' % self.ensemble_weights)
+        return value
+
+    def __rois(self, config, key):
+        value = self.__pop(config, key, {})
+        if not isinstance(value, dict):
+            raise ValueError('%s must map a source to a rectangle or polygon, got %r' % (key, value))
+        for source, roi in value.items():
+            if not (self.__is_rectangle(roi) or self.__is_polygon(roi)):
+                raise ValueError('%s.%s must be [x1, y1, x2, y2] or [[x, y], ...], got %r' % (key, source, roi))
+        return value
+
+    def __is_rectangle(self, roi):
+        return isinstance(roi, list) and len(roi) == 4 and all(self.__is_coordinate(x) for x in roi) and \
+            roi[2] > roi[0] and roi[3] > roi[1]
+
+    def __is_polygon(self, roi):
+        return isinstance(roi, list) and len(roi) >= 3 and \
+            all(isinstance(p, list) and len(p) == 2 and all(self.__is_coordinate(x) for x in p) for p in roi)
+
+    def __is_coordinate(self, x):
+        return isinstance(x, (int, float)) and not isinstance(x, bool) and x >= 0
@@ -0,0 +1,133 @@
+"""
+Fuzzy plate search, tolerant to OCR confusions.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Plates are compared with an edit distance where substituting characters OCR
+often confuses (0/O, 8/B, 1/I, ...) costs less than other edits. The index maps
+every confusable character to one representative, so that confusions are free,
+and keys each plate by the strings left after deleting up to depth characters.
+Two plates within distance r share such a key when r <= depth, so a search
+only looks up the keys of the query and checks the few plates found with the
+real distance, whatever the number of plates indexed.
+"""
+
+import threading
+
+CONFUSIONS = ('0O', '0D', '0Q', '8B', '1I', '1L', '5S', '2Z', '6G', '7T')
+EPS = 1e-9  # float sums of confusion costs
+
+
+class ConfusionDistance:
+    """ Edit distance with cheaper substitutions between confusable characters. """
+
+    def __init__(self, confusions=CONFUSIONS, cost=0.5):
+        """
+            Args:
+                confusions(list): groups of characters confused with each other, i.e. '0O'
+                cost(float): cost of a substitution within a group, in [0.5, 1]
+
+            Raises:
+                ValueError: cost out of range
+        """
+        if not 0.5 <= cost <= 1:
+            raise ValueError('confusion cost must be in [0.5, 1], got %r' % cost)  # below 0.5 it is not a metric
+        self.cost = cost
+        self.__pairs = {(a, b) for group in confusions for a in group.upper() for b in group.upper() if a != b}
+        representative = dict()  # character: representative of its confusion class, classes sharing a character merged
+        for group in confusions:
+            roots = {representative.get(c, c) for c in group.upper()}
+            root = min(roots)
+            for c, r in list(representative.items()) + [(c, c) for c in group.upper()]:
+                if r in roots:
+                    representative[c] = root
+        self.__canonical = str.maketrans(representative)
+
+    def canonical(self, plate):
+        """
+        It returns the plate with every confusable character replaced by the representative of its class.
+        """
+        return plate.translate(self.__canonical)
+
+    def __call__(self, a, b):
+        if len(a) < len(b):
+            a, b = b, a
+        previous = [float(j) for j in range(len(b) + 1)]
+        for i, ca in enumerate(a, 1):
+            current = [float(i)]
+            for j, cb in enumerate(b, 1):
+                substitution = 0 if ca == cb else self.cost if (ca, cb) in self.__pairs else 1
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + substitution))
+            previous = current
+        return previous[-1]
+
+
+class PlateIndex:
+    """ Deletion neighbourhood index of plate strings, updated incrementally and searched by distance. """
+
+    def __init__(self, distance=None, depth=1):
+        """
+            Args:
+                distance(ConfusionDistance): plate distance, default confusions and cost
+                depth(int): characters deleted per key, the largest search radius; memory grows as length ** depth
+        """
+        self.distance = distance or ConfusionDistance()
+        self.depth = depth
+        self.__keys = dict()  # deletion key: plate, or list of plates
+        self.__plates = set()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__plates)
+
+    def add(self, plate):
+        """ Index a plate, once.
+
+            Args:
+                plate(str): normalized plate text
+        """
+        with self.__lock:
+            if plate in self.__plates:
+                return
+            self.__plates.add(plate)
+            for key in _deletions(self.distance.canonical(plate), self.depth):
+                found = self.__keys.get(key)
+                if found is None:
+                    self.__keys[key] = plate  # most keys belong to one plate, no list
+                elif isinstance(found, str):
+                    self.__keys[key] = [found, plate]
+                else:
+                    found.append(plate)
+
+    def search(self, plate, radius=1.0):
+        """ Indexed plates within a distance.
+
+            Args:
+                plate(str): normalized plate text
+                radius(float): maximum distance, inclusive, up to depth
+
+            Returns:
+                (list) (distance, plate), closest first
+
+            Raises:
+                ValueError: radius larger than the index depth
+        """
+        if radius > self.depth + EPS:
+            raise ValueError('radius must be at most %d, got %r' % (self.depth, radius))
+        candidates = set()
+        with self.__lock:
+            for key in _deletions(self.distance.canonical(plate), int(radius + EPS)):
+                found = self.__keys.get(key)
+                if found is not None:
+                    candidates.update([found] if isinstance(found, str) else found)
+        found = [(self.distance(plate, p), p) for p in candidates]
+        return sorted((d, p) for d, p in found if d <= radius + EPS)
+
+
+def _deletions(s, n):
+    # s and every string left by deleting up to n of its characters
+    level, keys = {s}, {s}
+    for _ in range(n):
+        level = {x[:i] + x[i + 1:] for x in level for i in range(len(x))}
+        keys |= level
+    return keys
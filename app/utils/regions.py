@@ -0,0 +1,163 @@
+"""
+Region utilities for serving inference on parts of a frame.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+"""
+
+import cv2
+import numpy as np
+
+from utils.general import check_img_size
+
+
+def roi_bounds(roi, shape):
+    """ Bounding rectangle of a region of interest, clipped to the frame.
+
+        Args:
+            roi(list): rectangle [x1, y1, x2, y2] or polygon [[x, y], ...]
+            shape(tuple): frame shape (height, width, ...)
+
+        Returns:
+            (tuple) x1, y1, x2, y2 integer pixel bounds
+    """
+    h, w = shape[:2]
+    if is_polygon(roi):
+        points = np.array(roi, dtype=np.float32)
+        x1, y1 = points.min(0)
+        x2, y2 = points.max(0)
+    else:
+        x1, y1, x2, y2 = roi
+    x1, x2 = int(np.clip(x1, 0, w)), int(np.clip(x2, 0, w))
+    y1, y2 = int(np.clip(y1, 0, h)), int(np.clip(y2, 0, h))
+    assert x2 > x1 and y2 > y1, f'Empty region of interest {roi} for frame {w}x{h}'
+    return x1, y1, x2, y2
+
+
+def is_polygon(roi):
+    return len(roi) > 0 and isinstance(roi[0], (list, tuple))
+
+
+def crop_roi(im, roi, color=(114, 114, 114)):
+    """ Crop a frame to its region of interest.
+    Pixels outside a polygon are filled with the letterbox color, so the model sees nothing there.
+
+        Args:
+            im(numpy.ndarray): HWC frame
+            roi(list): rectangle [x1, y1, x2, y2] or polygon [[x, y], ...]
+            color(tuple): fill color outside the polygon
+
+        Returns:
+            (numpy.ndarray, tuple) cropped image and its (x, y) offset in the frame
+    """
+    x1, y1, x2, y2 = roi_bounds(roi, im.shape)
+    crop = im[y1:y2, x1:x2]
+    if is_polygon(roi):
+        mask = np.zeros(crop.shape[:2], dtype=np.uint8)
+        points = np.round(np.array(roi, dtype=np.float32) - (x1, y1)).astype(np.int32)
+        cv2.fillPoly(mask, [points], 255)
+        crop = crop.copy()
+        crop[mask == 0] = color
+    return crop, (x1, y1)
+
+
+def inference_shape(shape, max_shape, stride=32):
+    """ Smallest stride-aligned inference shape that keeps the crop aspect ratio within max_shape.
+
+        Args:
+            shape(tuple): crop shape (height, width, ...)
+            max_shape(tuple): upper bound (height, width, ...), i.e. Parameters.pred_shape
+            stride(int): model max stride
+
+        Returns:
+            (list) inference [height, width], multiple of stride
+    """
+    h, w = shape[:2]
+    gain = min(max_shape[0] / h, max_shape[1] / w, 1.0)  # only scale down
+    return check_img_size([max(round(h * gain), 1), max(round(w * gain), 1)], s=stride)
+
+
+def scale_boxes(boxes, from_shape, to_shape, offset=(0, 0)):
+    """ Map xyxy boxes predicted on a resized crop back to frame coordinates, in place.
+
+        Args:
+            boxes(torch.Tensor): (n, 4+) xyxy boxes in inference space
+            from_shape(tuple): inference shape (height, width)
+            to_shape(tuple): crop shape (height, width) before resizing
+            offset(tuple): crop (x, y) offset in the frame
+
+        Returns:
+            (torch.Tensor) boxes in frame coordinates
+    """
+    boxes[:, [0, 2]] *= to_shape[1] / from_shape[1]
+    boxes[:, [1, 3]] *= to_shape[0] / from_shape[0]
+    return translate_boxes(boxes, offset)
+
+
+def translate_boxes(boxes, offset):
+    """ Shift xyxy boxes by a crop (x, y) offset, in place.
+
+        Args:
+            boxes(torch.Tensor): (n, 4+) xyxy boxes
+            offset(tuple): crop (x, y) offset in the frame
+
+        Returns:
+            (torch.Tensor) shifted boxes
+    """
+    if offset[0] or offset[1]:
+        boxes[:, [0, 2]] += offset[0]
+        boxes[:, [1, 3]] += offset[1]
+    return boxes
+
+
+def candidate_windows(boxes, shape, min_side, context=3.0):
+    """ Square windows around coarse candidates for the fine detection pass.
+    Each window is the candidate box grown by context, never smaller than min_side so
+    the upscaling stays bounded, and shifted to lie inside the frame.
+
+        Args:
+            boxes(torch.Tensor): (n, 4+) xyxy candidate boxes in frame coordinates
+            shape(tuple): frame shape (height, width, ...)
+            min_side(int): minimum window side in frame pixels
+            context(float): window side over the longest candidate side
+
+        Returns:
+            (list) x1, y1, x2, y2 integer window bounds
+    """
+    h, w = shape[:2]
+    windows = []
+    for x1, y1, x2, y2 in boxes[:, :4].tolist():
+        side = int(min(max(max(x2 - x1, y2 - y1) * context, min_side), h, w))
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        wx = int(np.clip(round(cx - side / 2), 0, w - side))
+        wy = int(np.clip(round(cy - side / 2), 0, h - side))
+        windows.append((wx, wy, wx + side, wy + side))
+    return windows
+
+
+def tile_windows(shape, tile_shape, overlap):
+    """ Overlapping tiles covering a frame at native resolution.
+    Tiles start on multiples of the tile step, the last one of each row and column is
+    aligned to the frame border; frames smaller than a tile get a single, smaller tile.
+
+        Args:
+            shape(tuple): frame shape (height, width, ...)
+            tile_shape(tuple): tile (height, width), multiple of the model stride
+            overlap(int): overlap between neighbouring tiles in pixels, multiple of the model stride
+
+        Returns:
+            (list) x1, y1, x2, y2 integer tile bounds
+
+        Raises:
+            ValueError: overlap not smaller than the tile
+    """
+    if overlap >= min(tile_shape[:2]):
+        raise ValueError('tile overlap %d must be smaller than the tile %r' % (overlap, tuple(tile_shape[:2])))
+
+    def starts(length, tile):
+        if length <= tile:
+            return [0]
+        return list(range(0, length - tile, tile - overlap)) + [length - tile]
+
+    h, w = shape[:2]
+    th, tw = tile_shape[:2]
+    return [(x, y, x + min(tw, w), y + min(th, h)) for y in starts(h, th) for x in starts(w, tw)]
@@ -0,0 +1,331 @@
+"""
+Retention of the detected folder: time buckets, packing and quotas.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Results are written in one subdirectory per time bucket, named after its UTC
+start, i.e. 20231015-1400, so no directory grows with the service uptime;
+within a bucket, files are spread over the shards of a Layout.
+A background thread packs the buckets older than pack_after into an
+append-only segment file, the concatenated files, with a text index of
+'offset length name' lines next to it, and removes the files. Whole buckets,
+directories or segments, are deleted when older than max_age or, oldest
+first, while the folder is over max_bytes. A pass only lists the buckets
+still being written, the size of the others is kept from an earlier pass.
+"""
+
+import os
+import time
+import shutil
+import logging
+import calendar
+import threading
+from collections import OrderedDict
+from utils.layout import Layout
+
+BUCKET_FORMAT = '%Y%m%d-%H%M'
+SEGMENT, INDEX = '.seg', '.idx'
+CACHED_INDEXES = 16  # segment indexes kept in memory for reads
+SETTLE = 600.0  # seconds after its end a bucket is no longer written, but by retried frames
+
+
+class Retention:
+    """ Time-bucketed layout of the detected folder, with packing into segments and age and size quotas. """
+
+    def __init__(self, folder, bucket_seconds=3600, pack_after=86400.0, max_age=0.0, max_bytes=0, interval=60.0,
+                 layout=None):
+        """
+            Args:
+                folder(str): detected folder
+                bucket_seconds(int): time span of a bucket, a multiple of 60 dividing a day
+                pack_after(float): seconds after its end a bucket is packed into a segment, 0 to never pack
+                max_age(float): seconds after its end a bucket is deleted, 0 to keep it
+                max_bytes(int): size of the folder over which the oldest buckets are deleted, 0 for no quota
+                interval(float): seconds between retention passes
+                layout(Layout): layout of the files within a bucket, flat by default
+
+            Raises:
+                ValueError: argument out of range
+        """
+        if bucket_seconds < 60 or bucket_seconds % 60 or 86400 % bucket_seconds:
+            raise ValueError('bucket_seconds must be a multiple of 60 dividing a day, got %r' % bucket_seconds)
+        for name, value in (('pack_after', pack_after), ('max_age', max_age), ('max_bytes', max_bytes)):
+            if value < 0:
+                raise ValueError('%s must be at least 0, got %r' % (name, value))
+        if interval <= 0:
+            raise ValueError('interval must be positive, got %r' % interval)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.bucket_seconds = int(bucket_seconds)
+        self.pack_after = pack_after
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.__interval = interval
+        self.__layout = layout or Layout()
+        self.__lock = threading.Lock()  # segment index cache
+        self.__pass_lock = threading.Lock()  # one retention pass at a time
+        self.__sizes = dict()  # bucket: (scanned unix time, bytes), not scanned again once scanned after it settled
+        self.__bytes = 0
+        self.__indexes = OrderedDict()  # bucket: {name: (offset, length)}, least recently read first
+        self.__thread = threading.Thread(target=self.__retention_job, daemon=True, name='retention')
+        self.__thread.start()
+
+    def bucket(self, timestamp):
+        """
+        It returns the name of the bucket of a unix time.
+        """
+        return bucket_name(timestamp, self.bucket_seconds)
+
+    def path(self, filename, timestamp):
+        """ Path a result is written to, its bucket and shard directories created if needed.
+
+            Args:
+                filename(str): result basename
+                timestamp(float): unix time of the frame
+
+            Returns:
+                (str) path in the bucket of the frame
+        """
+        path = os.path.join(self.folder, self.bucket(timestamp), self.__layout.relative(filename))
+        os.makedirs(os.path.dirname(path), exist_ok=True)  # a system call per frame, the bucket may have been deleted
+        return path
+
+    def read(self, name):
+        """ Content of a result, from its bucket directory or from the segment it was packed into.
+
+            Args:
+                name(str): path relative to the folder, i.e. 20231015-1400/3f/a2/lane01_frame.jpg, or bucket and
+                    basename only, i.e. 20231015-1400/lane01_frame.jpg
+
+            Returns:
+                (bytes) content, None when not found
+
+            Raises:
+                ValueError: name outside the folder
+        """
+        name = os.path.normpath(name)
+        if os.path.isabs(name) or name.split(os.sep, 1)[0] in ('..', '.') or os.sep not in name:
+            raise ValueError('not a result name: %r' % name)
+        bucket, member = name.split(os.sep, 1)
+        if os.sep not in member:
+            name = os.path.join(bucket, self.__layout.relative(member))
+        try:
+            with open(os.path.join(self.folder, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        entry = self.__index(bucket).get(os.path.relpath(name, bucket).replace(os.sep, '/'))
+        if entry is None:
+            return None
+        try:
+            with open(os.path.join(self.folder, bucket + SEGMENT), 'rb') as f:
+                f.seek(entry[0])
+                return f.read(entry[1])
+        except FileNotFoundError:  # deleted meanwhile
+            return None
+
+    def size(self):
+        """
+        It returns the bytes kept in the folder at the last retention pass, files and segments.
+        """
+        return self.__bytes
+
+    def enforce(self, now=None):
+        """ One retention pass: pack the old buckets, then delete the expired ones and the oldest over quota.
+
+            Args:
+                now(float): unix time, the current one by default
+
+            Returns:
+                (dict) buckets packed and deleted, bytes kept
+        """
+        with self.__pass_lock:
+            return self.__enforce(time.time() if now is None else now)
+
+    def __enforce(self, now):
+        packed, deleted = [], []
+        buckets = self.__buckets()
+        for bucket, (start, directory) in sorted(buckets.items()):
+            end = start + self.bucket_seconds
+            if self.max_age and end + self.max_age < now:
+                self.__delete(bucket)
+                deleted.append(bucket)
+            elif directory and self.pack_after and end + self.pack_after < now:
+                self.__pack(bucket)
+                packed.append(bucket)
+        sizes = [(bucket, self.__size(bucket, start + self.bucket_seconds, now))
+                 for bucket, (start, _) in sorted(buckets.items()) if bucket not in deleted]
+        total = sum(size for _, size in sizes)
+        if self.max_bytes:
+            for bucket, size in sizes[:-1]:  # the newest bucket is being written, never deleted
+                if total <= self.max_bytes:
+                    break
+                self.__delete(bucket)
+                deleted.append(bucket)
+                total -= size
+            if total > self.max_bytes:
+                logging.warning('Retention: the current bucket alone is over max_bytes, %d bytes' % total)
+        self.__bytes = total
+        if packed or deleted:
+            logging.info('Retention: packed %s, deleted %s, %d bytes kept' % (packed, deleted, total))
+        return {'packed': packed, 'deleted': deleted, 'bytes': total}
+
+    def __buckets(self):
+        """
+        It returns the buckets of the folder, directories or segments, bucket: (start unix time, has a directory).
+        """
+        buckets = dict()
+        for e in os.scandir(self.folder):
+            name, extension = os.path.splitext(e.name)
+            if e.is_dir():
+                name, extension = e.name, ''
+            elif extension not in (SEGMENT, INDEX):
+                continue  # flat results of an older layout, not managed
+            start = bucket_start(name)
+            if start is None:
+                continue
+            buckets[name] = start, buckets.get(name, (start, False))[1] or e.is_dir()
+        return buckets
+
+    def __size(self, bucket, end, now):
+        directory = os.path.join(self.folder, bucket)
+        size = 0
+        for extension in (SEGMENT, INDEX):
+            try:
+                size += os.path.getsize(directory + extension)
+            except FileNotFoundError:
+                pass
+        if not os.path.isdir(directory):
+            self.__sizes.pop(bucket, None)
+            return size
+        cached = self.__sizes.get(bucket)
+        if cached is None or cached[0] < end + SETTLE:  # results of the bucket may still be written
+            cached = self.__sizes[bucket] = now, sum(os.path.getsize(path) for path, _ in _files(directory))
+        return size + cached[1]
+
+    def __pack(self, bucket):
+        """ Append the files of a bucket directory to its segment, then remove them.
+        The segment is synced before the index and the index before the files are removed, so a crash at
+        any point leaves every file either in the directory or in the segment; files already indexed with
+        the same content, by an interrupted pass, are only removed. A file written again after its name was
+        packed is appended again, the last index entry of a name is the one read.
+        """
+        directory = os.path.join(self.folder, bucket)
+        indexed = self.__load_index(bucket)
+        files = list(_files(directory))
+        entries = []
+        with open(directory + SEGMENT, 'ab') as segment, open(directory + SEGMENT, 'rb') as packed:
+            offset = segment.tell()
+            for path, name in files:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                entry = indexed.get(name)
+                if entry is not None and entry[1] == len(data):
+                    packed.seek(entry[0])
+                    if packed.read(entry[1]) == data:
+                        continue
+                segment.write(data)
+                entries.append((offset, len(data), name))
+                offset += len(data)
+            segment.flush()
+            os.fsync(segment.fileno())
+        with open(directory + INDEX, 'a+') as index:
+            if index.tell():
+                index.seek(index.tell() - 1)
+                if index.read(1) != '\n':
+                    index.write('\n')  # ends a line torn by a crash, skipped when loaded
+            index.writelines('%d %d %s\n' % entry for entry in entries)
+            index.flush()
+            os.fsync(index.fileno())
+        with self.__lock:
+            self.__indexes.pop(bucket, None)
+        for path, _ in files:
+            os.remove(path)
+        for root, _, _ in sorted(os.walk(directory), reverse=True):  # deepest first
+            try:
+                os.rmdir(root)
+            except OSError:  # a late result was written meanwhile, packed at the next pass
+                pass
+
+    def __delete(self, bucket):
+        directory = os.path.join(self.folder, bucket)
+        with self.__lock:
+            self.__indexes.pop(bucket, None)
+        for extension in (INDEX, SEGMENT):
+            if os.path.exists(directory + extension):
+                os.remove(directory + extension)
+        shutil.rmtree(directory, ignore_errors=True)
+        self.__sizes.pop(bucket, None)
+
+    def __index(self, bucket):
+        with self.__lock:
+            index = self.__indexes.get(bucket)
+            if index is not None:
+                self.__indexes.move_to_end(bucket)
+                return index
+        index = self.__load_index(bucket)
+        with self.__lock:
+            self.__indexes[bucket] = index
+            while len(self.__indexes) > CACHED_INDEXES:
+                self.__indexes.popitem(last=False)
+        return index
+
+    def __load_index(self, bucket):
+        index = dict()
+        try:
+            with open(os.path.join(self.folder, bucket + INDEX)) as f:
+                for line in f:
+                    try:
+                        offset, length, name = line.rstrip('\n').split(' ', 2)
+                        index[name] = int(offset), int(length)  # a name packed again, the last copy wins
+                    except ValueError:  # a line torn by a crash, its files were not removed
+                        continue
+        except FileNotFoundError:
+            pass
+        return index
+
+    def __retention_job(self):
+        while True:
+            try:
+                self.enforce()
+            except OSError as e:
+                logging.error('Retention pass failed: %s' % e)
+            time.sleep(self.__interval)
+
+
+def bucket_name(timestamp, bucket_seconds):
+    """ Name of the bucket of a unix time, its UTC start.
+
+        Args:
+            timestamp(float): unix time
+            bucket_seconds(int): time span of a bucket
+
+        Returns:
+            (str) bucket name, i.e. 20231015-1400
+    """
+    start = int(timestamp) - int(timestamp) % bucket_seconds
+    return time.strftime(BUCKET_FORMAT, time.gmtime(start))
+
+
+def bucket_start(name):
+    """ Start of a bucket.
+
+        Args:
+            name(str): bucket name
+
+        Returns:
+            (int) unix time, None when name is not a bucket name
+    """
+    try:
+        return calendar.timegm(time.strptime(name, BUCKET_FORMAT))
+    except ValueError:
+        return None
+
+
+def _files(directory):
+    # (path, name relative to the directory with '/' separators) of the files under a directory
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            yield path, os.path.relpath(path, directory).replace(os.sep, '/')
@@ -0,0 +1,148 @@
+"""
+On-demand sampling profiler of the service threads.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Nothing runs until a profile is requested: the requesting thread then wakes
+up every interval, reads the stack of every other thread with
+sys._current_frames() and counts the stacks. The interval is stretched when
+a sample costs more than the overhead budget, so sampling never takes more
+than that share of one core.
+"""
+
+import sys
+import time
+import threading
+from collections import Counter
+
+MAX_SECONDS = 300.0  # longest profile
+MAX_DEPTH = 128  # deepest stack recorded, innermost frames kept
+OVERHEAD = 0.01  # share of one core spent sampling, at most
+
+
+class Sampler:
+    """ Wall clock stack sampler of the threads of this process, one profile at a time. """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+
+    def profile(self, seconds, interval=0.01):
+        """ Sample the stacks of all the other threads.
+
+            Args:
+                seconds(float): profile duration, up to MAX_SECONDS
+                interval(float): seconds between samples, in [0.001, 1]
+
+            Returns:
+                (Profile) sampled stacks
+
+            Raises:
+                ValueError: duration or interval out of range
+                RuntimeError: a profile is already running
+        """
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError('seconds must be in (0, %s], got %r' % (MAX_SECONDS, seconds))
+        if not 0.001 <= interval <= 1:
+            raise ValueError('interval must be in [0.001, 1], got %r' % interval)
+        if not self.__lock.acquire(blocking=False):
+            raise RuntimeError('a profile is already running')
+        try:
+            return self.__sample(seconds, interval)
+        finally:
+            self.__lock.release()
+
+    def __sample(self, seconds, interval):
+        own = threading.get_ident()
+        profile = Profile(interval)
+        start = last = time.monotonic()
+        delay = interval
+        while last - start < seconds:
+            time.sleep(delay)
+            t = time.monotonic()
+            profile.add(sys._current_frames(), own, t - last)
+            last = time.monotonic()
+            delay = max(interval, (last - t) / OVERHEAD)  # stretch the interval when sampling gets expensive
+        profile.duration = last - start
+        return profile
+
+
+class Profile:
+    """ Sampled stacks per thread, exported as collapsed stacks or as a speedscope file. """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.duration = 0.0
+        self.samples = 0
+        self.stacks = Counter()  # (thread, frames root first): samples
+        self.weights = Counter()  # (thread, frames root first): seconds
+        self.__names = dict()  # thread ident: name
+        self.__frames = dict()  # code object: (function, file, line)
+
+    def add(self, frames, own, elapsed):
+        """ Count one sample.
+
+            Args:
+                frames(dict): thread ident: innermost frame, from sys._current_frames()
+                own(int): ident of the sampling thread, skipped
+                elapsed(float): seconds since the previous sample, the weight of this one
+        """
+        if frames.keys() - self.__names.keys():  # new threads
+            self.__names.update((t.ident, t.name) for t in threading.enumerate())
+            self.__names.update((i, 'thread-%d' % i) for i in frames.keys() - self.__names.keys())  # not from threading
+        for ident, frame in frames.items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                key = self.__frames.get(code)
+                if key is None:
+                    key = self.__frames[code] = (code.co_name, code.co_filename, code.co_firstlineno)
+                stack.append(key)
+                frame = frame.f_back
+            key = self.__names[ident], tuple(reversed(stack))
+            self.stacks[key] += 1
+            self.weights[key] += elapsed
+        self.samples += 1
+
+    def collapsed(self):
+        """ Collapsed stacks, the input of flamegraph.pl and speedscope.
+
+            Returns:
+                (str) one 'thread;frame;...;frame count' line per distinct stack, root first
+        """
+        lines = ['%s;%s %d' % (thread, ';'.join('%s (%s:%d)' % f for f in stack), n)
+                 for (thread, stack), n in sorted(self.stacks.items())]
+        return '\n'.join(lines) + '\n'
+
+    def speedscope(self, name='license-plate-detection'):
+        """ Speedscope file, one sampled profile per thread, weighted in seconds.
+
+            Args:
+                name(str): profile name
+
+            Returns:
+                (dict) JSON document, https://www.speedscope.app/file-format-schema.json
+        """
+        frames, index, profiles = [], dict(), dict()
+        for (thread, stack), weight in sorted(self.weights.items()):
+            samples = []
+            for f in stack:
+                if f not in index:
+                    index[f] = len(frames)
+                    frames.append({'name': f[0], 'file': f[1], 'line': f[2]})
+                samples.append(index[f])
+            p = profiles.setdefault(thread, {'type': 'sampled', 'name': thread, 'unit': 'seconds', 'startValue': 0,
+                                             'endValue': round(self.duration, 6), 'samples': [], 'weights': []})
+            p['samples'].append(samples)
+            p['weights'].append(round(weight, 6))
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'anpr sampler',
+            'shared': {'frames': frames},
+            'profiles': list(profiles.values())
+        }
+
+
+SAMPLER = Sampler()
@@ -0,0 +1,248 @@
+"""
+Store of the detected boxes, for lookups by plate, source and time.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+One row per box in a local SQLite database in WAL mode, indexed on
+(plate, time) and (source, time), with an optional in-memory fuzzy index of
+the plate texts. The Reader hands rows over through an
+in-memory queue; a writer thread inserts everything queued in one transaction,
+so the inference thread never waits on the database. Queries run on their own
+read connection per thread, alongside the writer.
+"""
+
+import os
+import queue
+import sqlite3
+import logging
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    time REAL NOT NULL,
+    x1 REAL NOT NULL,
+    y1 REAL NOT NULL,
+    x2 REAL NOT NULL,
+    y2 REAL NOT NULL,
+    conf REAL NOT NULL,
+    class TEXT NOT NULL,
+    plate TEXT,
+    image TEXT NOT NULL,
+    model TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_plate ON detections (plate, time);
+CREATE INDEX IF NOT EXISTS detections_source ON detections (source, time);
+CREATE INDEX IF NOT EXISTS detections_time ON detections (time);
+"""
+
+COLUMNS = ('id', 'source', 'time', 'x1', 'y1', 'x2', 'y2', 'conf', 'class', 'plate', 'image', 'model')
+
+MAX_LIMIT = 10000  # rows per query
+MAX_PLATES = 500  # closest plates looked up per fuzzy query
+
+
+class DetectionStore:
+    """ Boxes of the detected frames, written in batches and queried by plate, prefix, source and time. """
+
+    def __init__(self, path, max_batch=4096, index=None):
+        """
+            Args:
+                path(str): database file
+                max_batch(int): rows inserted per transaction, at most
+                index(PlateIndex): fuzzy search index of the stored plates, None to disable fuzzy()
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.__path = path
+        self.__max_batch = max_batch
+        self.__index = index
+        db = self.__connect()
+        db.executescript(SCHEMA)
+        db.close()
+        self.__rows = queue.SimpleQueue()
+        self.__local = threading.local()
+        self.__writer = threading.Thread(target=self.__writer_job, daemon=True, name='detection-store')
+        self.__writer.start()
+
+    def add(self, source, timestamp, det, names, image, model=None, plates=None):
+        """ Queue the boxes of a frame for insertion, without waiting.
+
+            Args:
+                source(str): camera name
+                timestamp(float): unix time of the frame
+                det(torch.Tensor): (n, 6) detections [xyxy, conf, cls] in frame coordinates
+                names(list): class names
+                image(str): path of the annotated frame
+                model(str): version tag of the model
+                plates(list): plate text per box, None when not read
+        """
+        plates = plates or [None] * len(det)
+        for (x1, y1, x2, y2, conf, cls), plate in zip(det.tolist(), plates):
+            self.__rows.put((source, timestamp, round(x1, 1), round(y1, 1), round(x2, 1), round(y2, 1),
+                             round(conf, 4), names[int(cls)], normalize(plate), image, model))
+
+    def set_plates(self, plates):
+        """ Record the plate text read from stored boxes, i.e. by an OCR stage.
+
+            Args:
+                plates(list): (box id, plate text)
+        """
+        plates = [(normalize(p), i) for i, p in plates]
+        db = self.__reader()
+        with db:
+            db.executemany('UPDATE detections SET plate = ? WHERE id = ?', plates)
+        self.__index_plates(p for p, _ in plates)
+
+    def exact(self, plate, since=None, until=None, source=None, limit=100):
+        """ Boxes of a plate, latest first.
+
+            Args:
+                plate(str): plate text, spaces and dashes are ignored
+                since(float): unix time, inclusive
+                until(float): unix time, exclusive
+                source(str): camera name
+                limit(int): maximum number of rows
+
+            Returns:
+                (list) rows as dicts
+        """
+        plate = normalize(plate)
+        if plate is None:
+            raise ValueError('plate is empty')
+        return self.__query('plate = ?', [plate], since, until, source, limit)
+
+    def prefix(self, prefix, since=None, until=None, source=None, limit=100):
+        """
+        It returns the boxes of the plates starting with prefix, latest first; arguments as in exact().
+        """
+        prefix = normalize(prefix)
+        if prefix is None:
+            raise ValueError('prefix is empty')
+        return self.__query('plate >= ? AND plate < ?', [prefix, prefix + '\uffff'], since, until, source, limit)
+
+    def fuzzy(self, plate, distance=1.0, since=None, until=None, source=None, limit=100):
+        """ Boxes of the plates within a confusion-aware edit distance, closest plates first, then latest first.
+
+            Args:
+                plate(str): plate text, spaces and dashes are ignored
+                distance(float): maximum distance, a confusion such as 0/O costs less than 1
+                since(float): unix time, inclusive
+                until(float): unix time, exclusive
+                source(str): camera name
+                limit(int): maximum number of rows
+
+            Returns:
+                (list) rows as dicts, with the distance of their plate
+
+            Raises:
+                ValueError: empty plate, no index, or distance over the index depth
+        """
+        plate = normalize(plate)
+        if plate is None:
+            raise ValueError('plate is empty')
+        if self.__index is None:
+            raise ValueError('fuzzy search is disabled')
+        matches = dict((p, d) for d, p in self.__index.search(plate, distance)[:MAX_PLATES])
+        if not matches:
+            return []
+        where = 'plate IN (%s)' % ', '.join('?' * len(matches))
+        rows = self.__query(where, list(matches), since, until, source, limit)
+        for row in rows:
+            row['distance'] = matches[row['plate']]
+        return sorted(rows, key=lambda row: row['distance'])  # stable, latest first within a distance
+
+    def between(self, since=None, until=None, source=None, limit=100):
+        """
+        It returns the boxes of a time range, of one source or all of them, latest first; arguments as in exact().
+        """
+        return self.__query('', [], since, until, source, limit)
+
+    def flush(self, timeout=5.0):
+        """ Wait until the rows queued so far are written.
+
+            Args:
+                timeout(float): seconds to wait, at most
+
+            Returns:
+                (bool) False on timeout
+        """
+        written = threading.Event()
+        self.__rows.put(written)
+        return written.wait(timeout)
+
+    def __query(self, where, args, since, until, source, limit):
+        clauses = [where] if where else []
+        if source is not None:
+            clauses.append('source = ?')
+            args.append(source)
+        if since is not None:
+            clauses.append('time >= ?')
+            args.append(since)
+        if until is not None:
+            clauses.append('time < ?')
+            args.append(until)
+        sql = 'SELECT %s FROM detections %s ORDER BY time DESC LIMIT ?' % (
+            ', '.join(COLUMNS), 'WHERE ' + ' AND '.join(clauses) if clauses else '')
+        rows = self.__reader().execute(sql, args + [max(1, min(int(limit), MAX_LIMIT))]).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def __connect(self):
+        db = sqlite3.connect(self.__path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def __reader(self):
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = self.__local.db = self.__connect()
+        return db
+
+    def __index_plates(self, plates):
+        if self.__index is not None:
+            for plate in plates:
+                if plate is not None:
+                    self.__index.add(plate)
+
+    def __writer_job(self):
+        db = self.__connect()
+        if self.__index is not None:  # rows arriving meanwhile wait in the queue
+            self.__index_plates(p for p, in db.execute('SELECT DISTINCT plate FROM detections WHERE plate IS NOT NULL'))
+            logging.info('Detection store: %d plates indexed' % len(self.__index))
+        while True:
+            rows = [self.__rows.get()]
+            while len(rows) < self.__max_batch:
+                try:
+                    rows.append(self.__rows.get_nowait())
+                except queue.Empty:
+                    break
+            events = [r for r in rows if isinstance(r, threading.Event)]  # flush() markers
+            rows = [r for r in rows if not isinstance(r, threading.Event)]
+            try:
+                with db:
+                    db.executemany('INSERT INTO detections (source, time, x1, y1, x2, y2, conf, class, plate, image, '
+                                   'model) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            except sqlite3.Error as e:
+                logging.error('Detection store: %d rows dropped, %s' % (len(rows), e))
+            else:
+                self.__index_plates(row[8] for row in rows)
+            for event in events:
+                event.set()
+
+
+def normalize(plate):
+    """ Plate text as stored and searched: upper case, without spaces and dashes.
+
+        Args:
+            plate(str): plate text, None when not read
+
+        Returns:
+            (str) normalized text, None for empty text
+    """
+    if plate is None:
+        return None
+    plate = ''.join(c for c in str(plate).upper() if c not in ' -')
+    return plate or None
@@ -0,0 +1,212 @@
+"""
+Service metrics, rendered in the Prometheus text exposition format.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Counters and histograms are sharded per thread: the hot path only touches
+its own thread's shard, shards are summed when the endpoint is scraped. The
+shards of finished threads, i.e. one per request of the threaded server, are
+folded into a running total.
+"""
+
+import bisect
+import threading
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class Metric:
+    """ Metric with per-thread shards of per-label-values state. """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.__local = threading.local()
+        self.__shards = []  # (thread, shard)
+        self.__retired = dict()  # state of the finished threads
+        self.__fold_at = 64  # registered shards that trigger a fold, amortized
+        self.__lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self):
+        """
+        It returns the calling thread's shard, registering it on first use.
+        """
+        shard = getattr(self.__local, 'shard', None)
+        if shard is None:
+            shard = self.__local.shard = dict()
+            with self.__lock:
+                self.__shards.append((threading.current_thread(), shard))
+                if len(self.__shards) >= self.__fold_at:
+                    self.__fold()
+                    self.__fold_at = 2 * len(self.__shards) + 64
+        return shard
+
+    def _shards(self):
+        with self.__lock:
+            self.__fold()
+            return [dict(self.__retired)] + [shard for _, shard in self.__shards]
+
+    def __fold(self):
+        # a finished thread no longer writes its shard, it is merged into the retired state; under the lock
+        live = []
+        for thread, shard in self.__shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for values, state in list(shard.items()):
+                    self.__retired[values] = self._merge(self.__retired.get(values), state)
+        self.__shards = live
+
+    def _merge(self, total, state):
+        """ Sum of two states of the same label values, a new object since totals are read unlocked.
+
+            Args:
+                total: state so far, None for none
+                state: state of a shard
+
+            Returns:
+                the summed state
+        """
+        raise NotImplementedError
+
+    def _label_string(self, values, extra=''):
+        pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def render(self):
+        """ Text exposition of the metric.
+
+            Returns:
+                (list) lines, HELP and TYPE first
+        """
+        return ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)] + \
+            self._samples()
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """ Monotonic counter. """
+
+    kind = 'counter'
+
+    def inc(self, *values, amount=1):
+        """ Increase the counter.
+
+            Args:
+                values(str): label values, in the order of the metric labels
+                amount(float): non-negative increment
+        """
+        shard = self._shard()
+        shard[values] = shard.get(values, 0) + amount
+
+    def _merge(self, total, state):
+        return state if total is None else total + state
+
+    def _samples(self):
+        totals = dict()
+        for shard in self._shards():
+            for values, count in list(shard.items()):
+                totals[values] = totals.get(values, 0) + count
+        return ['%s%s %s' % (self.name, self._label_string(values), _number(count)) for values, count in sorted(totals.items())]
+
+
+class Gauge(Metric):
+    """ Value read when the metrics are scraped. """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.__function = None
+
+    def set_function(self, function):
+        """ Read the gauge from a callable at scrape time.
+
+            Args:
+                function(callable): returns the current value
+        """
+        self.__function = function
+
+    def _samples(self):
+        return ['%s %s' % (self.name, _number(self.__function()))] if self.__function else []
+
+
+class Histogram(Metric):
+    """ Cumulative histogram with fixed upper bounds. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labels=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *values):
+        """ Record an observation.
+
+            Args:
+                value(float): observed value, i.e. seconds
+                values(str): label values, in the order of the metric labels
+        """
+        shard = self._shard()
+        state = shard.get(values)
+        if state is None:
+            state = shard[values] = [0] * (len(self.buckets) + 2)  # per bucket, +Inf, sum
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def _merge(self, total, state):
+        return list(state) if total is None else [a + b for a, b in zip(total, state)]
+
+    def _samples(self):
+        totals = dict()
+        for shard in self._shards():
+            for values, state in list(shard.items()):
+                total = totals.setdefault(values, [0] * len(state))
+                for i, x in enumerate(state):
+                    total[i] += x
+        lines = []
+        for values, state in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                le = 'le="%s"' % ('+Inf' if bound == float('inf') else _number(bound))
+                lines.append('%s_bucket%s %d' % (self.name, self._label_string(values, le), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, self._label_string(values), _number(state[-1])))
+            lines.append('%s_count%s %d' % (self.name, self._label_string(values), cumulative))
+        return lines
+
+
+def render():
+    """ Text exposition of every registered metric.
+
+        Returns:
+            (str) Prometheus text format, version 0.0.4
+    """
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def _number(x):
+    return repr(float(x)) if isinstance(x, float) and not float(x).is_integer() else str(int(x))
+
+
+# Service metrics
+UPLOADS = Counter('anpr_uploads_total', 'Frames received by the upload endpoint.')
+UPLOAD_BYTES = Histogram('anpr_upload_bytes', 'Size of the uploaded frames in bytes.', BYTES_BUCKETS)
+QUEUE_DEPTH = Gauge('anpr_queue_depth', 'Frames waiting to be inferred.')
+DETECTED_BYTES = Gauge('anpr_detected_bytes', 'Bytes kept in the detected folder, files and segments.')
+STAGE_SECONDS = Histogram('anpr_stage_seconds', 'Latency of each processing stage in seconds.', labels=('stage',))
+BATCH_SIZE = Histogram('anpr_batch_size', 'Frames inferred together per reader batch.', BATCH_BUCKETS)
+FRAMES = Counter('anpr_frames_total', 'Frames processed by the reader.')
+DROPPED = Counter('anpr_frames_dropped_total', 'Frames rejected at upload or dropped by the reader.', ('reason',))
@@ -209,6 +209,34 @@ def fuse_conv_and_bn(conv, bn):
     return fusedconv
 
 
+def layer_flops(model, *inputs):
+    # FLOPs of one forward on inputs, counted on Conv2d and Linear layers with forward hooks, 2 FLOPs per multiply-add
+    counts = []
+
+    def conv(m, x, y):
+        counts.append(2 * y.numel() * (m.in_channels // m.groups) * m.kernel_size[0] * m.kernel_size[1])
+
+    def linear(m, x, y):
+        counts.append(2 * y.numel() * m.in_features)
+
+    hooks = [m.register_forward_hook(conv if isinstance(m, nn.Conv2d) else linear)
+             for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        for h in hooks:
+            h.remove()
+    return sum(counts)
+
+
+def tensor_bytes(x):
+    # Bytes held by a tensor or a nested list/tuple of tensors
+    if isinstance(x, (list, tuple)):
+        return sum(tensor_bytes(i) for i in x)
+    return x.numel() * x.element_size() if isinstance(x, torch.Tensor) else 0
+
+
 def model_info(model, verbose=False, img_size=640):
     # Model information. img_size may be int or list, i.e. img_size=640 or img_size=[640, 320]
     n_p = sum(x.numel() for x in model.parameters())  # number parameters
@@ -221,10 +249,9 @@ def model_info(model, verbose=False, img_size=640):
                   (i, name, p.requires_grad, p.numel(), list(p.shape), p.mean(), p.std()))
 
     try:  # FLOPs
-        from thop import profile
         stride = max(int(model.stride.max()), 32) if hasattr(model, 'stride') else 32
         img = torch.zeros((1, model.yaml.get('ch', 3), stride, stride), device=next(model.parameters()).device)  # input
-        flops = profile(deepcopy(model), inputs=(img,), verbose=False)[0] / 1E9 * 2  # stride GFLOPs
+        flops = layer_flops(deepcopy(model), img) / 1E9  # stride GFLOPs
         img_size = img_size if isinstance(img_size, list) else [img_size, img_size]  # expand if int/float
         fs = ', %.1f GFLOPs' % (flops * img_size[0] / stride * img_size[1] / stride)  # 640x640 GFLOPs
     except (ImportError, Exception):
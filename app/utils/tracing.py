@@ -0,0 +1,178 @@
+"""
+Frame traces, from the upload to the result write.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Timestamps are monotonic seconds, shared by the Writer and Reader threads;
+they are converted to wall clock time only when spans are exported.
+"""
+
+import os
+import json
+import time
+import threading
+
+EVENTS = ('receive', 'enqueue', 'dequeue', 'inference_start', 'inference_end', 'result_write')
+
+# Wall clock at monotonic zero, to export monotonic timestamps as unix time
+_EPOCH = time.time() - time.monotonic()
+
+
+class Trace:
+    """ Trace ID and event timestamps of a frame. """
+
+    def __init__(self, trace_id=None):
+        self.id = trace_id if _is_trace_id(trace_id) else os.urandom(16).hex()
+        self.events = dict()
+
+    def mark(self, event, timestamp=None):
+        """ Record an event.
+
+            Args:
+                event(str): one of EVENTS
+                timestamp(float): monotonic seconds, now by default
+        """
+        self.events[event] = time.monotonic() if timestamp is None else timestamp
+
+    def queue_wait(self):
+        """
+        It returns the seconds spent in the potential folder, None when the frame was not uploaded through the Writer.
+        """
+        if 'enqueue' in self.events and 'dequeue' in self.events:
+            return self.events['dequeue'] - self.events['enqueue']
+
+    def service_time(self):
+        """
+        It returns the seconds from dequeue to result write.
+        """
+        if 'dequeue' in self.events and 'result_write' in self.events:
+            return self.events['result_write'] - self.events['dequeue']
+
+    def to_record(self):
+        """ Trace section of a result record.
+
+            Returns:
+                (dict) trace ID, monotonic timestamps, queue wait and service time in seconds
+        """
+        return {
+            'id': self.id,
+            'timestamps': {k: round(self.events[k], 6) for k in EVENTS if k in self.events},
+            'queue_wait': _round(self.queue_wait()),
+            'service_time': _round(self.service_time())
+        }
+
+    def to_spans(self, attributes=None):
+        """ Spans of the trace in OTLP JSON form: the frame span and one child per phase.
+
+            Args:
+                attributes(dict): string attributes of the frame span
+
+            Returns:
+                (list) OTLP spans, phases missing an event are skipped
+        """
+        events = self.events
+        start = events.get('receive', events.get('dequeue'))
+        end = events.get('result_write')
+        if start is None or end is None:
+            return []
+        root = os.urandom(8).hex()
+        spans = [self.__span('frame', root, None, start, end, attributes)]
+        phases = (('upload', 'receive', 'enqueue'), ('queue', 'enqueue', 'dequeue'),
+                  ('inference', 'inference_start', 'inference_end'), ('write', 'inference_end', 'result_write'))
+        for name, first, last in phases:
+            if first in events and last in events:
+                spans.append(self.__span(name, os.urandom(8).hex(), root, events[first], events[last]))
+        return spans
+
+    def __span(self, name, span_id, parent_id, start, end, attributes=None):
+        span = {
+            'traceId': self.id,
+            'spanId': span_id,
+            'name': name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(int((_EPOCH + start) * 1e9)),
+            'endTimeUnixNano': str(int((_EPOCH + end) * 1e9)),
+            'attributes': [{'key': k, 'value': {'stringValue': str(v)}} for k, v in (attributes or {}).items()]
+        }
+        if parent_id:
+            span['parentSpanId'] = parent_id
+        return span
+
+
+class Registry:
+    """ Traces of the frames waiting in the potential folder, keyed by filename.
+    Bounded, the oldest traces are dropped when frames are removed by something other than the Reader.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.__traces = dict()
+        self.__maxsize = maxsize
+        self.__lock = threading.Lock()
+
+    def put(self, filename, trace):
+        with self.__lock:
+            self.__traces.pop(filename, None)
+            self.__traces[filename] = trace
+            if len(self.__traces) > self.__maxsize:
+                del self.__traces[next(iter(self.__traces))]
+
+    def pop(self, filename):
+        """ Take the trace of a frame.
+
+            Args:
+                filename(str): frame basename
+
+            Returns:
+                (Trace) the upload trace, or a new one for frames not uploaded through the Writer
+        """
+        with self.__lock:
+            trace = self.__traces.pop(filename, None)
+        return trace or Trace()
+
+
+TRACES = Registry()
+
+
+def export_spans(path, traces, attributes, service='license-plate-detection'):
+    """ Append the spans of a batch of traces to a JSON lines file, one OTLP export request per line.
+
+        Args:
+            path(str): output file
+            traces(list): Trace objects
+            attributes(list): span attributes of each trace
+            service(str): service.name resource attribute
+    """
+    spans = [span for trace, attrs in zip(traces, attributes) for span in trace.to_spans(attrs)]
+    if not spans:
+        return
+    request = {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+        'scopeSpans': [{'scope': {'name': 'anpr'}, 'spans': spans}]
+    }]}
+    with open(path, 'a') as f:
+        f.write(json.dumps(request) + '\n')
+
+
+def parse_trace_id(headers):
+    """ Trace ID propagated by the client, from X-Trace-Id or a W3C traceparent header.
+
+        Args:
+            headers(dict): request headers
+
+        Returns:
+            (str) 32 hex digits trace ID, None when absent or malformed
+    """
+    trace_id = headers.get('X-Trace-Id')
+    if not trace_id and headers.get('traceparent'):
+        parts = headers.get('traceparent').split('-')
+        trace_id = parts[1] if len(parts) == 4 else None
+    trace_id = trace_id.lower() if trace_id else None
+    return trace_id if _is_trace_id(trace_id) else None
+
+
+def _is_trace_id(x):
+    return isinstance(x, str) and len(x) == 32 and all(c in '0123456789abcdef' for c in x) and x != '0' * 32
+
+
+def _round(x):
+    return None if x is None else round(x, 6)
@@ -0,0 +1,301 @@
+"""
+Durable queue of the frames waiting in the potential folder.
+The comments follows the Google Python Style Guide:
+    https://github.com/google/styleguide/blob/gh-pages/pyguide.md
+
+Each frame is a row of a local SQLite database in WAL mode, moving from
+enqueued to claimed, then done or failed. Claims are leased: a frame whose
+lease expires, or whose claimer died, is claimed again. Changes are committed
+in groups, every commit_interval seconds or commit_batch changes, so a frame
+costs a few microseconds; a crash loses at most the last group, which only
+moves frames back to an earlier state, i.e. a frame is inferred at least once.
+"""
+
+import os
+import time
+import contextlib
+import uuid
+import sqlite3
+import logging
+import itertools
+import threading
+from utils.layout import Layout
+
+ENQUEUED, CLAIMED, DONE, FAILED = 'enqueued', 'claimed', 'done', 'failed'
+STAGED = '.part'  # suffix of the hidden files uploads are written to before they are enqueued
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    state TEXT NOT NULL,
+    enqueued REAL NOT NULL,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS frames_state ON frames (state, id);
+"""
+
+
+class FrameQueue:
+    """ SQLite-backed work queue of frame filenames, shared by the Writer and Reader threads. """
+
+    def __init__(self, path, commit_interval=0.05, commit_batch=256, retention=86400.0, layout=None, quarantine=None):
+        """
+            Args:
+                path(str): database file
+                commit_interval(float): seconds between group commits
+                commit_batch(int): pending changes that trigger a commit
+                retention(float): seconds done frames are kept, for inspection
+                layout(Layout): layout of the potential folder, flat by default
+                quarantine(str): folder failed frames are moved to by scan(), None to leave them in place
+        """
+        for directory in (os.path.dirname(path), quarantine):
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')  # WAL is fsynced at checkpoints, a commit is a write only
+        self.__db.executescript(SCHEMA)
+        self.__commit_interval = commit_interval
+        self.__commit_batch = commit_batch
+        self.__retention = retention
+        self.__layout = layout or Layout()
+        self.__quarantine = quarantine
+        self.__lock = threading.Lock()
+        self.__pending = 0  # uncommitted changes
+        self.__purged = 0.0
+        self.__flusher = threading.Thread(target=self.__flusher_job, daemon=True, name='queue-commit')
+        self.__flusher.start()
+
+    def recover(self, folder):
+        """ Resume after a restart: release the claims of the previous run and reconcile the folder.
+        Frames not in the queue, i.e. enqueued in a lost commit or dropped in the folder, are enqueued
+        by creation time; frames already done, whose removal was lost, are removed, and failed frames are
+        quarantined.
+
+            Args:
+                folder(str): potential folder
+
+            Returns:
+                (int) frames enqueued from the folder
+        """
+        with self.__lock:
+            self.__begin()
+            released = self.__db.execute('UPDATE frames SET state = ?, lease_until = NULL WHERE state = ?',
+                                         (ENQUEUED, CLAIMED)).rowcount
+            self.__commit()
+        entries = list(self.__layout.entries(folder))
+        if self.__layout.levels:  # the top of the folder, listed by a flat layout already
+            entries += [e for e in os.scandir(folder) if e.is_file()]
+        for path in {e.path for e in entries if e.name.startswith('.') and e.name.endswith(STAGED)}:
+            with contextlib.suppress(FileNotFoundError):  # upload interrupted by the restart
+                os.remove(path)
+        enqueued = self.scan(folder, settle=0)
+        if released:
+            logging.info('Frame queue: %d frames claimed before the restart are enqueued again' % released)
+        return enqueued
+
+    def scan(self, folder, settle=1.0):
+        """ Enqueue the frames of the folder the queue does not know, i.e. copied there directly.
+        With a sharded layout, frames copied at the top of the folder are first moved to their shard.
+        A file changed after its frame was done or failed is a new frame under a reused name and is enqueued
+        again; otherwise the file of a done frame is removed and the file of a failed frame is quarantined.
+
+            Args:
+                folder(str): potential folder
+                settle(float): seconds a file must be left untouched, so it is fully written
+
+            Returns:
+                (int) frames enqueued
+        """
+        now = time.time()
+        entries = [(e.stat().st_ctime, e.name, e.path) for e in self.__layout.entries(folder)
+                   if not e.name.startswith('.') and now - e.stat().st_mtime >= settle]
+        if self.__layout.levels:
+            for e in os.scandir(folder):
+                if e.is_file() and not e.name.startswith('.') and now - e.stat().st_mtime >= settle:
+                    ctime, path = e.stat().st_ctime, self.__layout.path(folder, e.name, create=True)
+                    os.replace(e.path, path)
+                    entries.append((ctime, e.name, path))
+        added, quarantined = 0, 0
+        for ctime, filename, path in sorted(entries):
+            with self.__lock:  # an upload under the same name replaces the file and the row under the lock too
+                row = self.__db.execute('SELECT state, finished FROM frames WHERE filename = ?',
+                                        (filename,)).fetchone()
+                if row is not None and row[0] not in (DONE, FAILED):
+                    continue
+                try:
+                    changed = os.stat(path).st_ctime
+                except FileNotFoundError:  # done meanwhile
+                    continue
+                if row is None or changed > row[1]:
+                    self.__begin()
+                    self.__db.execute('INSERT OR REPLACE INTO frames (filename, state, enqueued) VALUES (?, ?, ?)',
+                                      (filename, ENQUEUED, ctime))
+                    self.__changed(1)
+                    added += 1
+                elif row[0] == DONE:
+                    os.remove(path)
+                elif self.__quarantine:
+                    os.replace(path, os.path.join(self.__quarantine, filename))
+                    quarantined += 1
+        self.flush()
+        if quarantined:
+            logging.warning('Frame queue: %d failed frames moved to %s' % (quarantined, self.__quarantine))
+        return added
+
+    def enqueue(self, filename, staged=None, path=None):
+        """ Add a frame stored in the potential folder; a frame stored again under the same name is queued again,
+        as a new row, so the result of the previous copy does not complete it.
+
+            Args:
+                filename(str): frame basename
+                staged(str): temporary file the frame was written to, moved to path as it is enqueued, so that
+                    the frame file and its row change together with respect to complete() and fail()
+                path(str): path of the frame in the potential folder, required with staged
+        """
+        with self.__lock:
+            if staged is not None:
+                os.replace(staged, path)
+            self.__begin()
+            self.__db.execute('INSERT OR REPLACE INTO frames (filename, state, enqueued) VALUES (?, ?, ?)',
+                              (filename, ENQUEUED, time.time()))
+            self.__changed(1)
+
+    def claim(self, n, lease, max_attempts=3):
+        """ Claim the oldest frames, enqueued or with an expired lease.
+        Frames claimed max_attempts times already, i.e. that crashed the reader, fail instead.
+
+            Args:
+                n(int): maximum number of frames
+                lease(float): seconds the frames are leased for
+                max_attempts(int): claims of a frame before it fails
+
+            Returns:
+                (list) (id, filename, enqueue unix time) of the claimed frames, oldest first
+        """
+        now = time.time()
+        with self.__lock:
+            # expired leases first, they are older; two queries so that both walk the (state, id) index
+            rows = self.__db.execute('SELECT id, filename, enqueued, attempts FROM frames '
+                                     'WHERE state = ? AND lease_until < ? ORDER BY id LIMIT ?',
+                                     (CLAIMED, now, n)).fetchall()
+            rows += self.__db.execute('SELECT id, filename, enqueued, attempts FROM frames WHERE state = ? '
+                                      'ORDER BY id LIMIT ?', (ENQUEUED, n - len(rows))).fetchall()
+            if not rows:
+                return []
+            poisoned = [row[0] for row in rows if row[3] >= max_attempts]
+            claimed = [row[:3] for row in rows if row[3] < max_attempts]
+            self.__begin()
+            self.__db.executemany('UPDATE frames SET state = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?',
+                                  [(CLAIMED, now + lease, i) for i, _, _ in claimed])
+            self.__db.executemany('UPDATE frames SET state = ?, finished = ?, lease_until = NULL, error = ? '
+                                  'WHERE id = ?', [(FAILED, now, 'too many attempts', i) for i in poisoned])
+            self.__changed(len(rows))
+        for i in poisoned:
+            logging.error('Frame queue: frame %d failed after %d attempts' % (i, max_attempts))
+        return claimed
+
+    def complete(self, ids, paths=()):
+        """ Mark claimed frames as done, their result is written, and remove their files.
+        A frame uploaded again meanwhile replaced the claimed row: it is neither completed nor removed.
+
+            Args:
+                ids(list): frame ids
+                paths(list): file of each frame, removed with its row completed
+
+            Returns:
+                (list) ids of the frames completed
+        """
+        now = time.time()
+        return self.__finish('UPDATE frames SET state = ?, finished = ?, lease_until = NULL WHERE id = ? AND state = ?',
+                             [(DONE, now, i, CLAIMED) for i in ids], ids, paths)
+
+    def fail(self, ids, error, paths=()):
+        """ Mark claimed frames as failed, they are not claimed again.
+
+            Args:
+                ids(list): frame ids
+                error(str): reason
+                paths(list): file of each frame, removed with its row failed; kept in the folder by default
+
+            Returns:
+                (list) ids of the frames failed
+        """
+        now = time.time()
+        return self.__finish('UPDATE frames SET state = ?, finished = ?, lease_until = NULL, error = ? '
+                             'WHERE id = ? AND state = ?', [(FAILED, now, error, i, CLAIMED) for i in ids], ids, paths)
+
+    def depth(self):
+        """
+        It returns the number of frames waiting to be claimed.
+        """
+        with self.__lock:
+            return self.__db.execute('SELECT COUNT(*) FROM frames WHERE state = ?', (ENQUEUED,)).fetchone()[0]
+
+    def counts(self):
+        """
+        It returns the number of frames in each state.
+        """
+        with self.__lock:
+            return dict(self.__db.execute('SELECT state, COUNT(*) FROM frames GROUP BY state'))
+
+    def flush(self):
+        """
+        It commits the pending changes.
+        """
+        with self.__lock:
+            self.__commit()
+
+    def __finish(self, sql, rows, ids, paths):
+        finished = []
+        with self.__lock:
+            self.__begin()
+            for i, row, path in itertools.zip_longest(ids, rows, paths):
+                if self.__db.execute(sql, row).rowcount:
+                    finished.append(i)
+                    if path is not None and os.path.exists(path):
+                        os.remove(path)
+            self.__changed(len(rows))
+        return finished
+
+    def __begin(self):
+        if not self.__db.in_transaction:
+            self.__db.execute('BEGIN')
+
+    def __changed(self, n):
+        self.__pending += n
+        if self.__pending >= self.__commit_batch:
+            self.__commit()
+
+    def __commit(self):
+        if self.__db.in_transaction:
+            self.__db.execute('COMMIT')
+        self.__pending = 0
+
+    def __flusher_job(self):
+        while True:
+            time.sleep(self.__commit_interval)
+            with self.__lock:
+                if self.__pending:
+                    self.__commit()
+                if time.time() - self.__purged > 60:  # drop done frames past retention, once a minute
+                    self.__purged = time.time()
+                    self.__db.execute('DELETE FROM frames WHERE state = ? AND finished < ?',
+                                      (DONE, self.__purged - self.__retention))
+
+
+def staging(path):
+    """ Hidden file a frame is written to before enqueue() moves it to its path, unique per upload.
+
+        Args:
+            path(str): path of the frame in the potential folder
+
+        Returns:
+            (str) path of the staged file, in the same directory
+    """
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, '.%s.%s%s' % (filename, uuid.uuid4().hex, STAGED))
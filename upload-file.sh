@@ -1,10 +1,12 @@
 file=$1
 host=$2
 port=$3
+source=$4
 
 curl -i -v -k \
 	-X POST \
 	-H "Content-Type: multipart/form-data" \
 	-F filename=$file \
 	-F upload=@$file \
-	http://$host:$port/api/v1/frame-upload
\ No newline at end of file
+	${source:+-F source=$source} \
+	http://$host:$port/api/v1/frame-upload